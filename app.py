@@ -1,341 +1,259 @@
 import streamlit as st
 import os
-import asyncio
+import copy
 import json
-import nest_asyncio
 import time
-import shutil
-import zipfile
-import re
 import base64
-from datetime import datetime
-from gtts import gTTS
-import google.generativeai as genai
-from google.api_core import exceptions
-import requests
-from bs4 import BeautifulSoup
-import edge_tts
+import uuid
+import html
+import sqlite3
 import streamlit.components.v1 as components
-from PIL import Image
-
-# 非同期処理の適用
-nest_asyncio.apply()
+import pandas as pd
+from disk_cache import DiskCache, make_cache_key
+from menu_caches import (
+    CACHE_ROOT, TTS_CACHE_MAX_MB, open_tts_cache, open_analysis_cache, open_image_cache, open_web_cache, open_model_store,
+)
+from tts_scheduler import AdaptiveLimiter
+from workspace import WorkspaceManager
+from jobs import JobManager, JobQueueFull
+from image_prep import dhash, PerceptualIndex
+from reading_dict import DictionaryStore
+from audio_utils import find_ffmpeg
+from gemini_client import ModelCatalog, FALLBACK_MODELS
+from telemetry import Telemetry
+from lazy_import import warm_up
+from menu_library import MenuLibrary, request_key, result_complete
+from menu_pipeline import (
+    LANG_SETTINGS, TTS_MAX_CONCURRENCY, MAP_REDUCE_MIN_PAGES, FFMPEG_COMMAND, new_tts_breakers, generate_menu, generate_menu_multilingual,
+    fetch_text_from_url, regenerate_changed_tracks,
+)
 
 # ページ設定
 st.set_page_config(page_title="Multilingual Menu Generator", layout="wide")
 
+# 重い SDK (Gemini / TTS / 画像 / HTML 解析) は使うときに読み込むが、最初の操作を待たせないよう裏で先に読み込む (プロセスで1回)
+@st.cache_resource
+def start_warm_up():
+    return warm_up()
+
+start_warm_up()
+
 # CSSでボタンのスタイル調整
 st.markdown("""
 <style>
     div[data-testid="column"] { margin-bottom: 10px; }
+    a.dl-btn { display:block; text-align:center; padding:0.5em 1em; border-radius:8px; border:1px solid #ccc; color:inherit; text-decoration:none; }
+    a.dl-btn.primary { background:#ff4b4b; border-color:#ff4b4b; color:#fff; }
 </style>
 """, unsafe_allow_html=True)
 
 # --- 辞書ファイルの管理 ---
+# 辞書はメモリに保持し (全セッション共有)、ファイルが変わったときだけ読み直す
 DICT_FILE = "my_dictionary.json"
 
+@st.cache_resource
+def get_dictionary_store():
+    return DictionaryStore(DICT_FILE)
+
 def load_dictionary():
-    if os.path.exists(DICT_FILE):
-        try:
-            with open(DICT_FILE, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except json.JSONDecodeError:
-            return {}
-    return {}
+    return get_dictionary_store().entries()
 
 def save_dictionary(new_dict):
-    with open(DICT_FILE, "w", encoding="utf-8") as f:
-        json.dump(new_dict, f, ensure_ascii=False, indent=2)
-
-# --- 定数・辞書設定 ---
-LANG_SETTINGS = {
-    "Japanese": {
-        "code": "ja",
-        "voice_gender": ["女性 (七海)", "男性 (慶太)"],
-        "voice_ids": ["ja-JP-NanamiNeural", "ja-JP-KeitaNeural"],
-        "rate_value": "+10%",
-        "ui": {
-            "title": "カテゴリー", "text": "説明", "loading": "読み込み中...", "speed": "速度", 
-            "map_btn": "🗺️ 地図・アクセス (Google Map)", "intro": "こんにちは。", "toc": "目次です。",
-            "outro": "それではどうぞ。", "file_code": "ja", "currency": "円"
-        }
-    },
-    "English (UK)": {
-        "code": "en",
-        "voice_gender": ["Female (Sonia - UK)", "Male (Ryan - UK)"],
-        "voice_ids": ["en-GB-SoniaNeural", "en-GB-RyanNeural"],
-        "rate_value": "+0%",
-        "ui": {
-            "title": "Category", "text": "Description", "loading": "Loading...", "speed": "Speed",
-            "map_btn": "🗺️ Open Map (Google Map)", "intro": "Hello.", "toc": "Here is the table of contents.",
-            "outro": "Please enjoy.", "file_code": "en", "currency": "Yen"
-        }
-    },
-    "Chinese": {
-        "code": "zh",
-        "voice_gender": ["女性 (晓晓)", "男性 (云希)"],
-        "voice_ids": ["zh-CN-XiaoxiaoNeural", "zh-CN-YunxiNeural"],
-        "rate_value": "+0%",
-        "ui": {
-            "title": "类别", "text": "描述", "loading": "加载中...", "speed": "速度",
-            "map_btn": "🗺️ 打开地图 (Google Map)", "intro": "你好。", "toc": "这是目录。",
-            "outro": "请慢用。", "file_code": "zh", "currency": "日元"
-        }
-    },
-    "Korean": {
-        "code": "ko",
-        "voice_gender": ["여성 (선희)", "남성 (인준)"],
-        "voice_ids": ["ko-KR-SunHiNeural", "ko-KR-InJoonNeural"],
-        "rate_value": "+0%",
-        "ui": {
-            "title": "카테고리", "text": "설명", "loading": "로딩 중...", "speed": "속도",
-            "map_btn": "🗺️ 지도 보기 (Google Map)", "intro": "안녕하세요。", "toc": "목차입니다。",
-            "outro": "천천히 골라주세요。", "file_code": "ko", "currency": "엔"
-        }
-    }
+    get_dictionary_store().save(new_dict)
+
+# --- 共有キャッシュ (場所と容量は menu_caches。一括生成と同じものを使う) ---
+# 同じ台本・声・速度なら前回の音声を再利用する (全セッション共有)
+@st.cache_resource
+def get_tts_cache():
+    return open_tts_cache()
+
+# 同じ画像(またはWebテキスト)・プロンプト・モデルなら Gemini の解析結果を再利用する
+@st.cache_resource
+def get_analysis_cache():
+    return open_analysis_cache()
+
+# --- Gemini のモデル一覧 (API キーごと・全セッション共有) ---
+MODEL_LIST_TTL_MINUTES = float(os.environ.get("MENU_MODEL_LIST_TTL_MINUTES", "60"))
+MODEL_LIST_FIRST_WAIT = 10
+
+@st.cache_resource
+def get_model_catalog():
+    return ModelCatalog(ttl=MODEL_LIST_TTL_MINUTES * 60, store=open_model_store())
+
+# 前処理 (縮小・再圧縮) 済みの画像を元画像のハッシュごとに再利用する
+@st.cache_resource
+def get_image_cache():
+    return open_image_cache()
+
+# URL から取り込んだページ (ETag / Last-Modified と抽出済みの文章) を条件付き GET 用に残す
+@st.cache_resource
+def get_web_cache():
+    return open_web_cache()
+
+# --- 計測 (スパンのログと Prometheus 形式のメトリクス) ---
+TELEMETRY_LOG = os.environ.get("MENU_TELEMETRY_LOG", os.path.join(CACHE_ROOT, "telemetry", "spans.jsonl"))
+TELEMETRY_LOG_MAX_MB = int(os.environ.get("MENU_TELEMETRY_LOG_MAX_MB", "5"))
+METRICS_FILE = os.environ.get("MENU_METRICS_FILE", os.path.join(CACHE_ROOT, "telemetry", "menu.prom"))
+
+@st.cache_resource
+def get_telemetry():
+    return Telemetry(TELEMETRY_LOG, METRICS_FILE, TELEMETRY_LOG_MAX_MB * 1024 * 1024)
+
+# --- 作業フォルダ (セッション・ジョブごとに分離) ---
+WORKSPACE_ROOT = os.environ.get("MENU_WORKSPACE_ROOT", os.path.abspath("workspaces"))
+WORKSPACE_MAX_AGE_HOURS = float(os.environ.get("MENU_WORKSPACE_MAX_AGE_HOURS", "24"))
+WORKSPACE_MAX_MB = int(os.environ.get("MENU_WORKSPACE_MAX_MB", "2000"))
+
+@st.cache_resource
+def get_workspaces():
+    workspaces = WorkspaceManager(WORKSPACE_ROOT, WORKSPACE_MAX_AGE_HOURS * 3600, WORKSPACE_MAX_MB * 1024 * 1024)
+    workspaces.start_janitor()
+    return workspaces
+
+# --- 作成済みメニューのライブラリ (作業フォルダと違い、期限で消さない) ---
+LIBRARY_ROOT = os.environ.get("MENU_LIBRARY_DIR", os.path.abspath("library"))
+LIBRARY_LIST_MAX = int(os.environ.get("MENU_LIBRARY_LIST_MAX", "20"))
+
+@st.cache_resource
+def get_library():
+    return MenuLibrary(LIBRARY_ROOT)
+
+# --- バックグラウンドジョブ (全セッション共有のワーカープール) ---
+JOB_WORKERS = int(os.environ.get("MENU_JOB_WORKERS", "2"))
+JOB_QUEUE_MAX = int(os.environ.get("MENU_JOB_QUEUE_MAX", "8"))
+# 進捗表示を更新する間隔 (秒)
+JOB_POLL_SECONDS = float(os.environ.get("MENU_JOB_POLL_SECONDS", "1"))
+JOB_STAGE_LABELS = {
+    "queued": "順番待ち", "copy": "準備中", "analyze": "解析中", "prep": "画像最適化中", "map": "ページ解析中", "tts": "音声生成中",
+    "chapters": "音声の結合中", "html": "プレイヤー作成中", "zip": "ZIP作成中", "done": "完了",
 }
 
-# --- 関数定義 ---
-def sanitize_filename(name):
-    return re.sub(r'[\\/*?:"<>|]', "", name).replace(" ", "_").replace("　", "_")
-
-def fetch_text_from_url(url):
-    try:
-        headers = {'User-Agent': 'Mozilla/5.0'}
-        response = requests.get(url, headers=headers, timeout=10)
-        response.encoding = response.apparent_encoding
-        soup = BeautifulSoup(response.text, 'html.parser')
-        for s in soup(["script", "style", "header", "footer", "nav"]): s.extract()
-        text = soup.get_text(separator="\n")
-        lines = [line.strip() for line in text.splitlines() if line.strip()]
-        return "\n".join(lines)
-    except: return None
-
-async def generate_single_track_fast(text, filename, voice_code, rate_value):
-    for attempt in range(3):
-        try:
-            comm = edge_tts.Communicate(text, voice_code, rate=rate_value)
-            await comm.save(filename)
-            if os.path.exists(filename) and os.path.getsize(filename) > 0:
-                return True
-        except:
-            await asyncio.sleep(1)
-    if voice_code.startswith("ja"):
-        try:
-            def gtts_task():
-                tts = gTTS(text=text, lang='ja')
-                tts.save(filename)
-            await asyncio.to_thread(gtts_task)
-            return True
-        except:
-            return False
-    return False
-
-async def process_all_tracks_fast(menu_data, output_dir, voice_code, rate_value, progress_bar, lang_key):
-    tasks = []
-    track_info_list = []
-    
-    for i, track in enumerate(menu_data):
-        safe_title = sanitize_filename(track['title'])
-        filename = f"{i:02}_{safe_title}.mp3"
-        save_path = os.path.join(output_dir, filename)
-        speech_text = track['text']
-        
-        if i > 0:
-            if lang_key == "Japanese":
-                speech_text = f"{i}、{track['title']}。\n{track['text']}"
-            elif lang_key == "English (UK)":
-                speech_text = f"Chapter {i}, {track['title']}.\n{track['text']}"
-            else:
-                speech_text = f"{i}, {track['title']}.\n{track['text']}"
+@st.cache_resource
+def get_job_manager():
+    return JobManager(WORKSPACE_ROOT, JOB_WORKERS, JOB_QUEUE_MAX)
 
-        tasks.append(generate_single_track_fast(speech_text, save_path, voice_code, rate_value))
-        track_info_list.append({"title": track['title'], "path": save_path})
-    
-    total = len(tasks)
-    completed = 0
-    for task in asyncio.as_completed(tasks):
-        await task
-        completed += 1
-        progress_bar.progress(completed / total)
-    return track_info_list
-
-# HTMLテンプレート (f文字列を使わない)
-HTML_TEMPLATE_RAW = """<!DOCTYPE html>
-<html lang="__LANG_CODE__"><head><meta charset="UTF-8"><meta name="viewport" content="width=device-width, initial-scale=1.0"><title>__STORE_NAME__ __UI_TITLE__</title>
-<style>
-body{font-family:sans-serif;background:#f4f4f4;margin:0;padding:20px;line-height:1.6;}
-.c{max-width:600px;margin:0 auto;background:#fff;padding:20px;border-radius:15px;box-shadow:0 2px 10px rgba(0,0,0,0.1);}
-h1{text-align:center;font-size:1.5em;color:#333;margin-bottom:10px;}
-h2{font-size:1.2em;color:#555;margin-top:20px;margin-bottom:10px;border-bottom:2px solid #eee;padding-bottom:5px;}
-.box{background:#fff5f5;border:2px solid #ff4b4b;border-radius:10px;padding:15px;text-align:center;margin-bottom:20px;}
-.ti{font-size:1.3em;font-weight:bold;color:#b71c1c;}
-.ctrl{display:flex;gap:15px;margin:20px 0;justify-content:center;}
-button{
-    flex:1; padding:15px 0; font-size:1.8em; font-weight:bold; color:#fff; background:#ff4b4b; border:none; border-radius:8px; cursor:pointer; min-height:60px;
-    display:flex; justify-content:center; align-items:center; transition:background 0.2s;
-}
-button:hover{background:#e04141;}
-button:focus, .map-btn:focus, select:focus, .itm:focus{outline:3px solid #333; outline-offset: 2px;}
-.map-btn{display:inline-block; padding:12px 20px; background-color:#4285F4; color:white; text-decoration:none; border-radius:8px; font-weight:bold; box-shadow:0 2px 5px rgba(0,0,0,0.2);}
-.lst{border-top:1px solid #eee;padding-top:10px;}
-.itm{padding:15px;border-bottom:1px solid #eee;cursor:pointer; font-size:1.1em;}
-.itm:hover{background:#f9f9f9;}
-.itm.active{background:#ffecec;color:#b71c1c;font-weight:bold;border-left:5px solid #ff4b4b;}
-</style></head>
-<body>
-<main class="c" role="main">
-    <h1>🎧 __STORE_NAME__</h1>
-    __MAP_BUTTON__
-    <section aria-label="__UI_LOADING__">
-        <div class="box"><div class="ti" id="ti" aria-live="polite">__UI_LOADING__</div></div>
-    </section>
-    <audio id="au" style="width:100%" aria-label="__UI_TITLE__ __UI_TEXT__ Player"></audio>
-    <section class="ctrl" aria-label="Controls">
-        <button onclick="prev()" aria-label="Previous">⏮</button>
-        <button onclick="toggle()" id="pb" aria-label="Play">▶</button>
-        <button onclick="next()" aria-label="Next">⏭</button>
-    </section>
-    <div style="text-align:center;margin-bottom:20px;">
-        <label for="sp" style="font-weight:bold; margin-right:5px;">__UI_SPEED__:</label>
-        <select id="sp" onchange="csp()" style="font-size:1rem; padding:5px;">
-            <option value="0.8">0.8</option>
-            <option value="1.0" selected>1.0</option>
-            <option value="1.2">1.2</option>
-            <option value="1.5">1.5</option>
-        </select>
-    </div>
-    <h2>📜 __UI_TOC__</h2>
-    <div id="ls" class="lst" role="list" aria-label="List"></div>
-</main>
-<script>
-const pl = __PLAYLIST_JSON__;
-let idx = 0;
-const au = document.getElementById('au');
-const ti = document.getElementById('ti');
-const pb = document.getElementById('pb');
-const langKey = "__LANG_KEY__";
-
-function init(){ ren(); ld(0); csp(); }
-
-function ld(i){
-    idx = i;
-    au.src = pl[idx].src;
-    ti.innerText = pl[idx].title;
-    ren();
-    csp();
-}
-
-function toggle(){
-    if(au.paused){
-        au.play();
-        pb.innerText = "⏸";
-    } else {
-        au.pause();
-        pb.innerText = "▶";
-    }
-}
-
-function next(){
-    if(idx < pl.length - 1){
-        ld(idx + 1);
-        au.play();
-        pb.innerText = "⏸";
-    }
-}
-
-function prev(){
-    if(idx > 0){
-        ld(idx - 1);
-        au.play();
-        pb.innerText = "⏸";
-    }
-}
-
-function csp(){
-    au.playbackRate = parseFloat(document.getElementById('sp').value);
-}
-
-au.onended = function(){
-    if(idx < pl.length - 1){
-        next();
-    } else {
-        pb.innerText = "▶";
-    }
-};
+# --- 音声生成の同時実行数 (全セッション共有) ---
+@st.cache_resource
+def get_tts_limiter():
+    return AdaptiveLimiter(TTS_MAX_CONCURRENCY)
 
-function getLabel(t, i){
-    if (i === 0) return t.title;
-    if (langKey === 'Japanese') return i + "、" + t.title;
-    if (langKey === 'English (UK)') return "Chapter " + i + ". " + t.title;
-    return i + ". " + t.title;
-}
+# エンジンごとのサーキットブレーカー (障害中のエンジンは即座に飛ばす)
+@st.cache_resource
+def get_tts_breakers():
+    return new_tts_breakers()
 
-function ren(){
-    const d = document.getElementById('ls');
-    d.innerHTML = "";
-    pl.forEach((t, i) => {
-        const m = document.createElement('div');
-        m.className = "itm " + (i === idx ? "active" : "");
-        m.setAttribute("role", "listitem");
-        m.setAttribute("tabindex", "0");
-        let label = getLabel(t, i);
-        m.innerText = label;
-        m.onclick = () => { ld(i); au.play(); pb.innerText = "⏸"; };
-        m.onkeydown = (e) => { if(e.key === 'Enter' || e.key === ' '){ e.preventDefault(); m.click(); } };
-        d.appendChild(m);
-    });
-}
-init();
-</script></body></html>"""
+# --- 似た画像の検出 (同じページの撮り直し・重複アップロード) ---
+# 64ビットの dHash でハミング距離がこれ以下なら同じページとみなす
+DUP_HAMMING_THRESHOLD = int(os.environ.get("MENU_DUP_HAMMING_THRESHOLD", "6"))
 
-# HTMLプレイヤー生成 (安全な置換方式)
-def create_standalone_html_player(store_name, menu_data, map_url="", lang_key="Japanese"):
-    ui = LANG_SETTINGS[lang_key]["ui"]
-    
-    playlist_js = []
-    for track in menu_data:
-        file_path = track['path']
-        if os.path.exists(file_path):
-            with open(file_path, "rb") as f:
-                b64_data = base64.b64encode(f.read()).decode()
-                playlist_js.append({"title": track['title'], "src": f"data:audio/mp3;base64,{b64_data}"})
-    playlist_json_str = json.dumps(playlist_js, ensure_ascii=False)
-    
-    map_button_html = ""
-    if map_url:
-        map_button_html = f"""
-        <div style="text-align:center; margin-bottom: 15px;">
-            <a href="{map_url}" target="_blank" role="button" aria-label="{ui['map_btn'].replace('🗺️ ', '')}" class="map-btn">
-                {ui['map_btn']}
-            </a>
-        </div>
-        """
-    
-    # 文字列置換で埋め込み（f文字列を使わないので安全）
-    html = HTML_TEMPLATE_RAW
-    html = html.replace("__LANG_CODE__", LANG_SETTINGS[lang_key]['code'])
-    html = html.replace("__STORE_NAME__", store_name)
-    html = html.replace("__UI_TITLE__", ui['title'])
-    html = html.replace("__UI_TEXT__", ui['text'])
-    html = html.replace("__UI_LOADING__", ui['loading'])
-    html = html.replace("__UI_SPEED__", ui['speed'])
-    html = html.replace("__UI_TOC__", ui['toc'])
-    html = html.replace("__MAP_BUTTON__", map_button_html)
-    html = html.replace("__PLAYLIST_JSON__", playlist_json_str)
-    html = html.replace("__LANG_KEY__", lang_key)
-    
-    return html
+@st.cache_data(max_entries=512, show_spinner=False)
+def image_dhash(data):
+    try:
+        return dhash(data)
+    except OSError:
+        return None
+
+def index_images(name, files):
+    # 索引は session_state[name] に持ち、前回から増えた画像だけハッシュを計算して足す (消えた画像は外す)。
+    # 前の画像と似ているものは除く → (索引, 残した画像, [(番号, 似ている番号, 距離)])  索引のキーは file_id
+    state = st.session_state.get(name)
+    if state is None:
+        state = st.session_state[name] = {"index": PerceptualIndex(DUP_HAMMING_THRESHOLD), "hashes": {}, "status": {}}
+    index, hashes, status = state["index"], state["hashes"], state["status"]
+    ids = [f.file_id for f in files]
+    pos = {key: i for i, key in enumerate(ids)}
+    gone = [key for key in hashes if key not in pos]
+    for key in gone:
+        del hashes[key]
+        status.pop(key, None)
+        index.remove(key)
+    if gone:
+        # 消えた画像と似ていたために除いていた画像は調べ直す (ハッシュは計算済み)
+        for key in [k for k, hit in status.items() if hit and hit[0] not in pos]: del status[key]
+    unique, duplicates = [], []
+    for i, (f, key) in enumerate(zip(files, ids)):
+        if key not in status:
+            if key not in hashes: hashes[key] = image_dhash(f.getvalue())
+            h = hashes[key]
+            status[key] = index.find(h) if h is not None else None
+            if status[key] is None and h is not None: index.add(key, h)
+        hit = status[key]
+        if hit:
+            duplicates.append((i, pos[hit[0]], hit[1])); continue
+        unique.append(f)
+    return index, unique, duplicates
+
+def find_similar(index, files, f, exclude=None):
+    # files の中で f とほぼ同じ画像 → (番号, 距離)。exclude の番号は比べない
+    h = image_dhash(f.getvalue())
+    if h is None: return None
+    hit = index.find(h, exclude=files[exclude].file_id if exclude is not None else None)
+    if not hit: return None
+    return [x.file_id for x in files].index(hit[0]), hit[1]
+
+# --- プレビュー音声の配信 ---
+# 静的ファイル配信 (.streamlit/config.toml の server.enableStaticServing) が有効なら、
+# 音声を static/preview/ にハッシュ名で置いて URL で渡す。再実行のたびに送るのは数KBの HTML だけになる。
+# 無効な環境では data URI に戻すが、エンコード結果はファイルのハッシュごとにメモ化する。
+# 表示中のプレビューの音声は、セッションごとに作業フォルダと同じ期間 pin して、容量の整理で消さない
+# (再生ボタンを押すのは表示してからしばらく後のことがある)。
+STATIC_PREVIEW_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "preview")
+PREVIEW_CACHE_MAX_MB = int(os.environ.get("MENU_PREVIEW_CACHE_MAX_MB", "300"))
+
+@st.cache_resource
+def get_preview_store():
+    return DiskCache(STATIC_PREVIEW_DIR, PREVIEW_CACHE_MAX_MB * 1024 * 1024, suffix=".mp3")
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def _track_data_uri(path, digest):
+    with open(path, "rb") as f:
+        return f"data:audio/mp3;base64,{base64.b64encode(f.read()).decode()}"
+
+def preview_src(track):
+    digest = track.get('digest')
+    if digest and st.get_option("server.enableStaticServing"):
+        store = get_preview_store()
+        if store.has(digest) or store.store(digest, track['path']):
+            return f"app/static/preview/{digest[:2]}/{digest}.mp3"
+    return _track_data_uri(track['path'], digest or str(os.path.getmtime(track['path'])))
+
+# --- 成果物のダウンロード ---
+# st.download_button は再実行のたびにファイルの中身をメモリに読み込むので、静的ファイル配信が有効なら
+# ZIP / HTML を static/downloads/ に推測できない名前で置き、リンクからディスクのまま配信する。
+# (名前はファイルのパス・サイズ・更新時刻とプロセスごとの秘密の値から作るので、差分再生成で中身が変わると別の名前になる)
+STATIC_DOWNLOAD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "downloads")
+DOWNLOAD_CACHE_MAX_MB = int(os.environ.get("MENU_DOWNLOAD_CACHE_MAX_MB", "2000"))
+
+@st.cache_resource
+def get_download_store():
+    return DiskCache(STATIC_DOWNLOAD_DIR, DOWNLOAD_CACHE_MAX_MB * 1024 * 1024)
+
+@st.cache_resource
+def get_download_secret():
+    return uuid.uuid4().hex
+
+def download_link(path, file_name, label, mime, primary=False):
+    if st.get_option("server.enableStaticServing"):
+        info = os.stat(path)
+        key = make_cache_key(os.path.abspath(path), info.st_size, info.st_mtime_ns, get_download_secret())
+        store = get_download_store()
+        # has() が最終利用時刻を更新するので、表示中のリンクの先は容量の整理で消されにくい
+        if store.has(key) or store.store(key, path):
+            st.markdown(f'<a class="dl-btn{" primary" if primary else ""}" href="app/static/downloads/{key[:2]}/{key}"'
+                        f' download="{html.escape(file_name)}">{html.escape(label)}</a>', unsafe_allow_html=True)
+            return
+    with open(path, "rb") as f:
+        st.download_button(label, f, file_name, mime, type="primary" if primary else "secondary")
 
 # プレビュー用プレイヤー (シンプル版)
 def render_preview_player(tracks, lang_key):
-    ui = LANG_SETTINGS[lang_key]["ui"]
+    if st.get_option("server.enableStaticServing"):
+        digests = [t['digest'] for t in tracks if t.get('digest')]
+        get_preview_store().pin(st.session_state.session_id, digests, WORKSPACE_MAX_AGE_HOURS * 3600)
     playlist_data = []
     for track in tracks:
         if os.path.exists(track['path']):
-            with open(track['path'], "rb") as f:
-                b64_data = base64.b64encode(f.read()).decode()
-                playlist_data.append({"title": track['title'],"src": f"data:audio/mp3;base64,{b64}"})
+            playlist_data.append({"title": track['title'], "src": preview_src(track)})
     playlist_json = json.dumps(playlist_data)
     
     # プレビュー用HTMLも同様にRaw文字列で定義
@@ -392,6 +310,50 @@ def render_preview_player(tracks, lang_key):
     preview_html = preview_html.replace("__PLAYLIST__", playlist_json)
     components.html(preview_html, height=450)
 
+# 差分再生成: 編集された台本と manifest を比べ、変わったトラックだけ作り直す
+# 表示する結果を差し替える。前回の結果の作業フォルダはもう参照されないので消す (ライブラリのフォルダは残す)
+def show_result(result):
+    prev_result = st.session_state.get("generated_result")
+    st.session_state.generated_result = result
+    if prev_result and not prev_result.get("library_id") and prev_result.get("job_dir") != result["job_dir"]:
+        get_workspaces().remove(prev_result["job_dir"])
+
+# 台本の修正をバックグラウンドのジョブで反映する (進捗は job_progress で表示し、終わったら結果を差し替える)。
+# ライブラリのエントリは他のセッションや後の同じ依頼も使うので、新しい作業フォルダに写してから直す。
+def submit_edit_job(res, lang_key, categories):
+    workspaces = get_workspaces()
+    library_id = res.get("library_id")
+    job_dir = workspaces.create(st.session_state.session_id) if library_id else res["job_dir"]
+    tts = {"tts_cache": get_tts_cache(), "limiter": get_tts_limiter(), "breakers": get_tts_breakers(),
+           "readings": get_dictionary_store().dictionary}
+
+    def run_edit(job, res=res, library=get_library(), tts=tts):
+        if library_id:
+            job.report("copy", 0.0, "ライブラリから作業フォルダに写しています...")
+            res = library.copy_to(library_id, job.dir)
+            if res is None: raise RuntimeError("ライブラリのファイルが見つかりません")
+        else:
+            # 画面が表示中の dict は書き換えず、写しを直して返す
+            res = copy.deepcopy(res)
+        view = res
+        if res.get("multilingual"): view = next(v for v in res["languages"] if v["lang_key"] == lang_key)
+        res["edit_stats"] = regenerate_changed_tracks(view, categories, report=job.report, **tts)
+        return res
+
+    def finish_edit(job):
+        # 写しを作ったフォルダは失敗したら消す (元の作業フォルダは残す)
+        if library_id and job.state != "done": workspaces.remove(job.dir)
+        else: workspaces.release(job.dir)
+
+    try:
+        job_id = get_job_manager().submit(job_dir, run_edit, on_finish=finish_edit)
+    except JobQueueFull as e:
+        if library_id: workspaces.remove(job_dir)
+        st.warning(str(e)); return
+    st.session_state.job_id = job_id
+    st.query_params["job"] = job_id
+    st.rerun()
+
 # --- UI ---
 user_dict = load_dictionary()
 
@@ -403,16 +365,26 @@ with st.sidebar:
     else:
         api_key = st.text_input("Gemini APIキー", type="password")
     
-    valid_models = []
     target_model_name = None
     if api_key:
-        try:
-            genai.configure(api_key=api_key)
-            all_models = list(genai.list_models())
-            valid_models = [m.name for m in all_models if 'generateContent' in m.supported_generation_methods]
-            default_idx = next((i for i, n in enumerate(valid_models) if "flash" in n), 0)
-            target_model_name = st.selectbox("使用するAIモデル", valid_models, index=default_idx)
-        except: pass
+        # 一覧はキャッシュから読むだけ (取得・更新は裏で行う)。初回だけ取得を少し待つ
+        model_catalog = get_model_catalog()
+        catalog = model_catalog.get(api_key)
+        if not catalog["models"] and catalog["refreshing"]:
+            with st.spinner("AIモデルの一覧を取得しています..."):
+                catalog = model_catalog.wait(api_key, MODEL_LIST_FIRST_WAIT)
+        valid_models = catalog["models"] or FALLBACK_MODELS
+        if catalog["error"]:
+            st.warning(f"モデル一覧を取得できませんでした: {catalog['error']}\n\n"
+                       + ("前回取得した一覧を表示しています。" if catalog["models"] else "既定のモデルを表示しています。APIキーを確認してください。"))
+        default_idx = next((i for i, n in enumerate(valid_models) if "flash" in n), 0)
+        target_model_name = st.selectbox("使用するAIモデル", valid_models, index=default_idx)
+        mc1, mc2 = st.columns([3, 1])
+        if catalog["fetched_at"]:
+            mc1.caption(f"🔄 一覧の取得: {int((time.time() - catalog['fetched_at']) // 60)}分前" + ("（更新中）" if catalog["refreshing"] else ""))
+        if mc2.button("🔄", key="refresh_models", help="モデル一覧を取り直す"):
+            model_catalog.refresh(api_key)
+            st.rerun()
     
     st.divider()
 
@@ -427,10 +399,24 @@ with st.sidebar:
     
     rate_value = current_lang_config["rate_value"]
 
+    tts_cache = get_tts_cache()
+    tts_limiter = get_tts_limiter()
+    limiter_state = tts_limiter.snapshot()
+    tts_breakers = get_tts_breakers()
+    cache_stats = tts_cache.stats()
+    st.caption(f"🗂️ 音声キャッシュ: ヒット {cache_stats['hits']} / ミス {cache_stats['misses']}"
+               f" ({cache_stats['files']}件, {cache_stats['bytes'] / 1024 / 1024:.1f}MB / {TTS_CACHE_MAX_MB}MB)")
+    st.caption(f"🚦 音声生成の同時実行: {limiter_state['active']} / 上限 {limiter_state['limit']} (待ち {limiter_state['waiting']})")
+    st.caption("🔌 " + " / ".join(f"{name}: {b.state}" for name, b in tts_breakers.items()))
+    hedge_after = None
+    if st.checkbox("🛡️ 音声生成が遅いときは gTTS も並行実行する", value=False):
+        hedge_after = st.slider("待ち時間 (秒)", 2.0, 20.0, 6.0, 1.0)
+    show_timings = st.checkbox("⏱️ 作成後に段階別の処理時間を表示する", value=False)
+
     if selected_lang == "Japanese":
         st.divider()
         st.subheader("📖 辞書登録")
-        st.caption("よく間違える読み方を登録すると、AIが学習します。")
+        st.caption(f"よく間違える読み方を登録すると、読み上げ時にその読みで発音します。（登録 {len(user_dict)}語）")
         with st.form("dict_form", clear_on_submit=True):
             c1, c2 = st.columns(2)
             new_word = c1.text_input("単語", placeholder="辛口")
@@ -441,6 +427,31 @@ with st.sidebar:
                 st.success("登録しました")
                 st.rerun()
 
+    st.divider()
+    st.subheader("📚 ライブラリ")
+    library = get_library()
+    library_stats = library.stats()
+    st.caption(f"作成済みのメニュー {library_stats['entries']}件 ({library_stats['bytes'] / 1024 / 1024:.1f}MB)。"
+               "同じ内容・設定で作成すると、生成し直さずにここから開きます。")
+    library_query = st.text_input("店舗名・メニュー名で検索", placeholder="例：カフェ", key="library_query")
+    for entry in library.search(library_query, LIBRARY_LIST_MAX):
+        lc1, lc2 = st.columns([4, 1])
+        label = entry["store_name"] + (f" / {entry['menu_title']}" if entry["menu_title"] else "")
+        if lc1.button(f"📂 {label}", key=f"library_open_{entry['id']}", use_container_width=True):
+            opened = library.get(entry["id"])
+            if opened is None:
+                library.remove(entry["id"])
+                st.warning("ファイルが見つからないため、ライブラリから削除しました。")
+            else:
+                show_result(opened)
+                st.rerun()
+        if lc2.button("🗑️", key=f"library_remove_{entry['id']}", help="ライブラリから削除"):
+            library.remove(entry["id"])
+            current = st.session_state.get("generated_result")
+            if current and current.get("library_id") == entry["id"]: st.session_state.generated_result = None
+            st.rerun()
+        lc1.caption(f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['created']))} ・ {entry['languages']}")
+
 st.title("🎧 Multilingual Menu Player Generator")
 st.caption(f"アクセシビリティに配慮した音声メニューを{selected_lang}で作成します。")
 
@@ -448,6 +459,9 @@ if 'retake_index' not in st.session_state: st.session_state.retake_index = None
 if 'captured_images' not in st.session_state: st.session_state.captured_images = []
 if 'generated_result' not in st.session_state: st.session_state.generated_result = None
 if 'show_camera' not in st.session_state: st.session_state.show_camera = False
+if 'session_id' not in st.session_state: st.session_state.session_id = uuid.uuid4().hex
+# URL の ?job= からジョブを引き継ぐ (ブラウザの再読み込み・再接続後も進捗を追える)
+if 'job_id' not in st.session_state: st.session_state.job_id = st.query_params.get("job")
 
 st.markdown("### 1. お店情報の入力")
 c1, c2 = st.columns(2)
@@ -464,7 +478,11 @@ target_url = None
 
 if input_method == "📂 アルバムから":
     uploaded_files = st.file_uploader("写真を選択", type=['png', 'jpg', 'jpeg'], accept_multiple_files=True)
-    if uploaded_files: final_image_list.extend(uploaded_files)
+    if uploaded_files:
+        _, unique_files, duplicates = index_images("album_image_index", uploaded_files)
+        for i, j, _ in duplicates:
+            st.warning(f"「{uploaded_files[i].name}」は「{uploaded_files[j].name}」とほぼ同じ画像のため除外しました。")
+        final_image_list.extend(unique_files)
 
 elif input_method == "📷 その場で撮影":
     # 再撮影ロジック
@@ -474,6 +492,10 @@ elif input_method == "📷 その場で撮影":
         # 再撮影は頻度が低いのでキーを変えても許容（確実に更新するため）
         retake_key = f"retake_{target_idx}_{int(time.time())}"
         cam = st.camera_input("再撮影", key=retake_key)
+        if cam is not None:
+            index, _, _ = index_images("captured_image_index", st.session_state.captured_images)
+            hit = find_similar(index, st.session_state.captured_images, cam, exclude=target_idx)
+            if hit: st.warning(f"No.{hit[0] + 1} とほぼ同じ写真です。")
         
         rc1, rc2 = st.columns(2)
         with rc1:
@@ -495,11 +517,12 @@ elif input_method == "📷 その場で撮影":
         # ★カメラIDを固定して再アクセスを防ぐ★
         cam = st.camera_input("撮影", key="menu_camera_fixed")
         
-        # すでにリストにある最後の画像と同じかチェック（連打防止）
-        is_new = True
+        # 撮影済みのどの画像ともほぼ同じでないかチェック（連打・撮り直し防止）
+        similar = None
         if cam is not None and st.session_state.captured_images:
-            if st.session_state.captured_images[-1].getvalue() == cam.getvalue():
-                is_new = False
+            index, _, _ = index_images("captured_image_index", st.session_state.captured_images)
+            similar = find_similar(index, st.session_state.captured_images, cam)
+        is_new = similar is None
         
         if cam is not None:
             c1, c2 = st.columns(2)
@@ -511,7 +534,7 @@ elif input_method == "📷 その場で撮影":
                         time.sleep(1) # メッセージを見せる
                         st.rerun()
                     else:
-                        st.warning("同じ写真です。新しい写真を撮影してください。")
+                        st.warning(f"No.{similar[0] + 1} とほぼ同じ写真です。新しいページを撮影してください。")
             with c2:
                 if st.button("✅ 追加して終了", type="primary", use_container_width=True):
                     if is_new:
@@ -560,124 +583,224 @@ if current_images and st.session_state.retake_index is None:
 
 st.markdown("---")
 st.markdown("### 3. 音声メニューの作成")
-disable_create = (st.session_state.retake_index is not None) or (st.session_state.show_camera)
+disable_create = (st.session_state.retake_index is not None) or (st.session_state.show_camera) or bool(st.session_state.job_id)
+oc1, oc2 = st.columns(2)
+with oc1: use_streaming = st.checkbox("⚡ 解析しながら音声を生成する（高速）", value=True)
+with oc2: force_reanalyze = st.checkbox("🔁 前回の解析結果を使わずにAIで再解析する", value=False,
+                                        help="ライブラリに同じ内容のメニューがあっても作り直します")
+multilingual = st.checkbox("🌏 複数の言語をまとめて作成する（解析は1回だけ・1つのZIPに言語切り替えページ付き）", value=False)
+if multilingual:
+    batch_langs = st.multiselect("作成する言語", list(LANG_SETTINGS.keys()), default=list(LANG_SETTINGS.keys()))
+map_reduce = st.checkbox(f"📚 {MAP_REDUCE_MIN_PAGES}ページ以上のメニューは数ページずつ分けて解析する（大きなメニュー向け）", value=True)
+PLAYER_MODES = {"📧 1ファイル（メール配布向け・音声埋め込み）": "single", "⚡ 軽量版（Webサーバー設置向け・オフライン対応）": "split"}
+player_mode = PLAYER_MODES[st.radio("プレイヤー形式", list(PLAYER_MODES.keys()), horizontal=True)]
+AUDIO_LAYOUTS = {"🎵 カテゴリーごとの音声": "tracks", "📀 1つの音声にまとめる（チャプター付き・通信が不安定な環境向け）": "chapters"}
+audio_layout = AUDIO_LAYOUTS[st.radio("音声の形式", list(AUDIO_LAYOUTS.keys()), horizontal=True)]
+audio_codec = "mp3"
+if audio_layout == "chapters":
+    AUDIO_CODEC_LABELS = {"MP3（どの環境でも再生可）": "mp3", "Opus（最も小さい・iOS 17 以降）": "opus", "AAC（小さい・iPhone でも再生可）": "aac"}
+    audio_codec = AUDIO_CODEC_LABELS[st.selectbox("圧縮形式", list(AUDIO_CODEC_LABELS.keys()))]
+    if not find_ffmpeg(FFMPEG_COMMAND):
+        st.caption("⚠️ ffmpeg が見つからないため、MP3 のまま無劣化でつなぎます（音量の調整と軽量化はできません）。")
 if st.button("🎙️ 作成開始", type="primary", use_container_width=True, disabled=disable_create):
     if not (api_key and target_model_name and store_name):
         st.error("設定や店舗名を確認してください"); st.stop()
     if not (current_images or target_url):
         st.warning("画像かURLを入力してください"); st.stop()
 
-    output_dir = os.path.abspath("menu_audio_album")
-    if os.path.exists(output_dir): shutil.rmtree(output_dir)
-    os.makedirs(output_dir)
+    # 画像はここでバイト列にしてからワーカーに渡す (UploadedFile はスクリプト側のオブジェクト)
+    images = []
+    for f in current_images:
+        f.seek(0)
+        images.append({"mime_type": f.type if hasattr(f, 'type') else 'image/jpeg', "data": f.getvalue()})
+    params = {
+        "store_name": store_name, "menu_title": menu_title, "map_url": map_url,
+        "lang_key": selected_lang, "voice_code": voice_code, "rate_value": rate_value,
+        "api_key": api_key, "model_name": target_model_name,
+        "images": images, "target_url": None if images else target_url,
+        "use_streaming": use_streaming, "force_reanalyze": force_reanalyze, "hedge_after": hedge_after,
+        "player_mode": player_mode, "map_reduce": map_reduce, "audio_layout": audio_layout, "audio_codec": audio_codec,
+    }
+    run_pipeline = generate_menu
+    if multilingual:
+        if not batch_langs:
+            st.warning("言語を選んでください"); st.stop()
+        # 声の種類 (女性/男性) はサイドバーの選択を全言語に当てはめる
+        params.update(languages=batch_langs,
+                      voice_codes={k: LANG_SETTINGS[k]["voice_ids"][voice_idx] for k in batch_langs})
+        run_pipeline = generate_menu_multilingual
+
+    # 同じ元データ・同じ設定のメニューがライブラリにあれば、生成し直さずにそれを開く
+    # (URL はページの中身で比べるので、取り込んでから裏のジョブで探す)
+    library = get_library()
+    if images and not force_reanalyze:
+        existing = library.find(request_key(params, user_dict))
+        if existing:
+            show_result(existing)
+            st.rerun()
 
-    with st.spinner('解析中...'):
+    workspaces = get_workspaces()
+    job_dir = workspaces.create(st.session_state.session_id)
+    resources = {"tts_cache": tts_cache, "analysis_cache": get_analysis_cache(), "image_cache": get_image_cache(), "web_cache": get_web_cache(),
+                 "limiter": tts_limiter, "breakers": tts_breakers, "readings": get_dictionary_store().dictionary,
+                 "telemetry": get_telemetry()}
+
+    def run_job(job, params=params, job_dir=job_dir, resources=resources, run_pipeline=run_pipeline,
+                library=library, dictionary=dict(user_dict), force=force_reanalyze):
+        web_text = None
+        if params["target_url"]:
+            # 取り込んだ本文でライブラリのキーを作り、生成にも同じ本文を渡す (クロールは1回だけ)
+            job.report("analyze", 0.0, "ページを取り込んでいます...")
+            web_text, web_stats = fetch_text_from_url(params["target_url"], resources["web_cache"])
+            params = {**params, "web_text": web_text, "web_stats": web_stats}
+        library_key = request_key(params, dictionary, web_text)
+        if not force:
+            existing = library.find(library_key)
+            if existing: return existing
+        result = run_pipeline(params, job_dir, report=job.report, **resources)
+        # 一部のトラックが作れなかった結果は保存しない (次の同じ依頼では作り直す)
+        if not result_complete(result): return result
+        # ライブラリに写せなくても、作成した結果はそのまま返す
         try:
-            genai.configure(api_key=api_key)
-            model = genai.GenerativeModel(target_model_name)
-            parts = []
-            
-            lang_instruction = ""
-            currency = current_lang_config["ui"]["currency"]
-            dict_prompt = ""
-            
-            if selected_lang == "Japanese":
-                lang_instruction = f"出力は全て日本語で行ってください。価格の数字には必ず「{currency}」をつけて読み上げる。"
-                user_dict_str = json.dumps(user_dict, ensure_ascii=False)
-                dict_prompt = f"★重要：以下の固有名詞・読み方辞書を必ず守ってください。\n{user_dict_str}\n"
-            elif selected_lang == "English (UK)":
-                lang_instruction = f"Translate all output into British English (UK). Group prices with {currency}."
-            elif selected_lang == "Chinese":
-                lang_instruction = f"Translate all output into Simplified Chinese. Group prices with {currency}."
-            elif selected_lang == "Korean":
-                lang_instruction = f"Translate all output into Korean. Group prices with {currency}."
-
-            prompt = f"""
-            You are a professional menu accessibility expert.
-            Analyze the menu images/text and organize them into 5-8 major categories.
-            1. {lang_instruction}
-            2. Group items intelligently.
-            3. The 'text' field should be a reading script suitable for customers.
-            4. Allergens, spice level, notes must be included.
-            {dict_prompt}
-            Output MUST be valid JSON only:
-            [
-              {{"title": "Category Name", "text": "Reading script..."}},
-              {{"title": "Category Name", "text": "Reading script..."}}
-            ]
-            """
-            
-            # 画像リストは current_images を使う
-            if current_images:
-                parts.append(prompt)
-                for f in current_images:
-                    f.seek(0)
-                    parts.append({"mime_type": f.type if hasattr(f, 'type') else 'image/jpeg', "data": f.getvalue()})
-            elif target_url:
-                web_text = fetch_text_from_url(target_url)
-                if not web_text: st.error("URLエラー"); st.stop()
-                parts.append(prompt + f"\n\n{web_text[:30000]}")
-
-            resp = None
-            for _ in range(3):
-                try: resp = model.generate_content(parts); break
-                except exceptions.ResourceExhausted: time.sleep(5)
-                except: pass
-
-            if not resp: st.error("失敗しました"); st.stop()
-
-            text_resp = resp.text
-            start = text_resp.find('[')
-            end = text_resp.rfind(']') + 1
-            if start == -1: st.error("解析エラー"); st.stop()
-            menu_data = json.loads(text_resp[start:end])
-
-            ui = current_lang_config["ui"]
-            intro_t = f"{ui['intro']} {store_name}."
-            if menu_title: intro_t += f" {menu_title}."
-            
-            for i, tr in enumerate(menu_data):
-                if selected_lang == "Japanese": intro_t += f" {i+1}、{tr['title']}。"
-                else: intro_t += f" {i+1}, {tr['title']}."
-            intro_t += f" {ui['outro']}"
-            menu_data.insert(0, {"title": ui['toc'], "text": intro_t})
-
-            progress_bar = st.progress(0)
-            st.info(f"音声を生成しています... ({selected_lang})")
-            generated_tracks = asyncio.run(process_all_tracks_fast(menu_data, output_dir, voice_code, rate_value, progress_bar, selected_lang))
-
-            html_str = create_standalone_html_player(store_name, generated_tracks, map_url, selected_lang)
-            
-            d_str = datetime.now().strftime('%Y%m%d')
-            s_name = sanitize_filename(store_name)
-            file_code = current_lang_config["ui"]["file_code"]
-            zip_name = f"{s_name}_{file_code}_{d_str}.zip"
-            zip_path = os.path.abspath(zip_name)
-            with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as z:
-                for root, dirs, files in os.walk(output_dir):
-                    for file in files: z.write(os.path.join(root, file), file)
-
-            with open(zip_path, "rb") as f:
-                zip_data = f.read()
-
-            st.session_state.generated_result = {
-                "zip_data": zip_data,
-                "zip_name": zip_name,
-                "html_content": html_str, 
-                "html_name": f"{s_name}_{file_code}_player.html",
-                "tracks": generated_tracks,
-                "lang_key": selected_lang
-            }
-            st.balloons()
-        except Exception as e: st.error(f"エラー: {e}")
+            return library.add(job_dir, result, params, library_key, web_text) or result
+        except (OSError, sqlite3.Error):
+            return result
+
+    def finish_job(job, workspaces=workspaces):
+        if job.state == "done": workspaces.release(job.dir)
+        else: workspaces.remove(job.dir)
+
+    try:
+        job_id = get_job_manager().submit(job_dir, run_job, on_finish=finish_job)
+    except JobQueueFull as e:
+        workspaces.remove(job_dir)
+        st.warning(str(e)); st.stop()
+    st.session_state.job_id = job_id
+    st.query_params["job"] = job_id
+    st.rerun()
+
+# 実行中のジョブの進捗を表示し、終わったら結果を取り込む
+# 進捗の表示だけを一定間隔で描き直す (画面全体は再実行しない)。終わったら全体を再実行して結果を取り込む
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def job_progress(job_id):
+    status = get_job_manager().status(job_id)
+    if status is None or status["state"] not in ("queued", "running"):
+        st.rerun()
+    stage_label = JOB_STAGE_LABELS.get(status["stage"], status["stage"])
+    st.info(f"⏳ {stage_label}: {status['message'] or '...'}")
+    st.progress(status["progress"])
+
+if st.session_state.job_id:
+    status = get_job_manager().status(st.session_state.job_id)
+    if status is None:
+        st.session_state.job_id = None
+        st.query_params.pop("job", None)
+    elif status["state"] in ("queued", "running"):
+        job_progress(st.session_state.job_id)
+    else:
+        st.session_state.job_id = None
+        st.query_params.pop("job", None)
+        if status["state"] == "failed":
+            st.error(f"エラー: {status['error']}")
+        else:
+            # セッションにはファイルのパスだけを持ち、中身はダウンロード時にディスクから読む
+            result = status["result"]
+            edit_stats = result.pop("edit_stats", None)
+            show_result(result)
+            if edit_stats is None:
+                st.balloons()
+            elif not edit_stats["changed"]:
+                st.info("変更されたトラックはありません")
+            else:
+                st.success(f"{edit_stats['updated']}トラックを更新しました")
+                if edit_stats["failed"]:
+                    st.warning(f"{edit_stats['failed']}トラックは音声を作れませんでした。もう一度「変更を反映して再生成」を押すと作り直します。")
 
 if st.session_state.generated_result:
     res = st.session_state.generated_result
+    if res.get("job_dir") and not res.get("library_id"): get_workspaces().touch(res["job_dir"])
     st.divider()
-    st.subheader(f"▶️ プレビュー ({res['lang_key']})")
-    render_preview_player(res["tracks"], res["lang_key"])
+    if res.get("library_id"):
+        st.caption(f"📚 ライブラリに保存済み（{time.strftime('%Y-%m-%d %H:%M', time.localtime(res['library_created']))} 作成）")
+    # 多言語一括モードでは言語を選んで、その言語の結果を表示・修正する
+    view = res
+    if res.get("multilingual"):
+        for lang_key, error in res["failed_languages"].items():
+            st.warning(f"{lang_key} は作成できませんでした: {error}")
+        view_langs = [v["lang_key"] for v in res["languages"]]
+        view = res["languages"][view_langs.index(st.radio("表示する言語", view_langs, horizontal=True))]
+    st.subheader(f"▶️ プレビュー ({view['lang_key']})")
+    render_preview_player(view["tracks"], view["lang_key"])
+    if view.get("analysis_cached"): st.caption("🗂️ 前回の解析結果を再利用しました（AI解析をスキップ）")
+    map_stats = res.get("map_stats")
+    if map_stats:
+        st.caption(f"📚 分割解析: {map_stats['pages']}ページを{map_stats['batches']}回に分けて{map_stats['items']}品目を抽出"
+                   f"（{map_stats['seconds']:.1f}秒, 前回の結果を再利用 {map_stats['cached_batches']}回）")
+        if map_stats["failed_pages"]:
+            st.warning(f"{', '.join(str(n) for n in map_stats['failed_pages'])}枚目の画像は読み取れなかったため、残りのページから作成しました。")
+    web_stats = res.get("web_stats")
+    if web_stats:
+        st.caption(f"🌐 {web_stats['pages']}ページを取り込みました（変更なし {web_stats['not_modified']}ページ）。"
+                   f"{web_stats['raw_chars']:,}文字 → 重複を除いて {web_stats['chars']:,}文字"
+                   + (f"（文字数の上限のため {web_stats['dropped_chunks']}ブロックを除外）" if web_stats["dropped_chunks"] else ""))
+        with st.expander("🌐 取り込んだページ"):
+            for url in web_stats["urls"]: st.write(url)
+            for error in web_stats["errors"]: st.warning(error)
+    image_stats = res.get("image_stats")
+    if image_stats and image_stats["pages"]:
+        st.caption(f"🖼️ 画像の最適化: {image_stats['bytes_before'] / 1024 / 1024:.1f}MB → {image_stats['bytes_after'] / 1024 / 1024:.1f}MB"
+                   f"（{image_stats['pages']}枚, {image_stats['seconds']:.2f}秒, キャッシュ {image_stats['cached']}枚"
+                   + (f", 重複 {image_stats['duplicates']}枚を除外" if image_stats["duplicates"] else "") + "）")
+        with st.expander("🖼️ 画像ごとの最適化結果"):
+            st.dataframe([{
+                "No.": i + 1, "元サイズ(KB)": round(p["before"] / 1024), "送信サイズ(KB)": round(p["after"] / 1024),
+                "処理時間(秒)": round(p["seconds"], 3), "キャッシュ": "✔" if p["cached"] else "",
+            } for i, p in enumerate(image_stats["per_page"])], use_container_width=True)
+    audio = view.get("audio")
+    if audio:
+        st.caption(f"📀 {len(audio['chapters'])}チャプターを1つの音声 ({audio['codec']}) にまとめました:"
+                   f" {audio['source_bytes'] / 1024 / 1024:.1f}MB → {audio['bytes'] / 1024 / 1024:.1f}MB"
+                   + ("（音量を揃えました）" if audio["normalized"] else "（ffmpeg がないため無劣化で結合）"))
+    cached_count = sum(1 for t in view["tracks"] if t.get("engine") == "cache")
+    if cached_count: st.caption(f"🗂️ {len(view['tracks'])}トラック中 {cached_count}トラックをキャッシュから再利用しました")
+    with st.expander("⏱️ トラック別の処理時間"):
+        st.dataframe([{
+            "No.": t["index"], "タイトル": t["title"], "エンジン": t["engine"] or "失敗",
+            "分割数": t["chunks"], "試行回数": t["attempts"], "ヘッジ": "✔" if t["hedged"] else "", "待ち時間(秒)": round(t["queue_wait"], 2), "合成時間(秒)": round(t["synth_time"], 2),
+        } for t in view["track_stats"]], use_container_width=True)
+    if show_timings and res.get("timings"):
+        with st.expander("⏱️ 段階別の処理時間", expanded=True):
+            st.caption("並列に動いた段階（音声のトラックなど）は合計が実際の経過時間より長くなります。")
+            st.dataframe([{
+                "段階": t["name"], "回数": t["count"], "合計(秒)": round(t["total"], 2), "最大(秒)": round(t["max"], 2), "失敗": t["errors"],
+            } for t in res["timings"]], use_container_width=True)
+            if res.get("counters"):
+                st.dataframe([{
+                    "項目": c["name"], "内訳": ", ".join(f"{k}={v}" for k, v in c.items() if k not in ("name", "value")), "回数": c["value"],
+                } for c in res["counters"]], use_container_width=True)
+    with st.expander("✏️ 台本を修正して再生成（変更したトラックだけ作り直します）"):
+        edited = st.data_editor(pd.DataFrame(view["menu_data"], columns=["title", "text"]), num_rows="dynamic",
+                                use_container_width=True, key=f"menu_editor_{view['lang_key']}")
+        if st.button("🔁 変更を反映して再生成", use_container_width=True, disabled=bool(st.session_state.job_id)):
+            edited_categories = [{"title": str(r["title"]).strip(), "text": str(r["text"]).strip()}
+                                 for r in edited.fillna("").to_dict("records") if str(r["title"]).strip() and str(r["text"]).strip()]
+            if not edited_categories:
+                st.warning("カテゴリーが空です")
+            else:
+                submit_edit_job(res, view["lang_key"], edited_categories)
     st.divider()
     st.subheader("📥 保存")
-    c1, c2 = st.columns(2)
-    with c1: st.download_button(f"🌐 Webプレイヤー ({res['html_name']})", res['html_content'], res['html_name'], "text/html", type="primary")
-    with c2: st.download_button(f"📦 ZIPファイル ({res['zip_name']})", data=res["zip_data"], file_name=res['zip_name'], mime="application/zip")
+    if not os.path.exists(res["zip_path"]):
+        st.warning("保存期限が過ぎたため、ファイルが削除されました。もう一度作成してください。")
+    elif res.get("multilingual"):
+        st.caption(f"ZIPを展開して {res['html_name']} を開くと、言語を切り替えて聞けます（各言語のフォルダにも個別のプレイヤーがあります）。")
+        download_link(res["zip_path"], res['zip_name'], f"📦 ZIPファイル ({res['zip_name']})", "application/zip", primary=True)
+    elif res.get("player_mode") == "split":
+        st.caption("ZIPを展開し、フォルダごとWebサーバーに置いて index.html を開いてください（一度聞いたトラックはオフラインでも再生できます）。")
+        download_link(res["zip_path"], res['zip_name'], f"📦 ZIPファイル ({res['zip_name']})", "application/zip", primary=True)
+    else:
+        c1, c2 = st.columns(2)
+        with c1:
+            download_link(res["html_path"], res['html_name'], f"🌐 Webプレイヤー ({res['html_name']})", "text/html", primary=True)
+        with c2:
+            download_link(res["zip_path"], res['zip_name'], f"📦 ZIPファイル ({res['zip_name']})", "application/zip")
@@ -0,0 +1,228 @@
+import os
+import re
+import shutil
+import struct
+import subprocess
+
+# --- MP3 ファイルの結合 ---
+# MP3 はフレームの連続なので、先頭以外のファイルのタグを取り除いてそのまま繋げれば
+# 再エンコードせずに (無劣化で) 1つのファイルにできる。
+
+def _id3v2_size(data):
+    if len(data) < 10 or data[:3] != b"ID3": return 0
+    size = ((data[6] & 0x7f) << 21) | ((data[7] & 0x7f) << 14) | ((data[8] & 0x7f) << 7) | (data[9] & 0x7f)
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+def strip_id3(data, keep_v2=False):
+    if not keep_v2:
+        data = data[_id3v2_size(data):]
+    # 末尾の ID3v1 タグ (128 バイト) は途中に残ると雑音になる
+    if len(data) >= 128 and data[-128:-125] == b"TAG":
+        data = data[:-128]
+    return data
+
+def join_mp3_files(paths, dest):
+    tmp = dest + ".tmp"
+    with open(tmp, "wb") as out:
+        for i, path in enumerate(paths):
+            with open(path, "rb") as f:
+                out.write(strip_id3(f.read(), keep_v2=(i == 0)))
+    os.replace(tmp, dest)
+
+# --- チャプター付きの1ファイル音声 ---
+# 全トラックを1つの音声にまとめ、各トラックの開始・終了位置をチャプターとして持たせる。
+# MP3 はフレームのヘッダーから長さを数えられるので、ffmpeg がなくても無劣化で繋いで
+# ID3 の CHAP / CTOC タグと、シーク用の Xing ヘッダーを付けられる。
+# ffmpeg があれば、トラックごとに音量 (ラウドネス) を揃えてから1回でエンコードし直す
+# (Opus / AAC の低ビットレート・モノラルにすると大幅に小さくなる)。
+
+MP3_BITRATES = {
+    3: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],  # MPEG1 Layer III
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],     # MPEG2 / 2.5 Layer III
+}
+MP3_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+def _frame_info(header):
+    # 戻り値: (フレーム長, サンプル数, サンプリング周波数)。Layer III 以外・壊れたヘッダーは None
+    if header[0] != 0xFF or (header[1] & 0xE0) != 0xE0: return None
+    version = (header[1] >> 3) & 3
+    layer = (header[1] >> 1) & 3
+    br_idx = header[2] >> 4
+    sr_idx = (header[2] >> 2) & 3
+    if version == 1 or layer != 1 or br_idx in (0, 15) or sr_idx == 3: return None
+    rate = MP3_SAMPLE_RATES[version][sr_idx]
+    padding = (header[2] >> 1) & 1
+    if version == 3:
+        return 144000 * MP3_BITRATES[3][br_idx] // rate + padding, 1152, rate
+    return 72000 * MP3_BITRATES[2][br_idx] // rate + padding, 576, rate
+
+def _side_info_size(header):
+    mono = (header[3] >> 6) == 3
+    if (header[1] >> 3) & 3 == 3: return 17 if mono else 32
+    return 9 if mono else 17
+
+def mp3_frames(data):
+    # [(開始位置, 長さ, 秒数)]。タグと Xing / Info / VBRI のフレームは除く
+    frames = []
+    pos = _id3v2_size(data)
+    end = len(data) - (128 if len(data) >= 128 and data[-128:-125] == b"TAG" else 0)
+    while pos + 4 <= end:
+        info = _frame_info(data[pos:pos + 4])
+        if info is None:
+            pos += 1
+            continue
+        length, samples, rate = info
+        if pos + length > end: break
+        head = data[pos + 4:pos + 40]
+        if not (b"Xing" in head or b"Info" in head or b"VBRI" in head):
+            frames.append((pos, length, samples / rate))
+        pos += length
+    return frames
+
+def _gapless_trim(data):
+    # LAME の Info タグにあるエンコーダーの遅延と末尾の詰め物 (秒)。デコーダーはこの分を再生しない
+    pos = _id3v2_size(data)
+    info = _frame_info(data[pos:pos + 4]) if len(data) >= pos + 4 else None
+    if info is None: return 0.0
+    frame = data[pos:pos + info[0]]
+    tag = max(frame.find(b"Xing"), frame.find(b"Info"))
+    if tag < 0: return 0.0
+    flags = struct.unpack(">I", frame[tag + 4:tag + 8])[0]
+    lame = tag + 8 + 4 * bool(flags & 1) + 4 * bool(flags & 2) + 100 * bool(flags & 4) + 4 * bool(flags & 8)
+    # エンコーダー名 ("LAME" / ffmpeg なら "Lavc") の後ろ 21 バイト目から遅延 12bit + 詰め物 12bit
+    if len(frame) < lame + 24 or not frame[lame:lame + 4].isalpha(): return 0.0
+    b = frame[lame + 21:lame + 24]
+    delay, padding = (b[0] << 4) | (b[1] >> 4), ((b[1] & 0x0F) << 8) | b[2]
+    return (delay + padding) / info[2]
+
+def mp3_duration(path, gapless=False):
+    # gapless: デコーダーが切り落とす分を引いた長さ (ffmpeg でデコードし直すとき)
+    with open(path, "rb") as f:
+        data = f.read()
+    duration = sum(sec for _, _, sec in mp3_frames(data))
+    return max(0.0, duration - _gapless_trim(data)) if gapless else duration
+
+def _xing_frame(header, frames, stream_bytes):
+    # 先頭に置く無音フレーム。フレーム数・バイト数・100分割の目次を持たせ、ブラウザの長さ計算とシークを正確にする
+    need = 4 + _side_info_size(header) + 4 + 4 + 4 + 4 + 100
+    h = bytearray(header[:4])
+    h[1] |= 0x01  # CRC なし
+    for br_idx in range(1, 15):
+        h[2] = (br_idx << 4) | (header[2] & 0x0C)
+        length = _frame_info(bytes(h))[0]
+        if length >= need: break
+    total = length + stream_bytes
+    duration = sum(sec for _, _, sec in frames)
+    toc = bytearray(100)
+    t = 0.0
+    offset = length
+    n = 0
+    for i in range(100):
+        target = duration * i / 100
+        while n < len(frames) and t + frames[n][2] <= target:
+            t += frames[n][2]
+            offset += frames[n][1]
+            n += 1
+        toc[i] = min(255, offset * 256 // total)
+    body = b"Xing" + struct.pack(">III", 0x07, len(frames), total) + bytes(toc)
+    frame = bytearray(length)
+    frame[:4] = h
+    pos = 4 + _side_info_size(header)
+    frame[pos:pos + len(body)] = body
+    return bytes(frame)
+
+def _id3_frame(frame_id, body):
+    return frame_id.encode("ascii") + struct.pack(">IH", len(body), 0) + body
+
+def _id3_text(frame_id, text):
+    # ID3v2.3 の UTF-16 (BOM 付き)
+    return _id3_frame(frame_id, b"\x01" + text.encode("utf-16") + b"\x00\x00")
+
+def chapter_tag(title, chapters):
+    # ID3v2.3 のタグ: TIT2 + 目次 (CTOC) + チャプター (CHAP)。chapters: [{"title", "start", "end"}] (秒)
+    ids = [f"chp{n}".encode("ascii") for n in range(len(chapters))]
+    frames = [_id3_text("TIT2", title)]
+    frames.append(_id3_frame("CTOC", b"toc\x00" + bytes([0x03, len(ids)]) + b"".join(i + b"\x00" for i in ids)))
+    for cid, c in zip(ids, chapters):
+        times = struct.pack(">IIII", round(c["start"] * 1000), round(c["end"] * 1000), 0xFFFFFFFF, 0xFFFFFFFF)
+        frames.append(_id3_frame("CHAP", cid + b"\x00" + times + _id3_text("TIT2", c["title"])))
+    payload = b"".join(frames)
+    size = len(payload)
+    syncsafe = bytes([(size >> 21) & 0x7F, (size >> 14) & 0x7F, (size >> 7) & 0x7F, size & 0x7F])
+    return b"ID3\x03\x00\x00" + syncsafe + payload
+
+def chapters_for(paths, titles, gapless=False):
+    chapters = []
+    t = 0.0
+    for path, title in zip(paths, titles):
+        d = mp3_duration(path, gapless)
+        chapters.append({"title": title, "start": round(t, 3), "end": round(t + d, 3)})
+        t += d
+    return chapters
+
+def join_mp3_chaptered(paths, titles, dest, album):
+    # 再エンコードせずに繋ぐ。戻り値: チャプターのリスト
+    frames = []
+    chunks = []
+    for path in paths:
+        with open(path, "rb") as f:
+            data = f.read()
+        found = mp3_frames(data)
+        frames.extend(found)
+        chunks.extend(data[pos:pos + length] for pos, length, _ in found)
+    if not frames: raise ValueError("MP3 のフレームが見つかりません")
+    chapters = chapters_for(paths, titles)
+    stream = b"".join(chunks)
+    tmp = dest + ".tmp"
+    with open(tmp, "wb") as out:
+        out.write(chapter_tag(album, chapters))
+        out.write(_xing_frame(stream[:4], frames, len(stream)))
+        out.write(stream)
+    os.replace(tmp, dest)
+    return chapters
+
+# ffmpeg で書き出すときの形式。mp3 はチャプターのタグを自前で付ける (ffmpeg には ID3 を書かせない)
+AUDIO_CODECS = {
+    "mp3": {"ext": ".mp3", "mime": "audio/mpeg", "args": ["-c:a", "libmp3lame", "-id3v2_version", "0"]},
+    "opus": {"ext": ".opus", "mime": "audio/ogg", "args": ["-c:a", "libopus", "-application", "voip"]},
+    "aac": {"ext": ".m4a", "mime": "audio/mp4", "args": ["-c:a", "aac", "-movflags", "+faststart"]},
+}
+
+def find_ffmpeg(command="ffmpeg"):
+    return shutil.which(command)
+
+def _ffmetadata(title, chapters):
+    escape = lambda s: re.sub(r"([=;#\\\n])", r"\\\1", s)
+    lines = [";FFMETADATA1", f"title={escape(title)}"]
+    for c in chapters:
+        lines += ["[CHAPTER]", "TIMEBASE=1/1000", f"START={round(c['start'] * 1000)}", f"END={round(c['end'] * 1000)}", f"title={escape(c['title'])}"]
+    return "\n".join(lines) + "\n"
+
+def encode_chaptered(paths, titles, dest, album, codec, bitrate, ffmpeg, loudness=-16.0, sample_rate=24000):
+    # トラックごとに loudnorm で音量を揃え、つないでモノラル・指定ビットレートで1回だけエンコードする
+    chapters = chapters_for(paths, titles, gapless=True)
+    meta_path = dest + ".ffmeta"
+    with open(meta_path, "w", encoding="utf-8") as f:
+        f.write(_ffmetadata(album, chapters))
+    filters = [f"[{i}:a]aformat=channel_layouts=mono,loudnorm=I={loudness}:TP=-1.5:LRA=11,aresample={sample_rate}[a{i}]" for i in range(len(paths))]
+    filters.append("".join(f"[a{i}]" for i in range(len(paths))) + f"concat=n={len(paths)}:v=0:a=1[out]")
+    cmd = [ffmpeg, "-hide_banner", "-loglevel", "error", "-y"]
+    for path in paths: cmd += ["-i", path]
+    cmd += ["-f", "ffmetadata", "-i", meta_path, "-filter_complex", ";".join(filters), "-map", "[out]",
+            "-map_metadata", str(len(paths)), "-map_chapters", str(len(paths)) if codec != "mp3" else "-1",
+            "-ac", "1", "-ar", str(sample_rate), "-b:a", bitrate] + AUDIO_CODECS[codec]["args"]
+    tmp = dest + ".tmp" + AUDIO_CODECS[codec]["ext"]
+    try:
+        proc = subprocess.run(cmd + [tmp], capture_output=True, text=True)
+        if proc.returncode != 0: raise RuntimeError(f"ffmpeg: {proc.stderr.strip()[-500:]}")
+        if codec == "mp3":
+            with open(tmp, "rb") as f:
+                data = strip_id3(f.read())
+            with open(tmp, "wb") as f:
+                f.write(chapter_tag(album, chapters) + data)
+        os.replace(tmp, dest)
+    finally:
+        for p in (meta_path, tmp):
+            if os.path.exists(p): os.remove(p)
+    return chapters
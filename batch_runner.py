@@ -0,0 +1,248 @@
+import os
+import sys
+import json
+import glob
+import time
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from disk_cache import make_cache_key
+from menu_caches import CACHE_ROOT, open_caches
+from tts_scheduler import AdaptiveLimiter
+from reading_dict import DictionaryStore
+from menu_library import result_complete
+from telemetry import Telemetry
+from menu_pipeline import (
+    LANG_SETTINGS, TTS_MAX_CONCURRENCY, new_tts_breakers, generate_menu, generate_menu_multilingual,
+)
+
+# --- 一括生成 (画面なし) ---
+# 店舗の一覧 (manifest) を読み、店舗ごとに別プロセスで menu_pipeline を実行する。
+# 店舗ごとの出力フォルダに checkpoint.json を書くので、途中で止めても完了済みの店舗は飛ばして再開できる。
+# 一部のトラック・言語が作れなかった店舗は "partial" として記録し、次の実行で作り直す。
+# 最後に全店舗の所要時間と失敗をまとめた summary.json を書く。
+#
+# manifest の例:
+# {
+#   "defaults": {"languages": ["Japanese"], "voice": "female", "player_mode": "single", "model_name": "models/gemini-1.5-flash"},
+#   "stores": [
+#     {"id": "tanaka", "store_name": "カフェタナカ", "menu_title": "ランチ", "map_url": "https://maps.app.goo.gl/...",
+#      "images": ["photos/tanaka/*.jpg"]},
+#     {"id": "sato", "store_name": "さとう食堂", "url": "https://example.com/menu", "languages": ["Japanese", "English (UK)"]}
+#   ]
+# }
+# 画像のパスは manifest からの相対パスで、ワイルドカードが使える。
+
+CHECKPOINT_FILE = "checkpoint.json"
+SUMMARY_FILE = "summary.json"
+IMAGE_TYPES = {".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".png": "image/png", ".webp": "image/webp"}
+
+def open_resources(cache_root, tts_concurrency):
+    # 画面 (app.py) と同じ場所・同じ設定のキャッシュを使う (menu_caches)
+    return {**open_caches(cache_root), "limiter": AdaptiveLimiter(tts_concurrency), "breakers": new_tts_breakers()}
+
+_telemetry = None
+
+def process_telemetry(out_dir):
+    # スパンのログは子プロセスごとに別のファイルへ書く (ローテーションを複数プロセスで共有しない)
+    global _telemetry
+    if _telemetry is None:
+        _telemetry = Telemetry(os.path.join(out_dir, "telemetry", f"spans-{os.getpid()}.jsonl"))
+    return _telemetry
+
+def load_manifest(path):
+    with open(path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(path))
+    defaults = manifest.get("defaults", {})
+    stores = []
+    ids = set()
+    for n, raw in enumerate(manifest["stores"]):
+        store = {**defaults, **raw}
+        store.setdefault("id", f"store{n + 1:03}")
+        if store["id"] in ids or os.path.basename(store["id"]) != store["id"]:
+            raise ValueError(f"店舗IDが重複しているか、使えない文字を含みます: {store['id']}")
+        ids.add(store["id"])
+        if not store.get("store_name"): raise ValueError(f"{store['id']}: store_name がありません")
+        patterns = store.get("images") or []
+        store["image_paths"] = sorted(p for pattern in patterns for p in glob.glob(os.path.join(base_dir, pattern)))
+        if not store["image_paths"] and not store.get("url"):
+            raise ValueError(f"{store['id']}: 画像または url が必要です")
+        languages = store.get("languages") or ["Japanese"]
+        for lang_key in languages:
+            if lang_key not in LANG_SETTINGS: raise ValueError(f"{store['id']}: 未対応の言語です: {lang_key}")
+        store["languages"] = languages
+        stores.append(store)
+    return stores
+
+def _voice_code(lang_key, voice):
+    # voice: "female" / "male" / 声のID。省略時は先頭の声
+    ids = LANG_SETTINGS[lang_key]["voice_ids"]
+    if voice in ids: return voice
+    return ids[1] if voice == "male" else ids[0]
+
+def store_digest(store):
+    # 入力 (設定と画像の中身の更新時刻) が変わったら、完了済みでも作り直す
+    images = [(p, os.path.getmtime(p)) for p in store["image_paths"]]
+    fields = {k: v for k, v in store.items() if k != "image_paths"}
+    return make_cache_key(fields, images)
+
+def read_checkpoint(store_dir):
+    try:
+        with open(os.path.join(store_dir, CHECKPOINT_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def write_checkpoint(store_dir, data):
+    fd, tmp = tempfile.mkstemp(dir=store_dir, suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, os.path.join(store_dir, CHECKPOINT_FILE))
+
+def _summarize(store, result):
+    if result.get("multilingual"):
+        langs = result["languages"]
+    else:
+        langs = [result]
+    tracks = [t for r in langs for t in r["tracks"]]
+    return {
+        "zip_path": result["zip_path"], "html_path": result["html_path"],
+        "languages": [r["lang_key"] for r in langs], "failed_languages": result.get("failed_languages", {}),
+        "tracks": len(tracks), "failed_tracks": sum(1 for t in tracks if not t.get("engine")),
+        "timings": result["timings"], "counters": result["counters"],
+    }
+
+def run_store(store, out_dir, api_key, cache_root, tts_concurrency, user_dict, hedge_after=None):
+    # 別プロセスで呼ばれる。例外は外に出さず、結果を dict で返す
+    store_dir = os.path.join(out_dir, store["id"])
+    os.makedirs(store_dir, exist_ok=True)
+    digest = store_digest(store)
+    started = time.time()
+    stage_times = {}
+    current = {"stage": None, "since": time.perf_counter()}
+
+    def report(stage, progress, message=None):
+        if stage == current["stage"]: return
+        now = time.perf_counter()
+        if current["stage"]: stage_times[current["stage"]] = stage_times.get(current["stage"], 0.0) + now - current["since"]
+        current.update(stage=stage, since=now)
+        print(f"[{store['id']}] {message or stage}", flush=True)
+
+    write_checkpoint(store_dir, {"id": store["id"], "state": "running", "digest": digest, "started": started})
+    try:
+        images = []
+        for path in store["image_paths"]:
+            with open(path, "rb") as f:
+                images.append({"mime_type": IMAGE_TYPES.get(os.path.splitext(path)[1].lower(), "image/jpeg"), "data": f.read()})
+        languages = store["languages"]
+        params = {
+            "store_name": store["store_name"], "menu_title": store.get("menu_title", ""), "map_url": store.get("map_url", ""),
+            "api_key": api_key, "model_name": store["model_name"],
+            "images": images, "target_url": None if images else store.get("url"),
+            "user_dict": user_dict, "use_streaming": store.get("use_streaming", True),
+            "force_reanalyze": store.get("force_reanalyze", False), "hedge_after": hedge_after,
+            "player_mode": store.get("player_mode", "single"), "map_reduce": store.get("map_reduce", True),
+            "audio_layout": store.get("audio_layout", "tracks"), "audio_codec": store.get("audio_codec", "mp3"),
+        }
+        resources = open_resources(cache_root, tts_concurrency)
+        resources["telemetry"] = process_telemetry(out_dir)
+        if len(languages) == 1:
+            lang_key = languages[0]
+            params.update(lang_key=lang_key, voice_code=_voice_code(lang_key, store.get("voice")),
+                          rate_value=LANG_SETTINGS[lang_key]["rate_value"])
+            result = generate_menu(params, store_dir, report=report, **resources)
+        else:
+            params.update(languages=languages, voice_codes={k: _voice_code(k, store.get("voice")) for k in languages})
+            result = generate_menu_multilingual(params, store_dir, report=report, **resources)
+        complete = result_complete(result)
+        report("done", 1.0, "完了" if complete else "完了 (一部の音声・言語が作れませんでした)")
+        entry = {"id": store["id"], "state": "done" if complete else "partial", **_summarize(store, result)}
+    except Exception as e:
+        report("failed", 0.0, f"失敗: {e}")
+        entry = {"id": store["id"], "state": "failed", "error": f"{e.__class__.__name__}: {e}"}
+    entry.update(digest=digest, started=started, seconds=round(time.time() - started, 2),
+                 stages={k: round(v, 2) for k, v in stage_times.items()})
+    write_checkpoint(store_dir, entry)
+    return entry
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="店舗の一覧から音声メニューをまとめて作成します")
+    parser.add_argument("manifest", help="店舗一覧の JSON")
+    parser.add_argument("-o", "--out", default="batch_output", help="出力フォルダ (店舗ごとのサブフォルダと summary.json)")
+    parser.add_argument("-w", "--workers", type=int, default=2, help="同時に処理する店舗数 (プロセス数)")
+    parser.add_argument("--tts-concurrency", type=int, default=TTS_MAX_CONCURRENCY, help="1店舗あたりの音声生成の同時実行数")
+    parser.add_argument("--api-key", default=os.environ.get("GEMINI_API_KEY"), help="Gemini APIキー (既定は環境変数 GEMINI_API_KEY)")
+    parser.add_argument("--model", help="manifest に model_name がない店舗で使うモデル")
+    parser.add_argument("--cache-dir", default=CACHE_ROOT)
+    parser.add_argument("--dictionary", default="my_dictionary.json", help="読み方辞書 (日本語)")
+    parser.add_argument("--hedge-after", type=float, help="音声生成がこの秒数を超えたら gTTS も並行実行する")
+    parser.add_argument("--force", action="store_true", help="完了済みの店舗も作り直す")
+    parser.add_argument("--only", nargs="*", help="この店舗IDだけを処理する")
+    args = parser.parse_args(argv)
+
+    if not args.api_key:
+        parser.error("Gemini APIキーを --api-key か環境変数 GEMINI_API_KEY で指定してください")
+    stores = load_manifest(args.manifest)
+    if args.only: stores = [s for s in stores if s["id"] in set(args.only)]
+    for store in stores:
+        store.setdefault("model_name", args.model)
+        if not store["model_name"]: parser.error(f"{store['id']}: model_name を manifest か --model で指定してください")
+    args.out = os.path.abspath(args.out)
+    os.makedirs(args.out, exist_ok=True)
+    user_dict = DictionaryStore(args.dictionary).entries()
+
+    started = time.time()
+    entries = {}
+    todo = []
+    for store in stores:
+        checkpoint = read_checkpoint(os.path.join(args.out, store["id"]))
+        if (not args.force and checkpoint and checkpoint.get("state") == "done"
+                and checkpoint.get("digest") == store_digest(store) and os.path.exists(checkpoint.get("zip_path", ""))):
+            entries[store["id"]] = {**checkpoint, "skipped": True}
+            print(f"[{store['id']}] 完了済みのため飛ばします", flush=True)
+        else:
+            todo.append(store)
+
+    with ProcessPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        futures = {pool.submit(run_store, store, args.out, args.api_key, args.cache_dir, args.tts_concurrency,
+                               user_dict, args.hedge_after): store for store in todo}
+        for fut in as_completed(futures):
+            store = futures[fut]
+            try:
+                entries[store["id"]] = fut.result()
+            except Exception as e:
+                # ワーカープロセス自体が落ちた場合
+                entries[store["id"]] = {"id": store["id"], "state": "failed", "error": f"{e.__class__.__name__}: {e}"}
+
+    ordered = [entries[s["id"]] for s in stores]
+    done = [e for e in ordered if e["state"] == "done"]
+    partial = [e for e in ordered if e["state"] == "partial"]
+    seconds = [e["seconds"] for e in ordered if not e.get("skipped") and "seconds" in e]
+    summary = {
+        "manifest": os.path.abspath(args.manifest),
+        "wall_seconds": round(time.time() - started, 2),
+        "stores": len(ordered),
+        "done": len(done),
+        "skipped": sum(1 for e in ordered if e.get("skipped")),
+        "partial": len(partial),
+        "failed": len(ordered) - len(done) - len(partial),
+        "store_seconds_total": round(sum(seconds), 2),
+        "store_seconds_max": max(seconds, default=0.0),
+        "failed_tracks": sum(e.get("failed_tracks", 0) for e in done + partial),
+        "results": ordered,
+    }
+    with open(os.path.join(args.out, SUMMARY_FILE), "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+
+    print(f"完了 {summary['done']} / {summary['stores']} 店舗 (飛ばした {summary['skipped']}, 一部欠け {summary['partial']}, "
+          f"失敗 {summary['failed']}), {summary['wall_seconds']}秒")
+    for e in ordered:
+        if e["state"] == "partial":
+            print(f"  △ {e['id']}: 音声 {e['failed_tracks']} / {e['tracks']} トラック失敗, 言語の失敗 {list(e['failed_languages']) or 'なし'}")
+        elif e["state"] != "done":
+            print(f"  ✗ {e['id']}: {e.get('error')}")
+    return 0 if summary["done"] == summary["stores"] else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,420 @@
+import io
+import os
+import sys
+import json
+import time
+import types
+import random
+import asyncio
+import argparse
+import tempfile
+import threading
+import statistics
+import subprocess
+import tracemalloc
+
+# --- オフライン・ベンチマーク ---
+# Gemini / edge-tts / gTTS を手元の偽物に差し替え、生成処理の速さを外部サービスなしで測る。
+# 偽物には待ち時間・ゆらぎ・失敗率・流量制限 (1秒あたりの呼び出し数) を設定でき、乱数は seed で固定する。
+# 架空のメニュー (5〜40カテゴリー・画像セット・HTML ページ) を使って
+#   音声生成 (process_all_tracks_fast) / プレイヤー作成 / 生成全体 (解析 → 音声 → HTML → ZIP) / 画像の前処理 / HTML の取り込み
+# を実行し、処理量・p50/p95・ピークメモリ (RSS) を JSON で書き出す。--baseline で前回の結果と比べられる。
+# 起動の速さ (新しいプロセスでモジュールを読み込む時間とメモリ) は偽物を入れずに、入っている本物の SDK で測る。
+#
+# 例: python benchmark.py --sizes 5 10 20 40 --latency 0.3 --jitter 0.1 --error-rate 0.05 --rps 30 -o bench.json
+
+class FakeThrottled(Exception):
+    pass
+
+class FakeService:
+    # 呼び出しごとの待ち時間・失敗・流量制限をまとめて決める (スレッドセーフ)
+    def __init__(self, name, latency, jitter, error_rate, rps, seed):
+        self.name = name
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rps = rps
+        self.calls = 0
+        self.errors = 0
+        self.throttled = 0
+        self._rng = random.Random(f"{seed}:{name}")
+        self._window = []
+        self._lock = threading.Lock()
+
+    def plan(self):
+        # 戻り値: (待ち時間, 発生させる例外の種類 or None)
+        now = time.monotonic()
+        with self._lock:
+            self.calls += 1
+            delay = max(0.0, self.latency + self._rng.uniform(-self.jitter, self.jitter))
+            if self.rps:
+                self._window = [t for t in self._window if now - t < 1.0]
+                if len(self._window) >= self.rps:
+                    self.throttled += 1
+                    return delay / 4, "throttled"
+                self._window.append(now)
+            if self._rng.random() < self.error_rate:
+                self.errors += 1
+                return delay, "error"
+            return delay, None
+
+    def snapshot(self):
+        with self._lock:
+            return {"calls": self.calls, "errors": self.errors, "throttled": self.throttled}
+
+SERVICES = {}
+
+# MPEG2 Layer III・24kHz・48kbps・モノラルの無音フレーム (144 バイト = 24ms)。edge-tts の出力と同じ形式
+SILENT_FRAME = b"\xff\xf3\x64\xc0" + bytes(140)
+
+def fake_audio(text):
+    # 文字数に比例した長さの無音の MP3 (1文字 0.12 秒)。チャプター付きの結合もそのまま通る
+    return SILENT_FRAME * (len(text) * 5)
+
+class FakeCommunicate:
+    def __init__(self, text, voice, rate=None):
+        self.text = text
+
+    async def save(self, path):
+        delay, failure = SERVICES["edge"].plan()
+        await asyncio.sleep(delay)
+        if failure: raise FakeThrottled(f"edge-tts: {failure}")
+        with open(path, "wb") as f:
+            f.write(fake_audio(self.text))
+
+class FakeGTTS:
+    def __init__(self, text, lang):
+        self.text = text
+
+    def write_to_fp(self, fp):
+        delay, failure = SERVICES["gtts"].plan()
+        time.sleep(delay)
+        if failure: raise FakeThrottled(f"gTTS: {failure}")
+        fp.write(fake_audio(self.text))
+
+class _Chunk:
+    def __init__(self, text):
+        self.text = text
+
+class FakeGenerativeModel:
+    # 抽出用のプロンプトには品目の一覧を、それ以外には FIXTURE["categories"] を返す
+    fixture = {"categories": [], "chunk_chars": 200}
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+        self._client = None
+
+    def _answer(self, parts):
+        from menu_pipeline import EXTRACT_PROMPT
+        if parts and parts[0] == EXTRACT_PROMPT:
+            items = [{"section": "page", "name": f"item{i}-{len(p['data'])}", "price": f"{500 + i * 10}円"} for i, p in enumerate(parts[1:])]
+            return json.dumps(items, ensure_ascii=False)
+        return json.dumps(self.fixture["categories"], ensure_ascii=False)
+
+    def _call(self):
+        from google.api_core import exceptions
+        delay, failure = SERVICES["gemini"].plan()
+        time.sleep(delay)
+        if failure == "throttled": raise exceptions.ResourceExhausted("fake quota")
+        if failure: raise FakeThrottled("gemini: error")
+
+    def generate_content(self, parts, stream=False):
+        self._call()
+        text = self._answer(parts)
+        if not stream: return _Chunk(text)
+        size = self.fixture["chunk_chars"]
+        def chunks():
+            for i in range(0, len(text), size):
+                time.sleep(SERVICES["gemini"].latency / 20)
+                yield _Chunk(text[i:i + size])
+        return chunks()
+
+class FakeClientManager:
+    def configure(self, **kwargs):
+        self.config = kwargs
+
+    def get_default_client(self, name):
+        return name
+
+def install_fakes():
+    # menu_pipeline を読み込む前に呼ぶ。google.api_core は本物があればその例外を使う
+    sys.modules["edge_tts"] = types.SimpleNamespace(Communicate=FakeCommunicate)
+    sys.modules["gtts"] = types.SimpleNamespace(gTTS=FakeGTTS)
+    fake_genai = types.ModuleType("google.generativeai")
+    fake_genai.configure = lambda **kwargs: None
+    fake_genai.GenerativeModel = FakeGenerativeModel
+    fake_genai.list_models = lambda client=None: []
+    fake_client = types.ModuleType("google.generativeai.client")
+    fake_client._ClientManager = FakeClientManager
+    sys.modules["google.generativeai.client"] = fake_client
+    try:
+        import google.api_core.exceptions  # noqa: F401
+    except ImportError:
+        google = sys.modules.setdefault("google", types.ModuleType("google"))
+        google.__path__ = getattr(google, "__path__", [])
+        api_core = types.ModuleType("google.api_core")
+        exceptions = types.ModuleType("google.api_core.exceptions")
+        exceptions.ResourceExhausted = type("ResourceExhausted", (Exception,), {})
+        api_core.exceptions = exceptions
+        sys.modules["google.api_core"] = api_core
+        sys.modules["google.api_core.exceptions"] = exceptions
+    sys.modules["google.generativeai"] = fake_genai
+    sys.modules["google"].generativeai = fake_genai
+
+# --- 架空のメニュー ---
+DISHES = ["唐揚げ定食", "焼き魚定食", "親子丼", "天ぷらそば", "カレーライス", "生姜焼き", "刺身盛り合わせ", "冷やしうどん", "抹茶パフェ", "生ビール"]
+
+def fixture_categories(n, seed=0):
+    rng = random.Random(f"menu:{n}:{seed}")
+    categories = []
+    for c in range(n):
+        items = rng.sample(DISHES, 4)
+        text = "".join(f"{d}は{rng.randrange(5, 20) * 100}円です。アレルギーは小麦、卵を含みます。" for d in items)
+        categories.append({"title": f"カテゴリー{c + 1}", "text": text})
+    return categories
+
+def fixture_images(pages, seed=0, size=(2000, 2600)):
+    from PIL import Image, ImageDraw
+    rng = random.Random(f"images:{seed}")
+    images = []
+    for p in range(pages):
+        img = Image.new("RGB", size, (245, 240, 228))
+        draw = ImageDraw.Draw(img)
+        for _ in range(80):
+            x, y = rng.randrange(100, size[0] - 400), rng.randrange(100, size[1] - 80)
+            shade = rng.randrange(0, 100)
+            draw.rectangle([x, y, x + rng.randrange(80, 380), y + rng.randrange(12, 40)], fill=(shade, shade, shade))
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=92)
+        images.append({"mime_type": "image/jpeg", "data": buf.getvalue()})
+    return images
+
+def fixture_html(pages, categories):
+    boiler = "<footer>住所: 東京都千代田区1-2-3 ビル5階 営業時間 11:00〜22:00</footer><p>ご予約はお電話で承ります（03-0000-0000）</p>"
+    result = []
+    per_page = max(1, len(categories) // pages)
+    for p in range(pages):
+        body = "".join(f"<h2>{c['title']}</h2><p>{c['text']}</p>" for c in categories[p * per_page:(p + 1) * per_page])
+        result.append(f"<html><head><meta charset='utf-8'><script>var x=1;</script></head><body><nav>menu</nav>{body}{boiler}</body></html>".encode("utf-8"))
+    return result
+
+# --- 計測 ---
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux は KB、macOS はバイト
+    return round(rss / 1024 / (1024 if sys.platform == "darwin" else 1), 1)
+
+def percentile(values, p):
+    if not values: return None
+    values = sorted(values)
+    k = (len(values) - 1) * p
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+def summarize(latencies, seconds, units, unit_name):
+    return {
+        "seconds": round(seconds, 4),
+        unit_name: units,
+        "throughput_per_s": round(units / seconds, 3) if seconds else None,
+        "p50_s": round(percentile(latencies, 0.5), 4) if latencies else None,
+        "p95_s": round(percentile(latencies, 0.95), 4) if latencies else None,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def bench_tts(mp, n, work_dir, concurrency):
+    categories = fixture_categories(n)
+    menu_data = [mp.build_toc_track(categories, "ベンチ食堂", "", "Japanese")] + categories
+    out = tempfile.mkdtemp(dir=work_dir)
+    progress = types.SimpleNamespace(progress=lambda v: None)
+    limiter = mp.AdaptiveLimiter(concurrency)
+    t0 = time.perf_counter()
+    tracks, stats = asyncio.run(mp.process_all_tracks_fast(
+        menu_data, out, "ja-JP-NanamiNeural", "+10%", progress, "Japanese", None, limiter, mp.new_tts_breakers()))
+    seconds = time.perf_counter() - t0
+    latencies = [s["queue_wait"] + s["synth_time"] for s in stats]
+    result = summarize(latencies, seconds, len(tracks), "tracks")
+    result["failed_tracks"] = sum(1 for t in tracks if not t.get("engine"))
+    result["engines"] = {e: sum(1 for s in stats if s["engine"] == e) for e in {s["engine"] for s in stats}}
+    return result, tracks
+
+def bench_player(mp, tracks, repeat, work_dir):
+    # 生成処理と同じく、ファイルに書き出すまでを測る
+    path = os.path.join(work_dir, "bench_player.html")
+    render = lambda: mp.write_standalone_html_player(path, "ベンチ食堂", tracks, "https://maps.example/x", "Japanese")
+    latencies = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        render()
+        latencies.append(time.perf_counter() - t0)
+    # 1回分の Python のメモリ確保のピーク (RSS は他のシナリオの分も含むため別に測る)
+    tracemalloc.start()
+    try:
+        render()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    result = summarize(latencies, sum(latencies), repeat, "renders")
+    result.update(html_bytes=os.path.getsize(path), peak_alloc_mb=round(peak / 1024 / 1024, 1))
+    return result
+
+IMPORT_PROBE = """
+import sys, json, time, resource
+t0 = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - t0
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({{"seconds": seconds, "rss_mb": rss / 1024 / (1024 if sys.platform == "darwin" else 1), "modules": len(sys.modules)}}))
+"""
+IMPORT_MODULES = ("menu_pipeline", "batch_runner")
+
+def bench_import(module, repeat):
+    # 毎回新しいプロセスで読み込む (読み込み済みのモジュールが残らないように)
+    runs = []
+    for _ in range(repeat):
+        proc = subprocess.run([sys.executable, "-c", IMPORT_PROBE.format(module=module)], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)))
+        if proc.returncode != 0:
+            return {"error": proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f"exit {proc.returncode}"}
+        runs.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+    return {
+        "seconds": round(statistics.median(r["seconds"] for r in runs), 4),
+        "peak_rss_mb": round(statistics.median(r["rss_mb"] for r in runs), 1),
+        "modules": runs[-1]["modules"],
+    }
+
+def bench_pipeline(mp, n, images, work_dir, streaming, concurrency, audio_layout="tracks", audio_codec="mp3"):
+    FakeGenerativeModel.fixture["categories"] = fixture_categories(n)
+    job_dir = tempfile.mkdtemp(dir=work_dir)
+    params = {
+        "store_name": "ベンチ食堂", "menu_title": "", "map_url": "", "lang_key": "Japanese",
+        "voice_code": "ja-JP-NanamiNeural", "rate_value": "+10%", "api_key": "offline", "model_name": "fake",
+        "images": images, "target_url": None, "use_streaming": streaming, "force_reanalyze": True,
+        "player_mode": "single", "map_reduce": True, "audio_layout": audio_layout, "audio_codec": audio_codec,
+    }
+    t0 = time.perf_counter()
+    res = mp.generate_menu(params, job_dir, limiter=mp.AdaptiveLimiter(concurrency), breakers=mp.new_tts_breakers())
+    seconds = time.perf_counter() - t0
+    # 段階ごとの合計時間 (並列に動いた分は重なる)
+    stages = {t["name"]: {"count": t["count"], "total_s": round(t["total"], 4)} for t in res["timings"]}
+    latencies = [s["queue_wait"] + s["synth_time"] for s in res["track_stats"]]
+    result = summarize(latencies, seconds, len(res["tracks"]), "tracks")
+    result.update(stages=stages, counters=res["counters"], zip_bytes=os.path.getsize(res["zip_path"]),
+                  html_bytes=os.path.getsize(res["html_path"]),
+                  failed_tracks=sum(1 for t in res["tracks"] if not t.get("engine")))
+    return result
+
+def bench_images(images, repeat):
+    from image_prep import preprocess_images
+    latencies = []
+    before = after = 0
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        _, stats = preprocess_images(images)
+        latencies.extend(p["seconds"] for p in stats["per_page"])
+        before, after = stats["bytes_before"], stats["bytes_after"]
+    result = summarize(latencies, time.perf_counter() - t0, len(images) * repeat, "pages")
+    result.update(bytes_before=before, bytes_after=after)
+    return result
+
+def bench_html(pages_html, repeat):
+    from web_ingest import _extract, build_menu_text
+    latencies = []
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        pages = []
+        for n, content in enumerate(pages_html):
+            lines, links = _extract(content, f"https://bench.example/{n}")
+            pages.append({"url": f"https://bench.example/{n}", "lines": lines, "links": links, "status": "fetched"})
+        text, stats = build_menu_text(pages)
+        latencies.append(time.perf_counter() - start)
+    result = summarize(latencies, time.perf_counter() - t0, repeat, "runs")
+    result.update(raw_chars=stats["raw_chars"], chars=stats["chars"])
+    return result
+
+def compare(current, baseline):
+    # 主な値の変化 (比) を並べる。throughput は大きい方、それ以外は小さい方が良い
+    rows = []
+    for name, cur in current["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(name)
+        if not base: continue
+        for key in ("throughput_per_s", "p50_s", "p95_s", "seconds", "peak_rss_mb", "peak_alloc_mb"):
+            if cur.get(key) and base.get(key):
+                rows.append((name, key, base[key], cur[key], cur[key] / base[key]))
+    return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="外部サービスなしで生成処理の速さを測ります")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[5, 10, 20, 40], help="メニューのカテゴリー数")
+    parser.add_argument("--pages", type=int, default=8, help="画像セットの枚数")
+    parser.add_argument("--latency", type=float, default=0.3, help="偽サービスの平均待ち時間 (秒)")
+    parser.add_argument("--jitter", type=float, default=0.1, help="待ち時間のゆらぎ (±秒)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="失敗させる割合 (0〜1)")
+    parser.add_argument("--rps", type=int, default=0, help="1秒あたりの呼び出し上限 (超えたら流量制限のエラー。0 で無制限)")
+    parser.add_argument("--gemini-latency", type=float, default=1.0, help="Gemini の偽物の待ち時間 (秒)")
+    parser.add_argument("--concurrency", type=int, default=8, help="音声生成の同時実行数の上限")
+    parser.add_argument("--repeat", type=int, default=3, help="プレイヤー作成・画像・HTML の繰り返し回数")
+    parser.add_argument("--audio-layout", choices=["tracks", "chapters"], default="tracks", help="生成全体のシナリオの音声の形式")
+    parser.add_argument("--audio-codec", choices=["mp3", "opus", "aac"], default="mp3", help="1ファイル版の圧縮形式 (ffmpeg が必要)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--skip", nargs="*", default=[], choices=["tts", "player", "pipeline", "images", "html", "import"])
+    parser.add_argument("-o", "--out", help="結果の JSON の保存先 (省略時は標準出力)")
+    parser.add_argument("--baseline", help="比較する前回の結果の JSON")
+    args = parser.parse_args(argv)
+
+    scenarios = {}
+    # 偽物を入れる前に測る
+    if "import" not in args.skip:
+        for module in IMPORT_MODULES:
+            scenarios[f"import_{module}"] = bench_import(module, max(args.repeat, 3))
+
+    SERVICES["edge"] = FakeService("edge", args.latency, args.jitter, args.error_rate, args.rps, args.seed)
+    SERVICES["gtts"] = FakeService("gtts", args.latency * 1.5, args.jitter, args.error_rate, args.rps, args.seed)
+    SERVICES["gemini"] = FakeService("gemini", args.gemini_latency, args.jitter, args.error_rate, args.rps, args.seed)
+    install_fakes()
+    # 再試行の待ち時間 (流量制限のあとの待ちなど) も本番と同じく計測に含める
+    import menu_pipeline as mp
+
+    with tempfile.TemporaryDirectory(prefix="menu-bench-") as work_dir:
+        images = fixture_images(args.pages, args.seed) if {"pipeline", "images"} - set(args.skip) else []
+        for n in args.sizes:
+            tracks = None
+            if "tts" not in args.skip:
+                scenarios[f"tts_{n}"], tracks = bench_tts(mp, n, work_dir, args.concurrency)
+            if "player" not in args.skip and tracks:
+                scenarios[f"player_{n}"] = bench_player(mp, tracks, args.repeat, work_dir)
+            if "pipeline" not in args.skip:
+                scenarios[f"pipeline_{n}"] = bench_pipeline(mp, n, images, work_dir, True, args.concurrency, args.audio_layout, args.audio_codec)
+            if "html" not in args.skip:
+                scenarios[f"html_{n}"] = bench_html(fixture_html(3, fixture_categories(n)), args.repeat)
+        if "images" not in args.skip:
+            scenarios["images"] = bench_images(images, args.repeat)
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "config": vars(args),
+        "services": {name: s.snapshot() for name, s in SERVICES.items()},
+        "peak_rss_mb": peak_rss_mb(),
+        "scenarios": scenarios,
+    }
+    data = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f: f.write(data)
+    else:
+        print(data)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        for name, key, before, after, ratio in compare(report, baseline):
+            print(f"{name:16} {key:18} {before:>10} → {after:>10}  (x{ratio:.2f})", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,206 @@
+import os
+import time
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+
+# --- ディスクキャッシュ (内容アドレス + LRU) ---
+# キーは入力値のハッシュ。ファイルの mtime を「最終利用時刻」として使い、
+# 容量を超えたら古いものから削除する。書き込みは一時ファイル → os.replace で
+# 原子的に行うので、複数セッションが同時に読み書きしても壊れたファイルは見えない。
+# JSON エントリは作成時刻を中に持ち、ttl 秒を過ぎたものは読み出し時に捨てる。
+# 件数と合計サイズはメモリで数え続け、フォルダ全体の走査は容量を超えたときと
+# rescan_interval 秒ごと (他のプロセスが書いた分を数え直す) にだけ行う。
+# pin() したキーは期限まで削除せず、容量にも数えない (表示中のページが参照しているファイルなど)。
+
+def make_cache_key(*parts):
+    raw = json.dumps(parts, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+class DiskCache:
+    def __init__(self, root, max_bytes, suffix="", ttl=None, rescan_interval=300):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.ttl = ttl
+        self.rescan_interval = rescan_interval
+        self.hits = 0
+        self.misses = 0
+        self._files = 0
+        self._bytes = 0
+        self._scanned = 0.0
+        # owner → (期限, キー)。_held は前回の整理で数えた pin 中の容量
+        self._pins = {}
+        self._held = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+        self._rescan()
+
+    def _path(self, key):
+        # 1ディレクトリにファイルが溜まりすぎないよう先頭2文字で分ける
+        return os.path.join(self.root, key[:2], key + self.suffix)
+
+    def _account(self, files, size):
+        with self._lock:
+            self._files += files
+            self._bytes += size
+
+    def pin(self, owner, keys, ttl):
+        # owner (セッションなど) が参照しているキーを ttl 秒のあいだ残す。呼ぶたびに owner の分を置き換える
+        with self._lock:
+            if keys: self._pins[owner] = (time.time() + ttl, frozenset(keys))
+            else: self._pins.pop(owner, None)
+
+    def _pinned_paths(self):
+        now = time.time()
+        with self._lock:
+            for owner in [o for o, (until, _) in self._pins.items() if until < now]: del self._pins[owner]
+            return {self._path(k) for _, keys in self._pins.values() for k in keys}
+
+    def _count(self, hit):
+        with self._lock:
+            if hit: self.hits += 1
+            else: self.misses += 1
+
+    def has(self, key):
+        # 存在確認だけ (ヒット数には数えない)。あれば最終利用時刻を更新する
+        try:
+            os.utime(self._path(key), None)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def fetch(self, key, dest_path):
+        src = self._path(key)
+        try:
+            shutil.copyfile(src, dest_path)
+            os.utime(src, None)
+        except FileNotFoundError:
+            # 他プロセスの削除と競合した場合もミス扱い
+            self._count(False)
+            return False
+        if os.path.getsize(dest_path) == 0:
+            self._count(False)
+            return False
+        self._count(True)
+        return True
+
+    def _write_atomic(self, key, write):
+        dest = self._path(key)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dest), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as out:
+                write(out)
+            size = os.path.getsize(tmp)
+            try:
+                old_size = os.path.getsize(dest)
+            except FileNotFoundError:
+                old_size = None
+            os.replace(tmp, dest)
+        except OSError:
+            if os.path.exists(tmp): os.remove(tmp)
+            return False
+        self._account(0 if old_size is not None else 1, size - (old_size or 0))
+        self.evict()
+        return True
+
+    def store(self, key, src_path):
+        def write(out):
+            with open(src_path, "rb") as src:
+                shutil.copyfileobj(src, out)
+        return self._write_atomic(key, write)
+
+    def get_bytes(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path, None)
+        except FileNotFoundError:
+            self._count(False)
+            return None
+        self._count(True)
+        return data
+
+    def put_bytes(self, key, data):
+        return self._write_atomic(key, lambda out: out.write(data))
+
+    def get_json(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            os.utime(path, None)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self._count(False)
+            return None
+        if self.ttl is not None and time.time() - entry.get("created", 0) > self.ttl:
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+                self._account(-1, -size)
+            except FileNotFoundError:
+                pass
+            self._count(False)
+            return None
+        self._count(True)
+        return entry.get("data")
+
+    def put_json(self, key, data):
+        payload = json.dumps({"created": time.time(), "data": data}, ensure_ascii=False).encode("utf-8")
+        return self._write_atomic(key, lambda out: out.write(payload))
+
+    def _entries(self):
+        entries = []
+        for sub in os.scandir(self.root):
+            if not sub.is_dir(): continue
+            for e in os.scandir(sub.path):
+                if e.name.endswith(".tmp"): continue
+                try:
+                    info = e.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((info.st_mtime, info.st_size, e.path))
+        return entries
+
+    def _rescan(self):
+        entries = self._entries()
+        with self._lock:
+            self._files = len(entries)
+            self._bytes = sum(size for _, size, _ in entries)
+            self._scanned = time.monotonic()
+        return entries
+
+    def evict(self):
+        with self._lock:
+            due = self._bytes > self.max_bytes + self._held or time.monotonic() - self._scanned > self.rescan_interval
+        if not due: return
+        entries = self._rescan()
+        pinned = self._pinned_paths()
+        # pin されたものは消さず、容量の上限にも数えない
+        held = sum(size for _, size, path in entries if path in pinned)
+        with self._lock:
+            self._held = held
+        total = sum(size for _, size, _ in entries) - held
+        if total <= self.max_bytes: return
+        # 最終利用が古い順に削除
+        files = freed = 0
+        for _, size, path in sorted(entries):
+            if path in pinned: continue
+            try:
+                os.remove(path)
+                files += 1
+                freed += size
+            except FileNotFoundError:
+                pass
+            total -= size
+            if total <= self.max_bytes: break
+        self._account(-files, -freed)
+
+    def stats(self):
+        # メモリ上の数を返す (フォルダは走査しない)
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "files": self._files, "bytes": self._bytes}
@@ -0,0 +1,133 @@
+import time
+import hashlib
+import threading
+from lazy_import import LazyModule
+
+genai = LazyModule("google.generativeai")
+genai_client = LazyModule("google.generativeai.client")
+
+# --- Gemini クライアントの設定とモデル一覧 ---
+# genai.configure はプロセス全体の設定で、別のセッションが別のキーで呼ぶと、呼び出し中のモデルも
+# そのキーで課金されてしまう。そこで API キーごとにクライアントの設定 (_ClientManager) を持ち、
+# モデルや一覧の取得にはそのキーのクライアントを渡す。
+# _ClientManager と GenerativeModel._client は SDK の公開 API ではないので、requirements.txt で
+# 確かめた版に固定し、見つからなければ (既定のクライアントに黙って戻さず) エラーにする。
+# モデル一覧は API キーごとに ttl 秒キャッシュし、取得はバックグラウンドのスレッドで行う。
+# 画面の再実行ではキャッシュを読むだけで、通信はしない。取得に失敗したら前回の一覧を使い続ける。
+
+# 一覧をまだ一度も取れていないときに選べるモデル
+FALLBACK_MODELS = ["models/gemini-1.5-flash", "models/gemini-1.5-pro"]
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+class GeminiClientError(RuntimeError):
+    pass
+
+def _require(obj, attr):
+    if not hasattr(obj, attr):
+        raise GeminiClientError(f"google-generativeai に {attr} がありません。requirements.txt の版を入れてください"
+                                f" (入っている版: {getattr(genai, '__version__', '不明')})")
+
+def genai_service(api_key, name):
+    # name: "generative" / "model" など。キーごとに1つ作って使い回す (辞書のキーはハッシュ)
+    key = _key_digest(api_key)
+    with _managers_lock:
+        manager = _managers.get(key)
+        if manager is None:
+            _require(genai_client, "_ClientManager")
+            manager = genai_client._ClientManager()
+            _require(manager, "get_default_client")
+            manager.configure(api_key=api_key)
+            _managers[key] = manager
+        return manager.get_default_client(name)
+
+def generative_model(api_key, model_name):
+    model = genai.GenerativeModel(model_name)
+    _require(model, "_client")
+    # 最初の呼び出しで既定 (プロセス全体) のクライアントを拾わないよう、先にこのキーのものを渡しておく
+    model._client = genai_service(api_key, "generative")
+    return model
+
+def list_generate_models(api_key):
+    client = genai_service(api_key, "model")
+    return [m.name for m in genai.list_models(client=client) if 'generateContent' in m.supported_generation_methods]
+
+def _key_digest(api_key):
+    # キーそのものはメモリ上の辞書やディスクに残さない
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+class ModelCatalog:
+    def __init__(self, ttl=3600, retry_interval=60, store=None, fetch=list_generate_models):
+        self.ttl = ttl
+        # 失敗した後は、この秒数が経つまで取り直さない
+        self.retry_interval = retry_interval
+        self.store = store
+        self.fetch = fetch
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _entry_locked(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = {"models": [], "fetched_at": None, "attempted_at": None, "error": None,
+                     "refreshing": False, "done": threading.Event()}
+            entry["done"].set()
+            saved = self.store.get_json(key) if self.store else None
+            if saved:
+                entry["models"] = saved["models"]
+                entry["fetched_at"] = saved["fetched_at"]
+            self._entries[key] = entry
+        return entry
+
+    def _start_locked(self, key, api_key, entry):
+        entry["refreshing"] = True
+        entry["attempted_at"] = time.time()
+        entry["done"] = threading.Event()
+        threading.Thread(target=self._run, args=(key, api_key, entry), daemon=True, name="gemini-models").start()
+
+    def _run(self, key, api_key, entry):
+        try:
+            models = self.fetch(api_key)
+        except Exception as e:
+            with self._lock:
+                entry["error"] = str(e) or e.__class__.__name__
+        else:
+            now = time.time()
+            with self._lock:
+                entry.update(models=models, fetched_at=now, error=None)
+            if self.store: self.store.put_json(key, {"models": models, "fetched_at": now})
+        finally:
+            with self._lock:
+                entry["refreshing"] = False
+            entry["done"].set()
+
+    @staticmethod
+    def _snapshot(entry):
+        return {k: entry[k] for k in ("models", "fetched_at", "error", "refreshing")}
+
+    def get(self, api_key):
+        # 古くなっていれば裏で取り直しを始め、今ある一覧をすぐ返す
+        key = _key_digest(api_key)
+        now = time.time()
+        with self._lock:
+            entry = self._entry_locked(key)
+            stale = entry["fetched_at"] is None or now - entry["fetched_at"] > self.ttl
+            may_retry = entry["attempted_at"] is None or now - entry["attempted_at"] > self.retry_interval
+            if stale and may_retry and not entry["refreshing"]:
+                self._start_locked(key, api_key, entry)
+            return self._snapshot(entry)
+
+    def refresh(self, api_key):
+        key = _key_digest(api_key)
+        with self._lock:
+            entry = self._entry_locked(key)
+            if not entry["refreshing"]: self._start_locked(key, api_key, entry)
+
+    def wait(self, api_key, timeout):
+        key = _key_digest(api_key)
+        with self._lock:
+            done = self._entry_locked(key)["done"]
+        done.wait(timeout)
+        with self._lock:
+            return self._snapshot(self._entries[key])
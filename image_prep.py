@@ -0,0 +1,149 @@
+import io
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from disk_cache import make_cache_key
+from lazy_import import LazyModule
+
+Image = LazyModule("PIL.Image")
+ImageChops = LazyModule("PIL.ImageChops")
+ImageOps = LazyModule("PIL.ImageOps")
+
+# --- 画像の前処理 (Gemini に送る前) ---
+# カメラの向きを直し、余白を切り取り、長辺を max_edge に縮めて JPEG で圧縮し直す。
+# 送信量・トークン数・待ち時間を減らすため。結果は元画像のハッシュごとにキャッシュする。
+
+PREP_VERSION = 1
+
+def _trim_border(img, tolerance=30, min_ratio=0.3):
+    # 四隅と同じ色の余白 (撮影時の机や紙の縁) を切り取る。切り過ぎそうなときは何もしない
+    bg = Image.new(img.mode, img.size, img.getpixel((0, 0)))
+    diff = ImageChops.difference(img, bg).convert("L")
+    diff = diff.point(lambda v: 255 if v > tolerance else 0)
+    bbox = diff.getbbox()
+    if not bbox: return img
+    w, h = bbox[2] - bbox[0], bbox[3] - bbox[1]
+    if w * h < img.size[0] * img.size[1] * min_ratio: return img
+    return img.crop(bbox)
+
+def preprocess_image(data, max_edge=1600, quality=82):
+    img = Image.open(io.BytesIO(data))
+    img = ImageOps.exif_transpose(img)
+    if img.mode != "RGB": img = img.convert("RGB")
+    img = _trim_border(img)
+    if max(img.size) > max_edge:
+        img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+    out = io.BytesIO()
+    img.save(out, format="JPEG", quality=quality, optimize=True)
+    return out.getvalue(), "image/jpeg"
+
+def preprocess_images(images, max_edge=1600, quality=82, cache=None, max_workers=4):
+    # images: [{"mime_type", "data"}] → (前処理後のリスト, 統計)
+    # 同じ画像 (バイト列が一致) が複数あれば1枚にまとめる
+    t0 = time.perf_counter()
+    unique = []
+    seen = set()
+    for img in images:
+        digest = hashlib.sha256(img["data"]).hexdigest()
+        if digest in seen: continue
+        seen.add(digest)
+        unique.append((digest, img))
+
+    def work(item):
+        digest, img = item
+        start = time.perf_counter()
+        key = make_cache_key(digest, max_edge, quality, PREP_VERSION)
+        data = cache.get_bytes(key) if cache else None
+        cached = data is not None
+        if not cached:
+            try:
+                data, _ = preprocess_image(img["data"], max_edge, quality)
+            except OSError:
+                # 読めない形式はそのまま送る
+                data = img["data"]
+            if cache: cache.put_bytes(key, data)
+        # 再圧縮で逆に大きくなった場合は元の画像を使う
+        page = dict(img) if len(data) >= len(img["data"]) else {"mime_type": "image/jpeg", "data": data}
+        return page, {"before": len(img["data"]), "after": len(page["data"]), "seconds": time.perf_counter() - start, "cached": cached}
+
+    if not unique: return [], {"pages": 0, "duplicates": 0, "bytes_before": 0, "bytes_after": 0, "cached": 0, "seconds": 0.0, "per_page": []}
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(unique))) as pool:
+        results = list(pool.map(work, unique))
+    pages = [page for page, _ in results]
+    per_page = [s for _, s in results]
+    stats = {
+        "pages": len(pages),
+        "duplicates": len(images) - len(unique),
+        "bytes_before": sum(len(img["data"]) for img in images),
+        "bytes_after": sum(s["after"] for s in per_page),
+        "cached": sum(1 for s in per_page if s["cached"]),
+        "seconds": time.perf_counter() - t0,
+        "per_page": per_page,
+    }
+    return pages, stats
+
+# --- 似た画像の検出 (dHash) ---
+# 縮小したグレースケール画像で隣り合う画素の明暗を比べた 64 ビットのハッシュ。
+# 同じページを撮り直した写真はハミング距離が小さくなる。
+
+def dhash(data, size=8):
+    img = Image.open(io.BytesIO(data))
+    # JPEG は縮小デコードで読み込む (フル解像度に展開しない)
+    img.draft("L", (size * 16, size * 16))
+    img = ImageOps.exif_transpose(img).convert("L").resize((size + 1, size), Image.BILINEAR)
+    px = list(img.getdata())
+    bits = 0
+    for y in range(size):
+        row = px[y * (size + 1):(y + 1) * (size + 1)]
+        for x in range(size):
+            bits = (bits << 1) | (row[x] > row[x + 1])
+    return bits
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+class PerceptualIndex:
+    # ハッシュを threshold + 1 個の区間に分けて区間ごとに索引する。
+    # 距離が threshold 以下なら少なくとも1区間は完全一致する (鳩の巣原理) ので、
+    # 全件と比べなくても候補だけ調べれば見つかる。
+    def __init__(self, threshold=6, bits=64):
+        self.threshold = threshold
+        bands = threshold + 1
+        width = bits // bands
+        self._bands = [(i * width, bits - i * width if i == bands - 1 else width) for i in range(bands)]
+        self._tables = [{} for _ in self._bands]
+        self._hashes = {}
+
+    def _band_keys(self, h):
+        return [(h >> shift) & ((1 << width) - 1) for shift, width in self._bands]
+
+    def find(self, h, exclude=None):
+        # 最も近い (key, 距離)。threshold 以内になければ None。exclude のキーは比べない
+        best = None
+        checked = {exclude}
+        for table, band in zip(self._tables, self._band_keys(h)):
+            for key in table.get(band, ()):
+                if key in checked: continue
+                checked.add(key)
+                dist = hamming(h, self._hashes[key])
+                if dist <= self.threshold and (best is None or dist < best[1]): best = (key, dist)
+        return best
+
+    def add(self, key, h):
+        self._hashes[key] = h
+        for table, band in zip(self._tables, self._band_keys(h)):
+            table.setdefault(band, []).append(key)
+
+    def remove(self, key):
+        h = self._hashes.pop(key, None)
+        if h is None: return
+        for table, band in zip(self._tables, self._band_keys(h)):
+            keys = table[band]
+            keys.remove(key)
+            if not keys: del table[band]
+
+    def __contains__(self, key):
+        return key in self._hashes
+
+    def __len__(self):
+        return len(self._hashes)
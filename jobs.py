@@ -0,0 +1,123 @@
+import os
+import json
+import glob
+import time
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# --- バックグラウンドジョブ ---
+# 生成処理を Streamlit のスクリプトスレッドから切り離してワーカープールで実行する。
+# 進捗と結果はジョブフォルダの job.json に保存するので、ブラウザが切断されたり
+# 画面が再実行されたりしても、ジョブIDさえ分かれば状態を取り直せる。
+# 実行中 + 待ち行列の数に上限を設け、超えた分は受け付けない (Gemini / TTS の枠を守るため)。
+
+JOB_FILE = "job.json"
+
+class JobQueueFull(Exception):
+    pass
+
+class Job:
+    def __init__(self, job_id, job_dir):
+        self.id = job_id
+        self.dir = job_dir
+        self.state = "queued"
+        self.stage = "queued"
+        self.progress = 0.0
+        self.message = ""
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.updated = self.created
+        self._lock = threading.Lock()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "id": self.id, "state": self.state, "stage": self.stage, "progress": self.progress,
+                "message": self.message, "result": self.result, "error": self.error,
+                "created": self.created, "updated": self.updated,
+            }
+
+    def save(self):
+        data = json.dumps(self.snapshot(), ensure_ascii=False)
+        fd, tmp = tempfile.mkstemp(dir=self.dir, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp, os.path.join(self.dir, JOB_FILE))
+
+    def update(self, **fields):
+        with self._lock:
+            for k, v in fields.items(): setattr(self, k, v)
+            self.updated = time.time()
+        self.save()
+
+    def report(self, stage, progress, message=None):
+        fields = {"stage": stage, "progress": min(max(progress, 0.0), 1.0)}
+        if message is not None: fields["message"] = message
+        self.update(**fields)
+
+def load_job_file(job_dir):
+    try:
+        with open(os.path.join(job_dir, JOB_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+class JobManager:
+    def __init__(self, root, max_workers=2, max_queue=8, keep_seconds=3600):
+        self.root = root
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        # 終わったジョブをメモリに残しておく時間 (以降は job.json から読む)
+        self.keep_seconds = keep_seconds
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="menu-job")
+
+    def _prune_locked(self):
+        now = time.time()
+        for job_id, job in list(self._jobs.items()):
+            if job.state in ("done", "failed") and now - job.updated > self.keep_seconds:
+                del self._jobs[job_id]
+
+    def pending(self):
+        with self._lock:
+            return sum(1 for j in self._jobs.values() if j.state in ("queued", "running"))
+
+    def submit(self, job_dir, fn, on_finish=None):
+        # fn(job) が結果 (JSON にできる dict) を返す。例外はジョブの失敗として記録する
+        with self._lock:
+            self._prune_locked()
+            pending = sum(1 for j in self._jobs.values() if j.state in ("queued", "running"))
+            if pending >= self.max_workers + self.max_queue:
+                raise JobQueueFull(f"混雑しています（処理中・待ち {pending} 件）。しばらくしてから再度お試しください。")
+            job = Job(os.path.basename(job_dir), job_dir)
+            self._jobs[job.id] = job
+        job.save()
+        self._executor.submit(self._run, job, fn, on_finish)
+        return job.id
+
+    def _run(self, job, fn, on_finish):
+        job.update(state="running")
+        try:
+            result = fn(job)
+            job.update(state="done", stage="done", progress=1.0, result=result)
+        except Exception as e:
+            job.update(state="failed", error=str(e))
+        finally:
+            if on_finish: on_finish(job)
+
+    def status(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job: return job.snapshot()
+        if not job_id or os.path.basename(job_id) != job_id: return None
+        # プロセスの再起動後などはディスクの記録から読む
+        for job_dir in glob.glob(os.path.join(self.root, "*", glob.escape(job_id))):
+            data = load_job_file(job_dir)
+            if data is None: continue
+            if data["state"] in ("queued", "running"):
+                data.update(state="failed", error="処理が中断されました")
+            return data
+        return None
@@ -0,0 +1,43 @@
+import importlib
+import threading
+
+# --- 重いライブラリの遅延読み込み ---
+# google.generativeai / edge_tts / gtts / bs4 / PIL などは読み込むだけで時間とメモリを使うが、
+# 多くのセッションは何度か操作してから初めて使う。LazyModule は属性に触れたときに初めて import する
+# モジュールの代わりで、`genai.GenerativeModel(...)` のような呼び出し側はそのまま書ける。
+# 起動直後に warm_up() を呼ぶと、登録済みのモジュールを裏のスレッドで先に読み込んでおく。
+
+_modules = []
+
+class LazyModule:
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+        _modules.append(self)
+
+    def _load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<LazyModule {self._name} ({state})>"
+
+def warm_up():
+    # 読み込めないモジュールは飛ばす (使うときに改めて ImportError になる)
+    def load():
+        for module in list(_modules):
+            try:
+                module._load()
+            except ImportError:
+                pass
+    thread = threading.Thread(target=load, name="menu-warm-up", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,45 @@
+import os
+from disk_cache import DiskCache
+
+# --- 共有キャッシュの場所と容量 ---
+# 画面 (app.py) と一括生成 (batch_runner.py) は、ここで決めた同じ場所・同じ設定のキャッシュを開く。
+# ファイル単位で原子的に書くので、複数のプロセスから同時に使える。
+
+CACHE_ROOT = os.environ.get("MENU_CACHE_DIR", os.path.abspath(".menu_cache"))
+
+# 同じ台本・声・速度なら前回の音声を再利用する
+TTS_CACHE_MAX_MB = int(os.environ.get("MENU_TTS_CACHE_MAX_MB", "500"))
+
+# 同じ画像(またはWebテキスト)・プロンプト・モデルなら Gemini の解析結果を再利用する
+ANALYSIS_CACHE_MAX_MB = int(os.environ.get("MENU_ANALYSIS_CACHE_MAX_MB", "50"))
+ANALYSIS_CACHE_TTL_HOURS = float(os.environ.get("MENU_ANALYSIS_CACHE_TTL_HOURS", "168"))
+
+# 前処理 (縮小・再圧縮) 済みの画像を元画像のハッシュごとに再利用する
+IMAGE_CACHE_MAX_MB = int(os.environ.get("MENU_IMAGE_CACHE_MAX_MB", "200"))
+
+# URL から取り込んだページ (ETag / Last-Modified と抽出済みの文章) を条件付き GET 用に残す
+WEB_CACHE_MAX_MB = int(os.environ.get("MENU_WEB_CACHE_MAX_MB", "50"))
+
+MB = 1024 * 1024
+
+def open_tts_cache(root=CACHE_ROOT):
+    return DiskCache(os.path.join(root, "tts"), TTS_CACHE_MAX_MB * MB, suffix=".mp3")
+
+def open_analysis_cache(root=CACHE_ROOT):
+    return DiskCache(os.path.join(root, "analysis"), ANALYSIS_CACHE_MAX_MB * MB,
+                     suffix=".json", ttl=ANALYSIS_CACHE_TTL_HOURS * 3600)
+
+def open_image_cache(root=CACHE_ROOT):
+    return DiskCache(os.path.join(root, "images"), IMAGE_CACHE_MAX_MB * MB, suffix=".jpg")
+
+def open_web_cache(root=CACHE_ROOT):
+    return DiskCache(os.path.join(root, "web"), WEB_CACHE_MAX_MB * MB, suffix=".json")
+
+def open_model_store(root=CACHE_ROOT):
+    # Gemini のモデル一覧 (API キーごと)
+    return DiskCache(os.path.join(root, "models"), MB, suffix=".json")
+
+def open_caches(root=CACHE_ROOT):
+    # generate_menu / generate_menu_multilingual にそのまま渡せる形
+    return {"tts_cache": open_tts_cache(root), "analysis_cache": open_analysis_cache(root),
+            "image_cache": open_image_cache(root), "web_cache": open_web_cache(root)}
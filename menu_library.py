@@ -0,0 +1,221 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import sqlite3
+import threading
+from contextlib import contextmanager
+from disk_cache import make_cache_key
+from workspace import dir_size
+
+# --- 作成済みメニューのライブラリ ---
+# 生成が終わった作業フォルダを root/<ID>/ に写し (同じディスクならハードリンクなのでほぼ一瞬)、
+# 店舗名・メニュー名・言語・声・作成日時・元データのハッシュ・成果物のパスを SQLite に記録する。
+# 結果の dict もそのまま保存するので、過去のプレイヤーは生成し直さずにすぐ開ける。
+# 同じ元データ・同じ設定の依頼 (request_key が同じ) は既存のエントリを返し、作り直さない。
+# エントリは複数のセッションが開くので書き換えない。台本を修正するときは copy_to で作業フォルダに写してから直す。
+# 店舗名・メニュー名の検索には FTS5 (trigram) の索引を使う (使えない SQLite では LIKE で探す)。
+
+DB_NAME = "library.db"
+# 保存する結果の中のパスは、この印から始まる相対パスにする (ライブラリの場所を移しても開ける)
+ENTRY_MARK = "$ENTRY"
+
+# 出来上がるものに影響する設定 (同じなら同じメニューとみなす)
+REQUEST_FIELDS = (
+    "store_name", "menu_title", "map_url", "lang_key", "languages", "voice_code", "voice_codes", "rate_value",
+    "model_name", "player_mode", "map_reduce", "audio_layout", "audio_codec",
+)
+
+def source_digest(params, web_text=None):
+    # 画像はバイト列のハッシュ、URL は取り込んだ本文のハッシュ (ページが変わったら別の依頼になる)
+    h = hashlib.sha256()
+    images = params.get("images") or []
+    for img in images:
+        h.update(hashlib.sha256(img["data"]).digest())
+    if not images:
+        if web_text is None: raise ValueError("URL の依頼は取り込んだ本文 (web_text) が必要です")
+        h.update(("url:" + (params.get("target_url") or "") + "\n").encode("utf-8"))
+        h.update(web_text.encode("utf-8"))
+    return h.hexdigest()
+
+def request_key(params, dictionary=None, web_text=None):
+    # dictionary: 読み方辞書の登録内容 (日本語を作るときだけ結果に影響する)
+    # web_text: URL の依頼で取り込んだ本文
+    languages = params.get("languages") or [params.get("lang_key")]
+    if "Japanese" not in languages: dictionary = None
+    return make_cache_key(source_digest(params, web_text), {k: params.get(k) for k in REQUEST_FIELDS}, dictionary or {})
+
+def result_complete(result):
+    # 全言語・全トラックの音声が作れた結果だけをライブラリに入れる (TTS の障害などで欠けた結果を使い回さない)
+    if result.get("failed_languages"): return False
+    views = result["languages"] if result.get("multilingual") else [result]
+    return all(t.get("engine") for v in views for t in v["tracks"])
+
+def _rebase(value, old, new):
+    # 結果の dict の中のパスの先頭を old → new に置き換える
+    if isinstance(value, str):
+        if value == old or value.startswith(old + os.sep) or value.startswith(old + "/"):
+            return new + value[len(old):]
+        return value
+    if isinstance(value, list): return [_rebase(v, old, new) for v in value]
+    if isinstance(value, tuple): return tuple(_rebase(v, old, new) for v in value)
+    if isinstance(value, dict): return {k: _rebase(v, old, new) for k, v in value.items()}
+    return value
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+class MenuLibrary:
+    def __init__(self, root):
+        self.root = root
+        self.db_path = os.path.join(root, DB_NAME)
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS menus (
+                    id TEXT PRIMARY KEY,
+                    request_key TEXT NOT NULL,
+                    source_digest TEXT NOT NULL,
+                    store_name TEXT NOT NULL,
+                    menu_title TEXT NOT NULL DEFAULT '',
+                    languages TEXT NOT NULL,
+                    voices TEXT NOT NULL DEFAULT '',
+                    player_mode TEXT,
+                    audio_layout TEXT,
+                    created REAL NOT NULL,
+                    zip_name TEXT,
+                    html_name TEXT,
+                    bytes INTEGER NOT NULL DEFAULT 0,
+                    result TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS menus_request ON menus(request_key);
+                CREATE INDEX IF NOT EXISTS menus_source ON menus(source_digest);
+                CREATE INDEX IF NOT EXISTS menus_created ON menus(created);
+            """)
+            try:
+                db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS menus_fts USING fts5(id UNINDEXED, store_name, menu_title, tokenize='trigram')")
+                self.fts = True
+            except sqlite3.OperationalError:
+                self.fts = False
+
+    @contextmanager
+    def _connect(self):
+        # 呼び出しごとに接続する (スレッドをまたいで接続を使い回さない)
+        db = sqlite3.connect(self.db_path, timeout=30)
+        db.row_factory = sqlite3.Row
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def _entry_dir(self, entry_id):
+        return os.path.join(self.root, entry_id)
+
+    def _load(self, row):
+        result = json.loads(row["result"])
+        result = _rebase(result, ENTRY_MARK, self._entry_dir(row["id"]))
+        result["library_id"] = row["id"]
+        result["library_created"] = row["created"]
+        return result
+
+    def _summary(self, row):
+        return {k: row[k] for k in ("id", "store_name", "menu_title", "languages", "voices", "player_mode", "audio_layout", "created", "bytes")}
+
+    def _alive(self, row):
+        return os.path.exists(os.path.join(self._entry_dir(row["id"]), row["zip_name"] or ""))
+
+    def add(self, job_dir, result, params, key, web_text=None):
+        # 作業フォルダを写してエントリを作り、ライブラリ側のパスに置き換えた結果を返す
+        entry_id = f"{time.strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8]}"
+        entry_dir = self._entry_dir(entry_id)
+        shutil.copytree(job_dir, entry_dir, copy_function=_link_or_copy, ignore=shutil.ignore_patterns("job.json", "*.tmp"))
+        stored = _rebase(result, job_dir, ENTRY_MARK)
+        langs = [r["lang_key"] for r in result["languages"]] if result.get("multilingual") else [result["lang_key"]]
+        voices = [r["voice_code"] for r in result["languages"]] if result.get("multilingual") else [result["voice_code"]]
+        with self._lock, self._connect() as db:
+            # 同じ依頼の古いエントリ (再解析して作り直した場合など) は置き換える
+            old = [r["id"] for r in db.execute("SELECT id FROM menus WHERE request_key = ?", (key,))]
+            db.execute(
+                "INSERT INTO menus (id, request_key, source_digest, store_name, menu_title, languages, voices, player_mode,"
+                " audio_layout, created, zip_name, html_name, bytes, result) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (entry_id, key, source_digest(params, web_text), result["store_name"], result.get("menu_title") or "", ",".join(langs),
+                 ",".join(voices), result.get("player_mode"), params.get("audio_layout", "tracks"), time.time(),
+                 os.path.relpath(result["zip_path"], job_dir), os.path.relpath(result["html_path"], job_dir),
+                 dir_size(entry_dir), json.dumps(stored, ensure_ascii=False)))
+            if self.fts:
+                db.execute("INSERT INTO menus_fts (id, store_name, menu_title) VALUES (?, ?, ?)",
+                           (entry_id, result["store_name"], result.get("menu_title") or ""))
+            self._delete_rows(db, old)
+        for old_id in old: shutil.rmtree(self._entry_dir(old_id), ignore_errors=True)
+        return self.get(entry_id)
+
+    def _delete_rows(self, db, ids):
+        for entry_id in ids:
+            db.execute("DELETE FROM menus WHERE id = ?", (entry_id,))
+            if self.fts: db.execute("DELETE FROM menus_fts WHERE id = ?", (entry_id,))
+
+    def get(self, entry_id):
+        with self._connect() as db:
+            row = db.execute("SELECT * FROM menus WHERE id = ?", (entry_id,)).fetchone()
+        return self._load(row) if row and self._alive(row) else None
+
+    def find(self, key):
+        # 同じ依頼の最新の、全トラックが揃ったエントリ。成果物が消えていれば記録も消す
+        with self._connect() as db:
+            rows = db.execute("SELECT * FROM menus WHERE request_key = ? ORDER BY created DESC", (key,)).fetchall()
+        for row in rows:
+            if not self._alive(row):
+                self.remove(row["id"])
+                continue
+            # 修正後の再生成で欠けたエントリは使わない (開いているセッションがあるので消さず、次に作ったもので置き換える)
+            result = self._load(row)
+            if result_complete(result): return result
+        return None
+
+    def search(self, query="", limit=20):
+        # 戻り値: 一覧表示用の要約 (新しい順)
+        query = query.strip()
+        with self._connect() as db:
+            if not query:
+                rows = db.execute("SELECT * FROM menus ORDER BY created DESC LIMIT ?", (limit,)).fetchall()
+            elif self.fts and len(query) >= 3:
+                # trigram は3文字以上でないと引けないので、短い語は LIKE で探す
+                phrase = '"' + query.replace('"', '""') + '"'
+                rows = db.execute(
+                    "SELECT m.* FROM menus_fts f JOIN menus m ON m.id = f.id WHERE menus_fts MATCH ? ORDER BY m.created DESC LIMIT ?",
+                    (phrase, limit)).fetchall()
+            else:
+                like = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+                rows = db.execute(
+                    "SELECT * FROM menus WHERE store_name LIKE ? ESCAPE '\\' OR menu_title LIKE ? ESCAPE '\\' OR languages LIKE ? ESCAPE '\\'"
+                    " ORDER BY created DESC LIMIT ?", (like, like, like, limit)).fetchall()
+        return [self._summary(r) for r in rows]
+
+    def copy_to(self, entry_id, dest_dir):
+        # エントリを dest_dir に複製した結果を返す (台本の修正はこちらに対して行い、共有のエントリは書き換えない)。
+        # 修正で上書きされるファイルがエントリ側まで変わらないよう、ハードリンクにせず中身を写す
+        result = self.get(entry_id)
+        if result is None: return None
+        entry_dir = self._entry_dir(entry_id)
+        shutil.copytree(entry_dir, dest_dir, dirs_exist_ok=True)
+        result = _rebase(result, entry_dir, dest_dir)
+        del result["library_id"], result["library_created"]
+        return result
+
+    def remove(self, entry_id):
+        with self._lock, self._connect() as db:
+            self._delete_rows(db, [entry_id])
+        shutil.rmtree(self._entry_dir(entry_id), ignore_errors=True)
+
+    def stats(self):
+        with self._connect() as db:
+            row = db.execute("SELECT COUNT(*) AS n, COALESCE(SUM(bytes), 0) AS b FROM menus").fetchone()
+        return {"entries": row["n"], "bytes": row["b"]}
@@ -0,0 +1,1594 @@
+import os
+import io
+import re
+import json
+import time
+import random
+import base64
+import asyncio
+import hashlib
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from disk_cache import make_cache_key
+from tts_scheduler import AdaptiveLimiter, CircuitBreaker
+from audio_utils import join_mp3_files, join_mp3_chaptered, encode_chaptered, find_ffmpeg, AUDIO_CODECS
+from zip_utils import IncrementalZip, patch_zip
+from image_prep import preprocess_images
+from reading_dict import ReadingDictionary
+from web_ingest import ingest_url, IngestError
+from gemini_client import generative_model
+from telemetry import run as telemetry_run, span, count, bind
+from lazy_import import LazyModule
+
+# SDK は最初に使うときに読み込む (app.py は起動後に warm_up() で裏から先に読み込む)
+gtts = LazyModule("gtts")
+exceptions = LazyModule("google.api_core.exceptions")
+edge_tts = LazyModule("edge_tts")
+
+# --- 生成パイプライン (解析 → 音声 → HTML → ZIP) ---
+# Streamlit に依存しない処理をまとめたモジュール。画面側 (app.py) からも
+# バックグラウンドのジョブからも同じ関数を呼ぶ。
+
+# --- 音声生成の設定 ---
+TTS_MAX_CONCURRENCY = int(os.environ.get("MENU_TTS_MAX_CONCURRENCY", "8"))
+TTS_MAX_ATTEMPTS = 3
+# これより長い台本は文単位で分割して並列に合成する
+TTS_CHUNK_CHARS = int(os.environ.get("MENU_TTS_CHUNK_CHARS", "400"))
+
+# --- 画像の前処理の設定 (Gemini に送る前に縮小・再圧縮する) ---
+IMAGE_MAX_EDGE = int(os.environ.get("MENU_IMAGE_MAX_EDGE", "1600"))
+IMAGE_QUALITY = int(os.environ.get("MENU_IMAGE_QUALITY", "82"))
+IMAGE_PREP_WORKERS = int(os.environ.get("MENU_IMAGE_PREP_WORKERS", "4"))
+
+# --- 分割解析 (map-reduce) の設定 ---
+# この枚数以上の画像は数ページずつ並列に品目を抽出し、最後にカテゴリーへまとめる
+MAP_REDUCE_MIN_PAGES = int(os.environ.get("MENU_MAP_REDUCE_MIN_PAGES", "6"))
+MAP_BATCH_PAGES = int(os.environ.get("MENU_MAP_BATCH_PAGES", "3"))
+MAP_MAX_CONCURRENCY = int(os.environ.get("MENU_MAP_MAX_CONCURRENCY", "3"))
+MAP_MAX_ATTEMPTS = 3
+
+# --- URL からの取り込みの設定 ---
+# 同じサイト内のメニューらしいリンクをたどる段数・ページ数と、Gemini に渡す文字数の上限
+WEB_CRAWL_DEPTH = int(os.environ.get("MENU_WEB_CRAWL_DEPTH", "1"))
+WEB_CRAWL_MAX_PAGES = int(os.environ.get("MENU_WEB_CRAWL_MAX_PAGES", "8"))
+WEB_MAX_CHARS = int(os.environ.get("MENU_WEB_MAX_CHARS", "30000"))
+
+# --- 1ファイル音声 (チャプター付き) の設定 ---
+# ffmpeg があればトラックごとの音量をこの値 (LUFS) に揃え、形式ごとのビットレートのモノラルでエンコードし直す
+FFMPEG_COMMAND = os.environ.get("MENU_FFMPEG", "ffmpeg")
+LOUDNESS_TARGET = float(os.environ.get("MENU_LOUDNESS_TARGET", "-16"))
+AUDIO_BITRATES = {
+    "mp3": os.environ.get("MENU_MP3_BITRATE", "48k"),
+    "opus": os.environ.get("MENU_OPUS_BITRATE", "16k"),
+    "aac": os.environ.get("MENU_AAC_BITRATE", "32k"),
+}
+
+# エンジンごとのサーキットブレーカー (障害中のエンジンは即座に飛ばす)
+def new_tts_breakers():
+    return {"edge": CircuitBreaker(failure_threshold=5, reset_timeout=30.0),
+            "gtts": CircuitBreaker(failure_threshold=5, reset_timeout=60.0)}
+
+# --- 定数・辞書設定 ---
+LANG_SETTINGS = {
+    "Japanese": {
+        "code": "ja",
+        "voice_gender": ["女性 (七海)", "男性 (慶太)"],
+        "voice_ids": ["ja-JP-NanamiNeural", "ja-JP-KeitaNeural"],
+        "rate_value": "+10%",
+        "ui": {
+            "title": "カテゴリー", "text": "説明", "loading": "読み込み中...", "speed": "速度", 
+            "map_btn": "🗺️ 地図・アクセス (Google Map)", "intro": "こんにちは。", "toc": "目次です。",
+            "outro": "それではどうぞ。", "file_code": "ja", "lang_name": "日本語", "currency": "円"
+        }
+    },
+    "English (UK)": {
+        "code": "en",
+        "voice_gender": ["Female (Sonia - UK)", "Male (Ryan - UK)"],
+        "voice_ids": ["en-GB-SoniaNeural", "en-GB-RyanNeural"],
+        "rate_value": "+0%",
+        "ui": {
+            "title": "Category", "text": "Description", "loading": "Loading...", "speed": "Speed",
+            "map_btn": "🗺️ Open Map (Google Map)", "intro": "Hello.", "toc": "Here is the table of contents.",
+            "outro": "Please enjoy.", "file_code": "en", "lang_name": "English", "currency": "Yen"
+        }
+    },
+    "Chinese": {
+        "code": "zh",
+        "voice_gender": ["女性 (晓晓)", "男性 (云希)"],
+        "voice_ids": ["zh-CN-XiaoxiaoNeural", "zh-CN-YunxiNeural"],
+        "rate_value": "+0%",
+        "ui": {
+            "title": "类别", "text": "描述", "loading": "加载中...", "speed": "速度",
+            "map_btn": "🗺️ 打开地图 (Google Map)", "intro": "你好。", "toc": "这是目录。",
+            "outro": "请慢用。", "file_code": "zh", "lang_name": "中文", "currency": "日元"
+        }
+    },
+    "Korean": {
+        "code": "ko",
+        "voice_gender": ["여성 (선희)", "남성 (인준)"],
+        "voice_ids": ["ko-KR-SunHiNeural", "ko-KR-InJoonNeural"],
+        "rate_value": "+0%",
+        "ui": {
+            "title": "카테고리", "text": "설명", "loading": "로딩 중...", "speed": "속도",
+            "map_btn": "🗺️ 지도 보기 (Google Map)", "intro": "안녕하세요。", "toc": "목차입니다。",
+            "outro": "천천히 골라주세요。", "file_code": "ko", "lang_name": "한국어", "currency": "엔"
+        }
+    }
+}
+
+# --- 関数定義 ---
+def sanitize_filename(name):
+    return re.sub(r'[\\/*?:"<>|]', "", name).replace(" ", "_").replace("　", "_")
+
+def fetch_text_from_url(url, cache=None):
+    # 戻り値: (メニューの文章, 取り込みの統計)
+    with span("ingest") as s:
+        try:
+            text, stats = ingest_url(url, WEB_CRAWL_DEPTH, WEB_CRAWL_MAX_PAGES, WEB_MAX_CHARS, cache)
+        except IngestError as e:
+            raise GenerationError(f"URLエラー: {e}") from e
+        s.update(pages=stats["pages"], chars=stats["chars"], errors=len(stats["errors"]))
+    count("cache_hits", stats["not_modified"], cache="web")
+    count("cache_misses", stats["pages"] - stats["not_modified"], cache="web")
+    return text, stats
+
+def web_source(params, cache=None):
+    # 呼び出し側が取り込み済み (params["web_text"] / params["web_stats"]) ならそれを使い、もう一度クロールしない
+    if params.get("web_text") is not None: return params["web_text"], params.get("web_stats")
+    return fetch_text_from_url(params["target_url"], cache)
+
+def gtts_lang_for_voice(voice_code):
+    for conf in LANG_SETTINGS.values():
+        if voice_code in conf["voice_ids"]: return conf["code"]
+    return voice_code.split("-")[0]
+
+async def generate_single_track_fast(text, filename, voice_code, rate_value, cache=None, limiter=None, stats=None, breakers=None, hedge_after=None):
+    # 戻り値: 使われたエンジン名 ("cache" / "edge" / "gtts")、失敗時は None
+    # stats には待ち時間・合成時間・試行回数・エンジンを記録する
+    # hedge_after 秒たっても edge-tts が終わらなければ gTTS を並行して走らせ、先に終わった方を使う
+    if limiter is None: limiter = AdaptiveLimiter(TTS_MAX_CONCURRENCY)
+    if breakers is None: breakers = new_tts_breakers()
+    if stats is None: stats = {}
+    stats.update({"queue_wait": 0.0, "synth_time": 0.0, "attempts": 0, "engine": None, "hedged": False})
+    gtts_lang = gtts_lang_for_voice(voice_code)
+    # エンジンごとに別の一時ファイルへ書き、勝った方だけを filename に置き換える
+    edge_path = filename + ".edge.part"
+    gtts_path = filename + ".gtts.part"
+
+    async def attempt(engine, make, path):
+        with span("tts_attempt", engine=engine) as s:
+            t0 = time.perf_counter()
+            await limiter.acquire()
+            t1 = time.perf_counter()
+            stats["queue_wait"] += t1 - t0
+            stats["attempts"] += 1
+            s.update(attempt=stats["attempts"], queue_wait=t1 - t0)
+            try:
+                await make()
+                s["ok"] = os.path.exists(path) and os.path.getsize(path) > 0
+            except Exception as e:
+                s.update(ok=False, error=f"{e.__class__.__name__}: {e}")
+            finally:
+                limiter.release()
+                stats["synth_time"] += time.perf_counter() - t1
+            if not s["ok"]: count("tts_failures", engine=engine)
+            return s["ok"]
+
+    async def run_edge():
+        breaker = breakers["edge"]
+        for n in range(TTS_MAX_ATTEMPTS):
+            if not breaker.allow(): return False
+            try:
+                ok = await attempt("edge", lambda: edge_tts.Communicate(text, voice_code, rate=rate_value).save(edge_path), edge_path)
+            except asyncio.CancelledError:
+                breaker.abandon()
+                raise
+            if ok:
+                breaker.record_success()
+                limiter.on_success()
+                return True
+            breaker.record_failure()
+            limiter.on_failure()
+            if n < TTS_MAX_ATTEMPTS - 1:
+                await asyncio.sleep(limiter.backoff_delay(n))
+        return False
+
+    async def run_gtts():
+        breaker = breakers["gtts"]
+        if not breaker.allow(): return False
+        def gtts_task():
+            buf = io.BytesIO()
+            gtts.gTTS(text=text, lang=gtts_lang).write_to_fp(buf)
+            return buf.getvalue()
+        async def make():
+            data = await asyncio.to_thread(gtts_task)
+            with open(gtts_path, "wb") as f: f.write(data)
+        try:
+            ok = await attempt("gtts", make, gtts_path)
+        except asyncio.CancelledError:
+            breaker.abandon()
+            raise
+        if ok: breaker.record_success()
+        else: breaker.record_failure()
+        return ok
+
+    def done(engine, path=None, key=None):
+        if path:
+            os.replace(path, filename)
+            if cache: cache.store(key, filename)
+        if engine == "cache": count("cache_hits", cache="tts")
+        elif cache: count("cache_misses", cache="tts")
+        # edge-tts で作れなかった分 (ヘッジで gTTS が先に終わった分を含む)
+        if engine == "gtts": count("tts_fallbacks", reason="hedge" if stats["hedged"] else "edge_failed")
+        stats["engine"] = engine
+        return engine
+
+    edge_key = make_cache_key(text, voice_code, rate_value, "edge")
+    # gTTS は声・速度を指定できないので言語だけをキーにする
+    gtts_key = make_cache_key(text, gtts_lang, "", "gtts")
+    if cache and cache.fetch(edge_key, filename):
+        return done("cache")
+
+    edge_task = asyncio.create_task(run_edge())
+    gtts_task = None
+    pending = {edge_task}
+    try:
+        if hedge_after is not None:
+            finished, _ = await asyncio.wait(pending, timeout=hedge_after)
+            if not finished and breakers["gtts"].available():
+                stats["hedged"] = True
+                count("tts_hedges")
+                gtts_task = asyncio.create_task(run_gtts())
+                pending.add(gtts_task)
+        while pending:
+            finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for t in finished:
+                if t.result():
+                    if t is edge_task: return done("edge", edge_path, edge_key)
+                    return done("gtts", gtts_path, gtts_key)
+        # edge-tts が失敗 (またはブレーカーが open) → gTTS にフォールバック
+        if gtts_task is None:
+            if cache and cache.fetch(gtts_key, filename):
+                return done("cache")
+            if await run_gtts():
+                return done("gtts", gtts_path, gtts_key)
+        return done(None)
+    finally:
+        for t in pending: t.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        for p in (edge_path, gtts_path):
+            if os.path.exists(p): os.remove(p)
+
+# 文の区切り: 日本語・中国語・韓国語の句点と、欧文の . ! ? (後ろに空白があるもののみ。価格の小数点では切らない)
+SENTENCE_END = re.compile(r'(?<=[。！？])|(?<=[.!?])\s+|\n+')
+
+def split_speech_text(text, max_chars):
+    if len(text) <= max_chars: return [text]
+    chunks = []
+    cur = ""
+    for sentence in SENTENCE_END.split(text):
+        sentence = sentence.strip()
+        if not sentence: continue
+        if cur and len(cur) + len(sentence) + 1 > max_chars:
+            chunks.append(cur)
+            cur = sentence
+        else:
+            cur = f"{cur}\n{sentence}" if cur else sentence
+    if cur: chunks.append(cur)
+    return chunks
+
+async def generate_track_chunked(text, filename, voice_code, rate_value, cache=None, limiter=None, stats=None, breakers=None, hedge_after=None):
+    # 長い台本は文単位に分けて同時に合成し、最後に1つの MP3 に繋げる
+    chunks = split_speech_text(text, TTS_CHUNK_CHARS)
+    if stats is None: stats = {}
+    if len(chunks) == 1:
+        stats["chunks"] = 1
+        return await generate_single_track_fast(text, filename, voice_code, rate_value, cache, limiter, stats, breakers, hedge_after)
+
+    if limiter is None: limiter = AdaptiveLimiter(TTS_MAX_CONCURRENCY)
+    if breakers is None: breakers = new_tts_breakers()
+    paths = [f"{filename}.{n:02}.chunk" for n in range(len(chunks))]
+    chunk_stats = [{} for _ in chunks]
+    try:
+        engines = await asyncio.gather(*[
+            generate_single_track_fast(c, p, voice_code, rate_value, cache, limiter, cs, breakers, hedge_after)
+            for c, p, cs in zip(chunks, paths, chunk_stats)])
+        if all(engines):
+            join_mp3_files(paths, filename)
+    finally:
+        for p in paths:
+            if os.path.exists(p): os.remove(p)
+
+    engine = "+".join(sorted(set(engines))) if all(engines) else None
+    stats.update({
+        "queue_wait": sum(cs["queue_wait"] for cs in chunk_stats),
+        "synth_time": max(cs["synth_time"] for cs in chunk_stats),
+        "attempts": sum(cs["attempts"] for cs in chunk_stats),
+        "engine": engine,
+        "hedged": any(cs["hedged"] for cs in chunk_stats),
+        "chunks": len(chunks),
+    })
+    return engine
+
+def track_file_path(i, track, output_dir):
+    safe_title = sanitize_filename(track['title'])
+    return os.path.join(output_dir, f"{i:02}_{safe_title}.mp3")
+
+def track_speech_text(i, track, lang_key, readings=None):
+    # readings: 読み方辞書 (ReadingDictionary)。登録語を読みに置き換えてから読み上げる
+    if i == 0:
+        text = track['text']
+    elif lang_key == "Japanese":
+        text = f"{i}、{track['title']}。\n{track['text']}"
+    elif lang_key == "English (UK)":
+        text = f"Chapter {i}, {track['title']}.\n{track['text']}"
+    else:
+        text = f"{i}, {track['title']}.\n{track['text']}"
+    return readings.apply(text) if readings else text
+
+def build_toc_track(categories, store_name, menu_title, lang_key):
+    ui = LANG_SETTINGS[lang_key]["ui"]
+    intro_t = f"{ui['intro']} {store_name}."
+    if menu_title: intro_t += f" {menu_title}."
+    
+    for i, tr in enumerate(categories):
+        if lang_key == "Japanese": intro_t += f" {i+1}、{tr['title']}。"
+        else: intro_t += f" {i+1}, {tr['title']}."
+    intro_t += f" {ui['outro']}"
+    return {"title": ui['toc'], "text": intro_t}
+
+async def _run_track(info, coro, on_track_done=None, stats=None):
+    with span("tts_track", title=info["title"]) as s:
+        info["engine"] = await coro
+        if stats: s.update({k: stats.get(k) for k in ("index", "engine", "attempts", "chunks", "hedged", "queue_wait", "synth_time")})
+    # 出来上がったトラックはすぐに ZIP などへ渡す
+    if on_track_done and info["engine"]: on_track_done(info)
+    return info
+
+def _new_track_stats(i, track):
+    return {"index": i, "title": track['title']}
+
+async def process_all_tracks_fast(menu_data, output_dir, voice_code, rate_value, progress_bar, lang_key, cache=None, limiter=None, breakers=None, hedge_after=None, reuse=None, on_track_done=None, readings=None):
+    # 戻り値: (track_info_list, トラックごとの計測値リスト)
+    # reuse に含まれる番号のトラックは既存のファイルをそのまま使う
+    if limiter is None: limiter = AdaptiveLimiter(TTS_MAX_CONCURRENCY)
+    tasks = []
+    track_info_list = []
+    track_stats = []
+    
+    for i, track in enumerate(menu_data):
+        save_path = track_file_path(i, track, output_dir)
+        speech_text = track_speech_text(i, track, lang_key, readings)
+        info = {"title": track['title'], "path": save_path}
+        stats = _new_track_stats(i, track)
+        if reuse and i in reuse:
+            info["engine"] = "reuse"
+            stats.update({"queue_wait": 0.0, "synth_time": 0.0, "attempts": 0, "engine": "reuse", "hedged": False, "chunks": 0})
+            track_info_list.append(info)
+            track_stats.append(stats)
+            continue
+        tasks.append(_run_track(info, generate_track_chunked(speech_text, save_path, voice_code, rate_value, cache, limiter, stats, breakers, hedge_after), on_track_done, stats))
+        track_info_list.append(info)
+        track_stats.append(stats)
+    
+    total = len(tasks)
+    completed = 0
+    for task in asyncio.as_completed(tasks):
+        await task
+        completed += 1
+        progress_bar.progress(completed / total)
+    if not total: progress_bar.progress(1.0)
+    return track_info_list, track_stats
+
+# --- ストリーミング解析 ---
+# Gemini の出力を少しずつ受け取り、JSON配列の要素 {"title","text"} が閉じた時点で取り出す
+class JsonArrayStreamParser:
+    def __init__(self):
+        self._started = False
+        self._done = False
+        self._depth = 0
+        self._in_str = False
+        self._escape = False
+        self._buf = []
+
+    def feed(self, text):
+        items = []
+        for ch in text:
+            if self._done: break
+            if not self._started:
+                if ch == '[': self._started = True
+                continue
+            if self._depth == 0:
+                if ch == '{':
+                    self._depth = 1
+                    self._buf = [ch]
+                elif ch == ']':
+                    self._done = True
+                continue
+            self._buf.append(ch)
+            if self._in_str:
+                if self._escape: self._escape = False
+                elif ch == '\\': self._escape = True
+                elif ch == '"': self._in_str = False
+                continue
+            if ch == '"':
+                self._in_str = True
+            elif ch in '{[':
+                self._depth += 1
+            elif ch in '}]':
+                self._depth -= 1
+                if self._depth == 0:
+                    try:
+                        obj = json.loads("".join(self._buf))
+                    except json.JSONDecodeError:
+                        continue
+                    if isinstance(obj, dict) and 'title' in obj and 'text' in obj:
+                        items.append(obj)
+        return items
+
+    @property
+    def done(self):
+        # 閉じ括弧 ] まで届いたか (途中で切れたストリームは False)
+        return self._done
+
+def next_chunk_text(chunks):
+    # 安全フィルタ等でテキストを持たないチャンクは読み飛ばす
+    for chunk in chunks:
+        try:
+            return chunk.text
+        except ValueError:
+            continue
+    return None
+
+def open_menu_stream(model, parts):
+    # 最初のチャンクが届くまでをリトライ対象にする (途中で切れた場合は呼び出し側でエラー)
+    for n in range(3):
+        try:
+            with span("llm", what="stream_open", model=model.model_name, attempt=n + 1):
+                chunks = iter(model.generate_content(parts, stream=True))
+                return chunks, next_chunk_text(chunks)
+        except exceptions.ResourceExhausted:
+            count("gemini_resource_exhausted")
+            time.sleep(5)
+        except Exception: pass
+    return None, None
+
+async def stream_tracks_fast(chunks, first_text, toc_builder, output_dir, voice_code, rate_value, progress_bar, lang_key, cache=None, limiter=None, breakers=None, hedge_after=None, on_track_done=None, readings=None):
+    # カテゴリーが1つ確定するたびに音声生成を開始し、目次トラックは全タイトルが揃ってから最後に作る
+    if limiter is None: limiter = AdaptiveLimiter(TTS_MAX_CONCURRENCY)
+    parser = JsonArrayStreamParser()
+    categories = []
+    track_info_list = []
+    track_stats = []
+    tasks = []
+    completed = 0
+
+    def on_done(_):
+        nonlocal completed
+        completed += 1
+        progress_bar.progress(min(completed / (len(tasks) + 1), 1.0))
+
+    def start_track(i, track):
+        save_path = track_file_path(i, track, output_dir)
+        info = {"title": track['title'], "path": save_path}
+        stats = _new_track_stats(i, track)
+        track_stats.append(stats)
+        coro = generate_track_chunked(track_speech_text(i, track, lang_key, readings), save_path, voice_code, rate_value, cache, limiter, stats, breakers, hedge_after)
+        task = asyncio.create_task(_run_track(info, coro, on_track_done, stats))
+        task.add_done_callback(on_done)
+        tasks.append(task)
+        return info
+
+    try:
+        with span("llm_stream") as s:
+            text = first_text
+            while text is not None:
+                for track in parser.feed(text):
+                    categories.append(track)
+                    track_info_list.append(start_track(len(categories), track))
+                text = await asyncio.to_thread(next_chunk_text, chunks)
+            s["categories"] = len(categories)
+        if not categories:
+            raise ValueError("解析エラー")
+        # 応答が途中で切れたら、揃った分だけでは作らない (不完全なメニューを解析結果として保存しない)
+        if not parser.done:
+            raise GenerationError("解析エラー: AIの応答が途中で切れました")
+        track_info_list.insert(0, start_track(0, toc_builder(categories)))
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks: task.cancel()
+        raise
+    progress_bar.progress(1.0)
+    track_stats.sort(key=lambda t: t["index"])
+    return categories, track_info_list, track_stats
+
+# --- トラックのマニフェスト (差分再生成用) ---
+# 音声フォルダに manifest.json を置き、各トラックの台本ハッシュ・声・速度・ファイルのハッシュを記録する
+MANIFEST_NAME = "manifest.json"
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""): h.update(block)
+    return h.hexdigest()
+
+def text_digest(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def write_track_manifest(output_dir, menu_data, track_info_list, voice_code, rate_value, lang_key, readings=None):
+    entries = []
+    for i, (track, info) in enumerate(zip(menu_data, track_info_list)):
+        # 合成に失敗したトラックは、同じパスに残っている前回の音声 (古い台本のもの) を消して失敗として記録する
+        if not info.get("engine") and os.path.exists(info["path"]): os.remove(info["path"])
+        info["digest"] = file_digest(info["path"]) if info.get("engine") and os.path.exists(info["path"]) else None
+        entries.append({
+            "index": i, "title": track['title'], "file": os.path.basename(info["path"]),
+            "text_hash": text_digest(track_speech_text(i, track, lang_key, readings)),
+            "voice": voice_code, "rate": rate_value, "digest": info["digest"],
+        })
+    with open(os.path.join(output_dir, MANIFEST_NAME), "w", encoding="utf-8") as f:
+        json.dump({"lang_key": lang_key, "tracks": entries}, f, ensure_ascii=False, indent=2)
+    return entries
+
+def load_track_manifest(output_dir):
+    try:
+        with open(os.path.join(output_dir, MANIFEST_NAME), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {"tracks": []}
+
+def diff_track_manifest(manifest, menu_data, output_dir, voice_code, rate_value, lang_key, readings=None):
+    # 台本・声・速度が同じで、ファイルが記録時のまま残っているトラックの番号を返す
+    old = {e["index"]: e for e in manifest.get("tracks", [])}
+    reuse = set()
+    for i, track in enumerate(menu_data):
+        e = old.get(i)
+        path = track_file_path(i, track, output_dir)
+        if not e or not e["digest"] or e["voice"] != voice_code or e["rate"] != rate_value: continue
+        if e["file"] != os.path.basename(path) or not os.path.exists(path): continue
+        if e["text_hash"] != text_digest(track_speech_text(i, track, lang_key, readings)): continue
+        if file_digest(path) == e["digest"]: reuse.add(i)
+    return reuse
+
+def playlist_from_html(html):
+    # 生成済みプレイヤーから埋め込み済みの playlist を取り出す (変更のないトラックの base64 を再利用するため)
+    start = html.find("const pl = ")
+    if start == -1: return []
+    start += len("const pl = ")
+    end = html.find(";\nlet idx", start)
+    try:
+        return json.loads(html[start:end])
+    except json.JSONDecodeError:
+        return []
+
+# --- テンプレートの差し込み ---
+# テンプレートは読み込み時に1回だけ「固定の文字列」と「差し込み名 (__NAME__)」に分けておき、
+# 描画では前から1回たどるだけにする (置換のたびに数MBの文字列を作り直さない)。
+# 値は文字列か、文字列を順に返すイテラブル (埋め込む音声を1つの大きな文字列にまとめずに書き出せる)。
+# 差し込んだ値の中の __NAME__ はそれ以上置き換えない。
+_PLACEHOLDER = re.compile(r"__([A-Z][A-Z_]*[A-Z])__")
+
+def compile_template(template):
+    # 戻り値: 偶数番目が固定の文字列、奇数番目が差し込み名のリスト
+    return _PLACEHOLDER.split(template)
+
+def render_chunks(parts, values):
+    for i, part in enumerate(parts):
+        if i % 2 == 0:
+            if part: yield part
+        elif isinstance(values[part], str):
+            yield values[part]
+        else:
+            yield from values[part]
+
+def render_template(parts, values):
+    return "".join(render_chunks(parts, values))
+
+# HTMLテンプレート (f文字列を使わない)
+HTML_TEMPLATE_RAW = """<!DOCTYPE html>
+<html lang="__LANG_CODE__"><head><meta charset="UTF-8"><meta name="viewport" content="width=device-width, initial-scale=1.0"><title>__STORE_NAME__ __UI_TITLE__</title>
+<style>
+body{font-family:sans-serif;background:#f4f4f4;margin:0;padding:20px;line-height:1.6;}
+.c{max-width:600px;margin:0 auto;background:#fff;padding:20px;border-radius:15px;box-shadow:0 2px 10px rgba(0,0,0,0.1);}
+h1{text-align:center;font-size:1.5em;color:#333;margin-bottom:10px;}
+h2{font-size:1.2em;color:#555;margin-top:20px;margin-bottom:10px;border-bottom:2px solid #eee;padding-bottom:5px;}
+.box{background:#fff5f5;border:2px solid #ff4b4b;border-radius:10px;padding:15px;text-align:center;margin-bottom:20px;}
+.ti{font-size:1.3em;font-weight:bold;color:#b71c1c;}
+.ctrl{display:flex;gap:15px;margin:20px 0;justify-content:center;}
+button{
+    flex:1; padding:15px 0; font-size:1.8em; font-weight:bold; color:#fff; background:#ff4b4b; border:none; border-radius:8px; cursor:pointer; min-height:60px;
+    display:flex; justify-content:center; align-items:center; transition:background 0.2s;
+}
+button:hover{background:#e04141;}
+button:focus, .map-btn:focus, select:focus, .itm:focus{outline:3px solid #333; outline-offset: 2px;}
+.map-btn{display:inline-block; padding:12px 20px; background-color:#4285F4; color:white; text-decoration:none; border-radius:8px; font-weight:bold; box-shadow:0 2px 5px rgba(0,0,0,0.2);}
+.lst{border-top:1px solid #eee;padding-top:10px;}
+.itm{padding:15px;border-bottom:1px solid #eee;cursor:pointer; font-size:1.1em;}
+.itm:hover{background:#f9f9f9;}
+.itm.active{background:#ffecec;color:#b71c1c;font-weight:bold;border-left:5px solid #ff4b4b;}
+</style></head>
+<body>
+<main class="c" role="main">
+    <h1>🎧 __STORE_NAME__</h1>
+    __MAP_BUTTON__
+    <section aria-label="__UI_LOADING__">
+        <div class="box"><div class="ti" id="ti" aria-live="polite">__UI_LOADING__</div></div>
+    </section>
+    <audio id="au" style="width:100%" aria-label="__UI_TITLE__ __UI_TEXT__ Player"></audio>
+    <section class="ctrl" aria-label="Controls">
+        <button onclick="prev()" aria-label="Previous">⏮</button>
+        <button onclick="toggle()" id="pb" aria-label="Play">▶</button>
+        <button onclick="next()" aria-label="Next">⏭</button>
+    </section>
+    <div style="text-align:center;margin-bottom:20px;">
+        <label for="sp" style="font-weight:bold; margin-right:5px;">__UI_SPEED__:</label>
+        <select id="sp" onchange="csp()" style="font-size:1rem; padding:5px;">
+            <option value="0.8">0.8</option>
+            <option value="1.0" selected>1.0</option>
+            <option value="1.2">1.2</option>
+            <option value="1.5">1.5</option>
+        </select>
+    </div>
+    <h2>📜 __UI_TOC__</h2>
+    <div id="ls" class="lst" role="list" aria-label="List"></div>
+</main>
+<script>
+// one: 1ファイル版の音声 (チャプター付き)。pl の各要素は src の代わりに start / end (秒) を持つ
+const one = __AUDIO_SRC__;
+const pl = __PLAYLIST_JSON__;
+let idx = 0;
+const au = document.getElementById('au');
+const ti = document.getElementById('ti');
+const pb = document.getElementById('pb');
+const langKey = "__LANG_KEY__";
+
+function init(){ ren(); ld(0); csp(); }
+
+function ld(i){
+    idx = i;
+    if(one){
+        if(!au.getAttribute('src')) au.src = one;
+        seek(pl[idx].start);
+    } else {
+        au.src = pl[idx].src;
+    }
+    ti.innerText = pl[idx].title;
+    ren();
+    csp();
+    pf(idx + 1);
+}
+
+function seek(t){
+    if(au.readyState > 0) au.currentTime = t;
+    else au.addEventListener('loadedmetadata', () => { au.currentTime = t; }, {once: true});
+}
+
+// 1ファイル版: 続けて再生しているうちに次のチャプターへ入ったら表示を切り替える
+au.ontimeupdate = function(){
+    if(!one) return;
+    let i = idx;
+    while(i < pl.length - 1 && au.currentTime >= pl[i].end) i++;
+    while(i > 0 && au.currentTime < pl[i].start) i--;
+    if(i !== idx){ idx = i; ti.innerText = pl[idx].title; ren(); }
+};
+
+function toggle(){
+    if(au.paused){
+        au.play();
+        pb.innerText = "⏸";
+    } else {
+        au.pause();
+        pb.innerText = "▶";
+    }
+}
+
+function next(){
+    if(idx < pl.length - 1){
+        ld(idx + 1);
+        au.play();
+        pb.innerText = "⏸";
+    }
+}
+
+function prev(){
+    if(idx > 0){
+        ld(idx - 1);
+        au.play();
+        pb.innerText = "⏸";
+    }
+}
+
+function csp(){
+    au.playbackRate = parseFloat(document.getElementById('sp').value);
+}
+
+au.onended = function(){
+    if(idx < pl.length - 1){
+        next();
+    } else {
+        pb.innerText = "▶";
+    }
+};
+
+function getLabel(t, i){
+    if (i === 0) return t.title;
+    if (langKey === 'Japanese') return i + "、" + t.title;
+    if (langKey === 'English (UK)') return "Chapter " + i + ". " + t.title;
+    return i + ". " + t.title;
+}
+
+function ren(){
+    const d = document.getElementById('ls');
+    d.innerHTML = "";
+    pl.forEach((t, i) => {
+        const m = document.createElement('div');
+        m.className = "itm " + (i === idx ? "active" : "");
+        m.setAttribute("role", "listitem");
+        m.setAttribute("tabindex", "0");
+        let label = getLabel(t, i);
+        m.innerText = label;
+        m.onclick = () => { ld(i); au.play(); pb.innerText = "⏸"; };
+        m.onkeydown = (e) => { if(e.key === 'Enter' || e.key === ' '){ e.preventDefault(); m.click(); } };
+        d.appendChild(m);
+    });
+}
+__PREFETCH_JS__
+init();
+</script></body></html>"""
+
+# 分割モード用: 次のトラックを先読みし、Service Worker で音声をキャッシュする
+# (Service Worker / Cache API は http(s) で配信したときだけ有効。file:// では普通に再生する)
+PREFETCH_JS_SPLIT = """const CACHE_NAME = "__CACHE_NAME__";
+function pf(i){
+    // 1ファイル版は音声全体を1回だけキャッシュする (再生中の Range 取得はキャッシュされないため)
+    const src = one || (i < pl.length ? pl[i].src : null);
+    if(!src) return;
+    if(window.caches && window.isSecureContext){
+        caches.open(CACHE_NAME).then(c => c.match(src).then(r => r || c.add(src))).catch(() => {});
+    } else if(!one){
+        const a = new Audio(); a.preload = "auto"; a.src = src;
+    }
+}
+if('serviceWorker' in navigator && location.protocol.indexOf('http') === 0){
+    navigator.serviceWorker.register('sw.js').catch(() => {});
+}"""
+
+SW_TEMPLATE_RAW = """const CACHE_NAME = "__CACHE_NAME__";
+self.addEventListener('install', e => {
+    self.skipWaiting();
+    e.waitUntil(caches.open(CACHE_NAME).then(c => c.addAll(['./', './index.html'])));
+});
+self.addEventListener('activate', e => {
+    e.waitUntil(caches.keys().then(keys => Promise.all(keys.filter(k => k !== CACHE_NAME).map(k => caches.delete(k)))));
+    self.clients.claim();
+});
+// audio 要素は Range 付きで取りに来るので、キャッシュした全体から切り出して 206 を返す
+function ranged(req, res){
+    const m = /bytes=(\\d+)-(\\d*)/.exec(req.headers.get('range') || '');
+    if(!m) return res;
+    return res.arrayBuffer().then(buf => {
+        const start = Number(m[1]);
+        const end = m[2] ? Math.min(Number(m[2]), buf.byteLength - 1) : buf.byteLength - 1;
+        return new Response(buf.slice(start, end + 1), {status: 206, headers: {
+            'Content-Type': res.headers.get('Content-Type') || 'audio/mpeg',
+            'Content-Range': 'bytes ' + start + '-' + end + '/' + buf.byteLength,
+            'Content-Length': String(end - start + 1)
+        }});
+    });
+}
+self.addEventListener('fetch', e => {
+    if(e.request.method !== 'GET') return;
+    const url = e.request.url.split('#')[0];
+    e.respondWith(caches.open(CACHE_NAME).then(c => c.match(url).then(hit => {
+        if(hit) return ranged(e.request, hit);
+        return fetch(url).then(res => {
+            if(res.status === 200){ c.put(url, res.clone()); }
+            return ranged(e.request, res);
+        });
+    })));
+});
+"""
+
+HTML_TEMPLATE = compile_template(HTML_TEMPLATE_RAW)
+PREFETCH_JS_SPLIT_TEMPLATE = compile_template(PREFETCH_JS_SPLIT)
+SW_TEMPLATE = compile_template(SW_TEMPLATE_RAW)
+
+# base64 は3バイト単位で区切って変換すれば、続けて書いてもそのままつながる
+B64_CHUNK_BYTES = 3 * 256 * 1024
+
+def _data_uri_chunks(path, mime):
+    yield f"data:{mime};base64,"
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(B64_CHUNK_BYTES)
+            if not block: break
+            yield base64.b64encode(block).decode()
+
+def _json_string_chunks(chunks):
+    # data URI は JSON でエスケープする文字を含まないので、引用符で囲むだけでよい
+    yield '"'
+    yield from chunks
+    yield '"'
+
+def _embedded_playlist_chunks(menu_data, known_srcs):
+    # json.dumps(playlist, ensure_ascii=False) と同じ形 (playlist_from_html で読み戻せる) をトラックごとに書き出す
+    yield "["
+    first = True
+    for track in menu_data:
+        known = known_srcs.get(track.get('digest'))
+        if known is None and not os.path.exists(track['path']): continue
+        if not first: yield ", "
+        first = False
+        if known is not None:
+            yield json.dumps({"title": track['title'], "src": known}, ensure_ascii=False)
+        else:
+            yield '{"title": ' + json.dumps(track['title'], ensure_ascii=False) + ', "src": '
+            yield from _json_string_chunks(_data_uri_chunks(track['path'], "audio/mp3"))
+            yield "}"
+    yield "]"
+
+# HTMLプレイヤー生成 (一度に差し込む方式)
+# playlist_json / audio_src_json: JSON のテキスト (文字列か、文字列を順に返すイテラブル)
+def _player_values(store_name, playlist_json, map_url, lang_key, prefetch_js, audio_src_json="null"):
+    ui = LANG_SETTINGS[lang_key]["ui"]
+    
+    map_button_html = ""
+    if map_url:
+        map_button_html = f"""
+        <div style="text-align:center; margin-bottom: 15px;">
+            <a href="{map_url}" target="_blank" role="button" aria-label="{ui['map_btn'].replace('🗺️ ', '')}" class="map-btn">
+                {ui['map_btn']}
+            </a>
+        </div>
+        """
+    
+    return {
+        "LANG_CODE": LANG_SETTINGS[lang_key]['code'], "STORE_NAME": store_name, "UI_TITLE": ui['title'], "UI_TEXT": ui['text'],
+        "UI_LOADING": ui['loading'], "UI_SPEED": ui['speed'], "UI_TOC": ui['toc'], "MAP_BUTTON": map_button_html,
+        "PREFETCH_JS": prefetch_js, "PLAYLIST_JSON": playlist_json, "AUDIO_SRC": audio_src_json, "LANG_KEY": lang_key,
+    }
+
+def _standalone_player_chunks(store_name, menu_data, map_url, lang_key, known_srcs, audio):
+    # 音声は読みながら base64 にして差し込む (HTML 全体を1つの文字列にしない)
+    if audio:
+        values = _player_values(store_name, json.dumps(audio["chapters"], ensure_ascii=False), map_url, lang_key, "function pf(i){}",
+                                _json_string_chunks(_data_uri_chunks(audio["path"], audio["mime"])))
+    else:
+        values = _player_values(store_name, _embedded_playlist_chunks(menu_data, known_srcs or {}), map_url, lang_key, "function pf(i){}")
+    return render_chunks(HTML_TEMPLATE, values)
+
+def create_standalone_html_player(store_name, menu_data, map_url="", lang_key="Japanese", known_srcs=None, audio=None):
+    # known_srcs: {ファイルのハッシュ: data URI} 再生成時に変更のないトラックはエンコードし直さない
+    # audio: write_chaptered_audio の戻り値。渡されたら1ファイルの音声を埋め込み、チャプターで頭出しする
+    with span("html_encode", tracks=1 if audio else len(menu_data)):
+        return "".join(_standalone_player_chunks(store_name, menu_data, map_url, lang_key, known_srcs, audio))
+
+def write_standalone_html_player(path, store_name, menu_data, map_url="", lang_key="Japanese", known_srcs=None, audio=None):
+    # create_standalone_html_player と同じ内容を、エンコードしながら少しずつファイルに書く
+    with span("html_encode", tracks=1 if audio else len(menu_data)), open(path, "w", encoding="utf-8") as f:
+        f.writelines(_standalone_player_chunks(store_name, menu_data, map_url, lang_key, known_srcs, audio))
+    return path
+
+# 分割モード: 音声は埋め込まず、同じフォルダの MP3 を相対パスで参照する軽量プレイヤー
+SPLIT_HTML_NAME = "index.html"
+SPLIT_SW_NAME = "sw.js"
+
+def create_split_html_player(store_name, menu_data, map_url="", lang_key="Japanese", audio=None):
+    # 戻り値: (index.html, sw.js)
+    playlist_js = []
+    audio_src = None
+    h = hashlib.sha256()
+    if audio:
+        audio_src = os.path.basename(audio["path"])
+        playlist_js = audio["chapters"]
+        h.update(f"{audio_src}:{file_digest(audio['path'])}".encode("utf-8"))
+    else:
+        for track in menu_data:
+            if os.path.exists(track['path']):
+                name = os.path.basename(track['path'])
+                playlist_js.append({"title": track['title'], "src": name})
+                h.update(f"{name}:{track.get('digest') or os.path.getmtime(track['path'])}".encode("utf-8"))
+    # 再生成で音声が変わったら別のキャッシュ名にして古いキャッシュを捨てさせる
+    cache_name = f"menu-{h.hexdigest()[:12]}"
+    prefetch_js = render_template(PREFETCH_JS_SPLIT_TEMPLATE, {"CACHE_NAME": cache_name})
+    html = render_template(HTML_TEMPLATE, _player_values(
+        store_name, json.dumps(playlist_js, ensure_ascii=False), map_url, lang_key, prefetch_js, json.dumps(audio_src)))
+    return html, render_template(SW_TEMPLATE, {"CACHE_NAME": cache_name})
+
+def write_split_player(output_dir, store_name, menu_data, map_url="", lang_key="Japanese", audio=None):
+    html, sw = create_split_html_player(store_name, menu_data, map_url, lang_key, audio)
+    html_path = os.path.join(output_dir, SPLIT_HTML_NAME)
+    with open(html_path, "w", encoding="utf-8") as f: f.write(html)
+    with open(os.path.join(output_dir, SPLIT_SW_NAME), "w", encoding="utf-8") as f: f.write(sw)
+    return html_path, html
+
+
+# --- 1ファイル音声 (チャプター付き) ---
+# トラックを1つの音声にまとめ、プレイヤーは曲の切り替えではなく位置の移動で頭出しする。
+# 同じ内容のチャプター一覧 (キューシート) を JSON でも書き出す。
+CHAPTERS_SUFFIX = "_chapters.json"
+
+def write_chaptered_audio(tracks, output_dir, base_name, album, codec="mp3"):
+    # 戻り値: {"path", "cue_path", "mime", "codec", "normalized", "bytes", "source_bytes", "chapters"}
+    # ffmpeg がない・失敗したときは MP3 のまま無劣化でつなぐ (音量の調整と形式の変換はしない)
+    usable = [t for t in tracks if t.get("engine") and os.path.exists(t["path"])]
+    if not usable: raise GenerationError("音声がありません")
+    paths = [t["path"] for t in usable]
+    titles = [t["title"] for t in usable]
+    ffmpeg = find_ffmpeg(FFMPEG_COMMAND)
+    with span("chapters", codec=codec, tracks=len(usable), ffmpeg=bool(ffmpeg)) as s:
+        path = None
+        if ffmpeg:
+            path = os.path.join(output_dir, base_name + AUDIO_CODECS[codec]["ext"])
+            try:
+                chapters = encode_chaptered(paths, titles, path, album, codec, AUDIO_BITRATES[codec], ffmpeg, LOUDNESS_TARGET)
+            except (RuntimeError, OSError) as e:
+                count("ffmpeg_failures", codec=codec)
+                s["ffmpeg_error"] = str(e)
+                path = None
+        normalized = path is not None
+        if path is None:
+            codec = "mp3"
+            path = os.path.join(output_dir, base_name + ".mp3")
+            chapters = join_mp3_chaptered(paths, titles, path, album)
+        s.update(codec=codec, normalized=normalized, bytes=os.path.getsize(path))
+    cue_path = os.path.join(output_dir, base_name + CHAPTERS_SUFFIX)
+    with open(cue_path, "w", encoding="utf-8") as f:
+        json.dump({"title": album, "audio": os.path.basename(path), "chapters": chapters}, f, ensure_ascii=False, indent=2)
+    return {
+        "path": path, "cue_path": cue_path, "mime": AUDIO_CODECS[codec]["mime"], "codec": codec, "normalized": normalized,
+        "bytes": os.path.getsize(path), "source_bytes": sum(os.path.getsize(p) for p in paths), "chapters": chapters,
+    }
+
+# 多言語一括モード: 言語ごとのプレイヤーを切り替えて表示するまとめページ
+MULTI_HTML_TEMPLATE_RAW = """<!DOCTYPE html>
+<html lang="__LANG_CODE__"><head><meta charset="UTF-8"><meta name="viewport" content="width=device-width, initial-scale=1.0"><title>__STORE_NAME__</title>
+<style>
+body{font-family:sans-serif;background:#f4f4f4;margin:0;padding:10px 0 0;}
+.lang{display:flex;gap:10px;max-width:640px;margin:0 auto 10px;padding:0 20px;box-sizing:border-box;}
+.lang button{flex:1;padding:12px 0;font-size:1.1em;font-weight:bold;color:#b71c1c;background:#fff;border:2px solid #ff4b4b;border-radius:8px;cursor:pointer;}
+.lang button[aria-pressed="true"]{background:#ff4b4b;color:#fff;}
+.lang button:focus{outline:3px solid #333;outline-offset:2px;}
+iframe{display:block;width:100%;height:calc(100vh - 80px);border:none;}
+</style></head>
+<body>
+<nav class="lang" id="lg" role="group" aria-label="Language"></nav>
+<iframe id="fr" title="__STORE_NAME__"></iframe>
+<script>
+const langs = __LANGS__;
+const lg = document.getElementById('lg');
+const fr = document.getElementById('fr');
+function sel(i){
+    fr.src = langs[i].src;
+    document.documentElement.lang = langs[i].code;
+    Array.from(lg.children).forEach((b, j) => b.setAttribute('aria-pressed', i === j));
+    try{ localStorage.setItem('menu-lang', langs[i].code); }catch(e){}
+}
+langs.forEach((l, i) => {
+    const b = document.createElement('button');
+    b.innerText = l.name; b.lang = l.code; b.onclick = () => sel(i);
+    lg.appendChild(b);
+});
+// 前回選んだ言語 → ブラウザの言語 → 先頭 の順で選ぶ
+let start = langs.findIndex(l => (navigator.language || '').toLowerCase().startsWith(l.code));
+try{ const j = langs.findIndex(l => l.code === localStorage.getItem('menu-lang')); if(j >= 0) start = j; }catch(e){}
+sel(start >= 0 ? start : 0);
+</script></body></html>"""
+
+MULTI_HTML_TEMPLATE = compile_template(MULTI_HTML_TEMPLATE_RAW)
+
+def create_multilang_html_player(store_name, players):
+    # players: [(lang_key, ZIP 内の相対パス)]
+    langs = [{"code": LANG_SETTINGS[k]["code"], "name": LANG_SETTINGS[k]["ui"]["lang_name"], "src": src} for k, src in players]
+    return render_template(MULTI_HTML_TEMPLATE, {
+        "LANGS": json.dumps(langs, ensure_ascii=False), "LANG_CODE": langs[0]["code"] if langs else "ja", "STORE_NAME": store_name,
+    })
+
+# --- 生成処理の本体 ---
+class GenerationError(Exception):
+    pass
+
+class _StageProgress:
+    # process_all_tracks_fast などに渡す progress_bar の代わり (進捗を report に流す)
+    def __init__(self, report, stage):
+        self.report = report
+        self.stage = stage
+
+    def progress(self, value):
+        self.report(self.stage, value)
+
+def build_menu_prompt(lang_key, user_dict=None):
+    lang_instruction = ""
+    currency = LANG_SETTINGS[lang_key]["ui"]["currency"]
+    dict_prompt = ""
+    
+    if lang_key == "Japanese":
+        lang_instruction = f"出力は全て日本語で行ってください。価格の数字には必ず「{currency}」をつけて読み上げる。"
+        # 辞書は元の文章に出てくる語だけを渡す (読み上げ時の置き換えは track_speech_text で行う)
+        if user_dict:
+            user_dict_str = json.dumps(user_dict, ensure_ascii=False)
+            dict_prompt = f"★重要：以下の固有名詞・読み方辞書を必ず守ってください。\n{user_dict_str}\n"
+    elif lang_key == "English (UK)":
+        lang_instruction = f"Translate all output into British English (UK). Group prices with {currency}."
+    elif lang_key == "Chinese":
+        lang_instruction = f"Translate all output into Simplified Chinese. Group prices with {currency}."
+    elif lang_key == "Korean":
+        lang_instruction = f"Translate all output into Korean. Group prices with {currency}."
+
+    return f"""
+            You are a professional menu accessibility expert.
+            Analyze the menu images/text and organize them into 5-8 major categories.
+            1. {lang_instruction}
+            2. Group items intelligently.
+            3. The 'text' field should be a reading script suitable for customers.
+            4. Allergens, spice level, notes must be included.
+            {dict_prompt}
+            Output MUST be valid JSON only:
+            [
+              {{"title": "Category Name", "text": "Reading script..."}},
+              {{"title": "Category Name", "text": "Reading script..."}}
+            ]
+            """
+
+# --- 分割解析 (map-reduce) ---
+# map: 数ページずつ並列に Gemini へ送り、品目を元の言語のまま抽出する。
+# reduce: 抽出した品目 (テキスト) を通常のプロンプトに渡し、5〜8カテゴリーの台本にまとめる。
+# バッチが失敗したら1ページずつに分けて再試行し、それでも読めないページだけを諦める。
+# 成功したバッチの結果は解析キャッシュに残すので、やり直したときは失敗分だけ送り直す。
+
+EXTRACT_PROMPT = """
+            You are extracting items from photos of a restaurant menu.
+            List every item on these pages. Keep names, prices and notes in the original language.
+            Output MUST be valid JSON only:
+            [
+              {"section": "Heading on the page", "name": "Item name", "price": "Price as printed",
+               "description": "Description", "notes": "Allergens, spice level, other notes"}
+            ]
+            """
+EXTRACT_PROMPT_VERSION = 1
+
+def parse_json_array(text):
+    start = text.find('[')
+    end = text.rfind(']') + 1
+    if start == -1 or end <= start: raise ValueError("JSON が見つかりません")
+    return json.loads(text[start:end])
+
+def _generate_json(model, parts, what):
+    # JSON 配列を返す1回分の呼び出し。ResourceExhausted は待ち時間を伸ばして再試行する
+    last_error = None
+    for attempt in range(MAP_MAX_ATTEMPTS):
+        try:
+            with span("llm", what=what, model=model.model_name, attempt=attempt + 1):
+                resp = model.generate_content(parts)
+            with span("json_extract"):
+                return parse_json_array(resp.text)
+        except exceptions.ResourceExhausted as e:
+            count("gemini_resource_exhausted")
+            last_error = e
+            delay = min(30.0, 2.0 * (2 ** attempt))
+            time.sleep(delay / 2 + random.uniform(0, delay / 2))
+        except Exception as e:
+            last_error = e
+    raise GenerationError(f"{what}に失敗しました: {last_error}")
+
+def _extract_items(model, pages):
+    return _generate_json(model, [EXTRACT_PROMPT] + pages, "品目の抽出")
+
+def _merge_items(batches):
+    # ページの重なりなどで同じ品目が二重に出た分をまとめる
+    items = []
+    seen = set()
+    for batch in batches:
+        for item in batch:
+            if not isinstance(item, dict): continue
+            key = (str(item.get("name", "")).strip(), str(item.get("price", "")).strip())
+            if key in seen: continue
+            seen.add(key)
+            items.append(item)
+    return items
+
+def map_menu_pages(model, model_name, pages, cache=None, report=None):
+    # pages: 前処理済みの画像 → (品目リスト, 統計)
+    t0 = time.perf_counter()
+    batches = [list(range(i, min(i + MAP_BATCH_PAGES, len(pages)))) for i in range(0, len(pages), MAP_BATCH_PAGES)]
+    digests = [hashlib.sha256(p["data"]).hexdigest() for p in pages]
+    batch_key = lambda idx: make_cache_key("extract", EXTRACT_PROMPT_VERSION, model_name, [digests[i] for i in idx])
+    results = {}
+    cached_batches = 0
+    todo = []
+    for idx in batches:
+        items = cache.get_json(batch_key(idx)) if cache else None
+        if items is None:
+            todo.append(idx)
+        else:
+            results[idx[0]] = items
+            cached_batches += 1
+
+    failed_pages = []
+    done = len(batches) - len(todo)
+
+    def run(idx):
+        try:
+            items = _extract_items(model, [pages[i] for i in idx])
+            if cache: cache.put_json(batch_key(idx), items)
+            return [(idx[0], items)], []
+        except GenerationError:
+            if len(idx) == 1: return [], idx
+        # バッチ全体が駄目なら1ページずつ試し、読めたページだけでも残す
+        recovered, failed = [], []
+        for i in idx:
+            items = cache.get_json(batch_key([i])) if cache else None
+            if items is None:
+                try:
+                    items = _extract_items(model, [pages[i]])
+                except GenerationError:
+                    failed.append(i)
+                    continue
+                if cache: cache.put_json(batch_key([i]), items)
+            recovered.append((i, items))
+        return recovered, failed
+
+    if todo:
+        with ThreadPoolExecutor(max_workers=min(MAP_MAX_CONCURRENCY, len(todo)), thread_name_prefix="menu-map") as pool:
+            futures = [pool.submit(bind(run), idx) for idx in todo]
+            for fut in as_completed(futures):
+                recovered, failed = fut.result()
+                for first, items in recovered: results[first] = items
+                failed_pages.extend(failed)
+                done += 1
+                if report: report("map", done / len(batches), f"ページを解析しています... ({done}/{len(batches)})")
+
+    if not results: raise GenerationError("すべてのページの解析に失敗しました")
+    items = _merge_items(results[k] for k in sorted(results))
+    stats = {
+        "pages": len(pages), "batches": len(batches), "cached_batches": cached_batches,
+        "failed_pages": sorted(i + 1 for i in failed_pages), "items": len(items),
+        "seconds": time.perf_counter() - t0,
+    }
+    return items, stats
+
+def reduce_prompt(prompt, items):
+    return prompt + "\n\nThe menu has already been transcribed into the following items (JSON). Use them as the menu:\n" + json.dumps(items, ensure_ascii=False)
+
+def prepare_images(images, cache=None):
+    with span("image_prep", pages=len(images)) as s:
+        prepared, stats = preprocess_images(images, IMAGE_MAX_EDGE, IMAGE_QUALITY, cache, IMAGE_PREP_WORKERS)
+        s.update(bytes_before=stats["bytes_before"], bytes_after=stats["bytes_after"], duplicates=stats["duplicates"])
+    if cache:
+        count("cache_hits", stats["cached"], cache="image")
+        count("cache_misses", stats["pages"] - stats["cached"], cache="image")
+    return prepared, stats
+
+def readings_for(lang_key, params, readings=None):
+    # 読み方辞書は日本語だけに使う。渡されなければ params["user_dict"] から作る
+    if lang_key != "Japanese": return None
+    if readings is None and params.get("user_dict"): readings = ReadingDictionary(params["user_dict"])
+    return readings
+
+def dict_subset(readings, text):
+    return readings.subset(text) if readings else None
+
+def generate_menu(params, job_dir, tts_cache=None, analysis_cache=None, limiter=None, breakers=None, report=None, image_cache=None, readings=None, web_cache=None, telemetry=None):
+    # params: store_name, menu_title, map_url, lang_key, voice_code, rate_value, api_key, model_name,
+    #         images ([{"mime_type", "data"}]), target_url, user_dict (readings がないときだけ使う), use_streaming, force_reanalyze, hedge_after,
+    #         player_mode ("single": 音声埋め込みの1ファイル / "split": 軽量HTML + 別ファイルの音声),
+    #         map_reduce (ページ数が多いときに分割して解析する),
+    #         audio_layout ("tracks": トラックごとの MP3 / "chapters": チャプター付きの1ファイル), audio_codec ("mp3" / "opus" / "aac")
+    # report(stage, progress, message="") で段階ごとの進捗を知らせる
+    # telemetry: スパンとカウンターの出力先 (Telemetry)。結果の timings / counters に今回の内訳が入る
+    with telemetry_run(telemetry, mode="single", lang=params["lang_key"], model=params["model_name"]) as run:
+        result = _generate_menu(params, job_dir, tts_cache, analysis_cache, limiter, breakers, report, image_cache, readings, web_cache)
+    result.update(timings=run.timings(), counters=run.counts())
+    return result
+
+def _generate_menu(params, job_dir, tts_cache=None, analysis_cache=None, limiter=None, breakers=None, report=None, image_cache=None, readings=None, web_cache=None):
+    if report is None: report = lambda stage, progress, message="": None
+    lang_key = params["lang_key"]
+    store_name = params["store_name"]
+    menu_title = params.get("menu_title", "")
+    voice_code = params["voice_code"]
+    rate_value = params["rate_value"]
+    hedge_after = params.get("hedge_after")
+    output_dir = os.path.join(job_dir, "audio")
+    os.makedirs(output_dir, exist_ok=True)
+
+    report("analyze", 0.0, "解析中...")
+    model = generative_model(params["api_key"], params["model_name"])
+    readings = readings_for(lang_key, params, readings)
+
+    parts = []
+    source_digests = []
+    images = params.get("images") or []
+    web_text = None
+    web_stats = None
+    if images:
+        source_digests = [hashlib.sha256(img["data"]).hexdigest() for img in images]
+    elif params.get("target_url"):
+        web_text, web_stats = web_source(params, web_cache)
+        source_digests.append(hashlib.sha256(web_text.encode("utf-8")).hexdigest())
+    else:
+        raise GenerationError("画像かURLを入力してください")
+    # 画像は解析前に中身が分からないので辞書はプロンプトに入れない (読み上げ時に置き換える)
+    prompt = build_menu_prompt(lang_key, dict_subset(readings, web_text))
+
+    # 解析キャッシュのキーは元画像のハッシュで作る (ヒットすれば前処理も不要)
+    analysis_key = make_cache_key(source_digests, prompt, params["model_name"])
+    menu_data = None
+    if analysis_cache and not params.get("force_reanalyze"):
+        menu_data = analysis_cache.get_json(analysis_key)
+    analysis_cached = menu_data is not None
+    if analysis_cache: count("cache_hits" if analysis_cached else "cache_misses", cache="analysis")
+    image_stats = None
+    map_stats = None
+    if menu_data is None:
+        if images:
+            report("prep", 0.0, "画像を最適化しています...")
+            prepared, image_stats = prepare_images(images, image_cache)
+            if params.get("map_reduce", True) and len(prepared) >= MAP_REDUCE_MIN_PAGES:
+                report("map", 0.0, "ページを分割して解析しています...")
+                with span("map", pages=len(prepared)):
+                    items, map_stats = map_menu_pages(model, params["model_name"], prepared, analysis_cache, report)
+                items_prompt = build_menu_prompt(lang_key, dict_subset(readings, json.dumps(items, ensure_ascii=False)))
+                parts = [reduce_prompt(items_prompt, items)]
+            else:
+                parts = [prompt] + prepared
+        else:
+            parts = [prompt + f"\n\n{web_text}"]
+    toc_builder = lambda cats: build_toc_track(cats, store_name, menu_title, lang_key)
+    progress_bar = _StageProgress(report, "tts")
+    tts_args = (tts_cache, limiter, breakers, hedge_after)
+
+    d_str = datetime.now().strftime('%Y%m%d')
+    s_name = sanitize_filename(store_name)
+    file_code = LANG_SETTINGS[lang_key]["ui"]["file_code"]
+    zip_name = f"{s_name}_{file_code}_{d_str}.zip"
+    zip_path = os.path.join(job_dir, zip_name)
+    chaptered = params.get("audio_layout") == "chapters"
+    # トラックは出来上がった順に ZIP へ追加していく (1ファイル版は最後にまとめた音声だけを入れる)
+    with IncrementalZip(zip_path) as zip_out:
+        on_track_done = None if chaptered else (lambda info: zip_out.add(info["path"]))
+        if menu_data is not None:
+            menu_data.insert(0, toc_builder(menu_data))
+            report("tts", 0.0, f"音声を生成しています... ({lang_key})")
+            with span("tts", tracks=len(menu_data)):
+                generated_tracks, track_stats = asyncio.run(process_all_tracks_fast(menu_data, output_dir, voice_code, rate_value, progress_bar, lang_key, *tts_args, on_track_done=on_track_done, readings=readings))
+            categories = menu_data[1:]
+        elif params.get("use_streaming", True):
+            chunks, first_text = open_menu_stream(model, parts)
+            if chunks is None: raise GenerationError("失敗しました")
+            report("tts", 0.0, f"解析しながら音声を生成しています... ({lang_key})")
+            with span("tts", streaming=True):
+                categories, generated_tracks, track_stats = asyncio.run(stream_tracks_fast(
+                    chunks, first_text, toc_builder, output_dir, voice_code, rate_value, progress_bar, lang_key, *tts_args, on_track_done=on_track_done, readings=readings))
+            if analysis_cache: analysis_cache.put_json(analysis_key, categories)
+            menu_data = [toc_builder(categories)] + categories
+        else:
+            resp = None
+            for n in range(3):
+                try:
+                    with span("llm", what="menu", model=params["model_name"], attempt=n + 1):
+                        resp = model.generate_content(parts)
+                    break
+                except exceptions.ResourceExhausted:
+                    count("gemini_resource_exhausted")
+                    time.sleep(5)
+                except Exception: pass
+
+            if not resp: raise GenerationError("失敗しました")
+
+            with span("json_extract"):
+                text_resp = resp.text
+                start = text_resp.find('[')
+                end = text_resp.rfind(']') + 1
+                if start == -1: raise GenerationError("解析エラー")
+                menu_data = json.loads(text_resp[start:end])
+            if analysis_cache: analysis_cache.put_json(analysis_key, menu_data)
+            menu_data.insert(0, toc_builder(menu_data))
+
+            report("tts", 0.0, f"音声を生成しています... ({lang_key})")
+            with span("tts", tracks=len(menu_data)):
+                generated_tracks, track_stats = asyncio.run(process_all_tracks_fast(menu_data, output_dir, voice_code, rate_value, progress_bar, lang_key, *tts_args, on_track_done=on_track_done, readings=readings))
+            categories = menu_data[1:]
+
+        write_track_manifest(output_dir, menu_data, generated_tracks, voice_code, rate_value, lang_key, readings)
+
+        audio = None
+        if chaptered:
+            report("chapters", 0.0, "1つの音声にまとめています...")
+            audio = write_chaptered_audio(generated_tracks, output_dir, f"{s_name}_{file_code}", store_name, params.get("audio_codec", "mp3"))
+            zip_out.add(audio["path"])
+            zip_out.add(audio["cue_path"])
+
+        report("html", 0.0, "プレイヤーを作成しています...")
+        player_mode = params.get("player_mode", "single")
+        with span("html", mode=player_mode, tracks=len(generated_tracks)):
+            if player_mode == "split":
+                # 音声フォルダに index.html / sw.js を置くと ZIP にもそのまま入る
+                html_path, _ = write_split_player(output_dir, store_name, generated_tracks, params.get("map_url", ""), lang_key, audio)
+                html_name = SPLIT_HTML_NAME
+                zip_out.add(html_path)
+                zip_out.add(os.path.join(output_dir, SPLIT_SW_NAME))
+            else:
+                html_name = f"{s_name}_{file_code}_player.html"
+                html_path = write_standalone_html_player(os.path.join(job_dir, html_name), store_name, generated_tracks,
+                                                         params.get("map_url", ""), lang_key, audio=audio)
+        report("zip", 1.0, "ZIPを仕上げています...")
+        # トラックは追加済みなので、残りは目録の書き込みだけ
+        with span("zip"): zip_out.close()
+
+    return {
+        "zip_name": zip_name,
+        "zip_path": zip_path,
+        "html_name": html_name,
+        "html_path": html_path,
+        "player_mode": player_mode,
+        "audio": audio,
+        "tracks": generated_tracks,
+        "track_stats": track_stats,
+        "analysis_cached": analysis_cached,
+        "image_stats": image_stats,
+        "map_stats": map_stats,
+        "web_stats": web_stats,
+        "lang_key": lang_key,
+        "job_dir": job_dir,
+        "output_dir": output_dir,
+        "menu_data": categories,
+        "store_name": store_name,
+        "menu_title": menu_title,
+        "map_url": params.get("map_url", ""),
+        "voice_code": voice_code,
+        "rate_value": rate_value,
+        "hedge_after": hedge_after,
+    }
+
+# --- 多言語一括生成 ---
+# 画像 (または Web ページ) からの品目抽出は1回だけ行い、その結果から言語ごとの台本を並列に作る。
+# 台本ができた言語から順に音声生成を始め、全言語の TTS は同じ limiter / breakers を通す。
+# ZIP には言語ごとのフォルダ (音声 + プレイヤー) と、言語を切り替えるまとめページを入れる。
+
+class _SharedProgress:
+    # 言語ごとの進捗をまとめて1本の進捗として report に流す
+    def __init__(self, report, stage, keys):
+        self.report = report
+        self.stage = stage
+        self.values = dict.fromkeys(keys, 0.0)
+
+    def part(self, key):
+        return _StageProgress(self._update, key)
+
+    def _update(self, key, value):
+        self.values[key] = value
+        self.report(self.stage, sum(self.values.values()) / len(self.values))
+
+def generate_menu_multilingual(params, job_dir, tts_cache=None, analysis_cache=None, limiter=None, breakers=None, report=None, image_cache=None, readings=None, web_cache=None, telemetry=None):
+    # params: generate_menu と同じ (lang_key / voice_code / rate_value / use_streaming を除く) に加えて
+    #         languages ([lang_key]), voice_codes ({lang_key: voice_code}, 省略時は各言語の先頭の声)
+    #         audio_layout / audio_codec は言語ごとに当てはめる
+    with telemetry_run(telemetry, mode="multilingual", languages=",".join(params["languages"]), model=params["model_name"]) as run:
+        result = _generate_menu_multilingual(params, job_dir, tts_cache, analysis_cache, limiter, breakers, report, image_cache, readings, web_cache)
+    result.update(timings=run.timings(), counters=run.counts())
+    return result
+
+def _generate_menu_multilingual(params, job_dir, tts_cache=None, analysis_cache=None, limiter=None, breakers=None, report=None, image_cache=None, readings=None, web_cache=None):
+    if report is None: report = lambda stage, progress, message="": None
+    languages = params["languages"]
+    if not languages: raise GenerationError("言語を選んでください")
+    store_name = params["store_name"]
+    menu_title = params.get("menu_title", "")
+    map_url = params.get("map_url", "")
+    hedge_after = params.get("hedge_after")
+    player_mode = params.get("player_mode", "single")
+    chaptered = params.get("audio_layout") == "chapters"
+    model_name = params["model_name"]
+    if limiter is None: limiter = AdaptiveLimiter(TTS_MAX_CONCURRENCY)
+
+    report("analyze", 0.0, "解析中...")
+    model = generative_model(params["api_key"], model_name)
+    readings = {k: readings_for(k, params, readings) for k in languages}
+
+    images = params.get("images") or []
+    web_text = None
+    web_stats = None
+    if images:
+        source_digests = [hashlib.sha256(img["data"]).hexdigest() for img in images]
+    elif params.get("target_url"):
+        web_text, web_stats = web_source(params, web_cache)
+        source_digests = [hashlib.sha256(web_text.encode("utf-8")).hexdigest()]
+    else:
+        raise GenerationError("画像かURLを入力してください")
+    prompts = {k: build_menu_prompt(k, dict_subset(readings[k], web_text)) for k in languages}
+
+    # 言語ごとの解析キャッシュは1言語モードと同じキーなので、どちらで作った結果も使い回せる
+    analysis_keys = {k: make_cache_key(source_digests, prompts[k], model_name) for k in languages}
+    scripts = {}
+    if analysis_cache and not params.get("force_reanalyze"):
+        for k in languages:
+            cached = analysis_cache.get_json(analysis_keys[k])
+            if cached is not None: scripts[k] = cached
+    cached_langs = set(scripts)
+    if analysis_cache:
+        count("cache_hits", len(cached_langs), cache="analysis")
+        count("cache_misses", len(languages) - len(cached_langs), cache="analysis")
+
+    # 共通の抽出 (キャッシュにない言語があるときだけ)
+    image_stats = None
+    map_stats = None
+    source_text = web_text
+    if len(scripts) < len(languages) and images:
+        report("prep", 0.0, "画像を最適化しています...")
+        prepared, image_stats = prepare_images(images, image_cache)
+        report("map", 0.0, "メニューの品目を抽出しています...")
+        with span("map", pages=len(prepared)):
+            items, map_stats = map_menu_pages(model, model_name, prepared, analysis_cache, report)
+        source_text = None
+
+    def write_script(lang_key):
+        if source_text is None:
+            items_prompt = build_menu_prompt(lang_key, dict_subset(readings[lang_key], json.dumps(items, ensure_ascii=False)))
+            parts = [reduce_prompt(items_prompt, items)]
+        else: parts = [prompts[lang_key] + f"\n\n{source_text}"]
+        categories = _generate_json(model, parts, f"台本の作成 ({lang_key})")
+        if analysis_cache: analysis_cache.put_json(analysis_keys[lang_key], categories)
+        return categories
+
+    d_str = datetime.now().strftime('%Y%m%d')
+    s_name = sanitize_filename(store_name)
+    zip_name = f"{s_name}_multi_{d_str}.zip"
+    zip_path = os.path.join(job_dir, zip_name)
+    progress = _SharedProgress(report, "tts", languages)
+    voice_codes = params.get("voice_codes") or {}
+    results = {}
+
+    async def run_language(lang_key, pool, zip_out):
+        file_code = LANG_SETTINGS[lang_key]["ui"]["file_code"]
+        voice_code = voice_codes.get(lang_key) or LANG_SETTINGS[lang_key]["voice_ids"][0]
+        rate_value = LANG_SETTINGS[lang_key]["rate_value"]
+        output_dir = os.path.join(job_dir, file_code)
+        os.makedirs(output_dir, exist_ok=True)
+        categories = scripts.get(lang_key)
+        if categories is None:
+            categories = await asyncio.get_running_loop().run_in_executor(pool, bind(write_script), lang_key)
+        menu_data = [build_toc_track(categories, store_name, menu_title, lang_key)] + categories
+        add_to_zip = lambda path: zip_out.add(path, f"{file_code}/{os.path.basename(path)}")
+        on_track_done = None if chaptered else (lambda info: add_to_zip(info["path"]))
+        tracks, track_stats = await process_all_tracks_fast(
+            menu_data, output_dir, voice_code, rate_value, progress.part(lang_key), lang_key,
+            tts_cache, limiter, breakers, hedge_after, on_track_done=on_track_done, readings=readings[lang_key])
+        write_track_manifest(output_dir, menu_data, tracks, voice_code, rate_value, lang_key, readings[lang_key])
+        audio = None
+        if chaptered:
+            # ffmpeg の処理は時間がかかるので、他の言語の音声生成を止めないよう別スレッドで行う
+            audio = await asyncio.to_thread(write_chaptered_audio, tracks, output_dir, f"{s_name}_{file_code}", store_name, params.get("audio_codec", "mp3"))
+            add_to_zip(audio["path"])
+            add_to_zip(audio["cue_path"])
+        results[lang_key] = {
+            "lang_key": lang_key, "voice_code": voice_code, "rate_value": rate_value,
+            "output_dir": output_dir, "zip_prefix": f"{file_code}/", "tracks": tracks, "track_stats": track_stats, "audio": audio,
+            "menu_data": categories, "analysis_cached": lang_key in cached_langs,
+        }
+
+    async def run_all(zip_out):
+        with ThreadPoolExecutor(max_workers=len(languages), thread_name_prefix="menu-script") as pool:
+            return await asyncio.gather(*[run_language(k, pool, zip_out) for k in languages], return_exceptions=True)
+
+    report("tts", 0.0, f"台本と音声を作成しています... ({len(languages)}言語)")
+    with IncrementalZip(zip_path) as zip_out:
+        with span("tts", languages=len(languages)):
+            outcomes = asyncio.run(run_all(zip_out))
+        failed = {k: str(e) for k, e in zip(languages, outcomes) if isinstance(e, Exception)}
+        if not results: raise GenerationError("すべての言語で失敗しました: " + " / ".join(failed.values()))
+
+        report("html", 0.0, "プレイヤーを作成しています...")
+        players = []
+        with span("html", mode=player_mode, languages=len(results)):
+            for lang_key in languages:
+                r = results.get(lang_key)
+                if r is None: continue
+                file_code = LANG_SETTINGS[lang_key]["ui"]["file_code"]
+                if player_mode == "split":
+                    html_path, _ = write_split_player(r["output_dir"], store_name, r["tracks"], map_url, lang_key, r["audio"])
+                    html_name = SPLIT_HTML_NAME
+                    zip_out.add(os.path.join(r["output_dir"], SPLIT_SW_NAME), f"{file_code}/{SPLIT_SW_NAME}")
+                else:
+                    html_name = f"{s_name}_{file_code}_player.html"
+                    html_path = write_standalone_html_player(os.path.join(r["output_dir"], html_name), store_name, r["tracks"],
+                                                             map_url, lang_key, audio=r["audio"])
+                zip_out.add(html_path, f"{file_code}/{html_name}")
+                r.update(html_name=html_name, html_path=html_path)
+                players.append((lang_key, f"{file_code}/{html_name}"))
+
+            combined_name = SPLIT_HTML_NAME if player_mode == "split" else f"{s_name}_player.html"
+            combined_path = os.path.join(job_dir, combined_name)
+            with open(combined_path, "w", encoding="utf-8") as f:
+                f.write(create_multilang_html_player(store_name, players))
+            zip_out.add(combined_path, combined_name)
+        report("zip", 1.0, "ZIPを仕上げています...")
+        with span("zip"): zip_out.close()
+
+    shared = {
+        "zip_name": zip_name, "zip_path": zip_path, "player_mode": player_mode, "job_dir": job_dir,
+        "store_name": store_name, "menu_title": menu_title, "map_url": map_url, "hedge_after": hedge_after,
+    }
+    languages_result = []
+    for lang_key in languages:
+        if lang_key in results:
+            # 言語ごとの結果だけで再生成などができるよう、共通の値も持たせる
+            languages_result.append({**shared, **results[lang_key]})
+    return {
+        **shared,
+        "multilingual": True,
+        "languages": languages_result,
+        "failed_languages": failed,
+        "html_name": combined_name,
+        "html_path": combined_path,
+        "image_stats": image_stats,
+        "map_stats": map_stats,
+        "web_stats": web_stats,
+    }
+
+# --- 台本の修正 (変更したトラックだけ作り直す) ---
+# 画面のスレッドではなくバックグラウンドのジョブから呼ぶ。view (1言語分の結果) をその場で書き換え、
+# 作業フォルダの音声・プレイヤー・ZIP を差分だけ更新する。
+# 戻り値: {"changed": 変更があったか, "updated": 作り直したトラック数, "failed": 作れなかったトラック数}
+def regenerate_changed_tracks(view, categories, tts_cache=None, limiter=None, breakers=None, report=None, readings=None):
+    if report is None: report = lambda stage, progress, message="": None
+    output_dir = view["output_dir"]
+    lang_key = view["lang_key"]
+    menu_data = [build_toc_track(categories, view["store_name"], view["menu_title"], lang_key)] + categories
+    manifest = load_track_manifest(output_dir)
+    readings = readings_for(lang_key, view, readings)
+    reuse = diff_track_manifest(manifest, menu_data, output_dir, view["voice_code"], view["rate_value"], lang_key, readings)
+    if len(reuse) == len(menu_data) and len(manifest["tracks"]) == len(menu_data):
+        return {"changed": False, "updated": 0, "failed": 0}
+
+    report("tts", 0.0, f"{len(menu_data) - len(reuse)}トラックを再生成しています...")
+    tracks, track_stats = asyncio.run(process_all_tracks_fast(
+        menu_data, output_dir, view["voice_code"], view["rate_value"], _StageProgress(report, "tts"), lang_key,
+        tts_cache, limiter, breakers, view.get("hedge_after"), reuse, readings=readings))
+
+    # 変更のないトラックのハッシュと、前回のプレイヤーに埋め込まれた data URI を対応付ける
+    report("html", 0.0, "プレイヤーを更新しています...")
+    old_entries = manifest["tracks"]
+    known_srcs = {}
+    if not view.get("audio"):
+        with open(view["html_path"], "r", encoding="utf-8") as f:
+            old_srcs = [p["src"] for p in playlist_from_html(f.read())]
+        known_srcs = dict(zip([e["digest"] for e in old_entries if e["digest"]], old_srcs))
+    entries = write_track_manifest(output_dir, menu_data, tracks, view["voice_code"], view["rate_value"], lang_key, readings)
+
+    new_files = {e["file"] for e in entries}
+    removed_files = {e["file"] for e in old_entries} - new_files
+    for name in removed_files:
+        path = os.path.join(output_dir, name)
+        if os.path.exists(path): os.remove(path)
+    # 作り直せなかったトラックは古い音声を消してあるので、ZIP からも外す
+    failed_files = {e["file"] for e in entries if not e["digest"]}
+    # 多言語一括モードでは ZIP 内の言語フォルダ (例: "en/") の下にある
+    prefix = view.get("zip_prefix", "")
+    removals = {prefix + name for name in removed_files | failed_files}
+    updates = {prefix + e["file"]: os.path.join(output_dir, e["file"]) for e in entries if e["index"] not in reuse and e["digest"]}
+    updated_count = len(updates)
+    audio = view.get("audio")
+    if audio:
+        # 1ファイル版は ZIP にトラックごとの MP3 を入れていないので、まとめた音声とキューシートだけを作り直す
+        report("chapters", 0.0, "音声をまとめ直しています...")
+        old_name = os.path.basename(audio["path"])
+        base_name = os.path.splitext(old_name)[0]
+        audio = write_chaptered_audio(tracks, output_dir, base_name, view["store_name"], audio["codec"])
+        removals = {prefix + old_name} - {prefix + os.path.basename(audio["path"])}
+        updates = {prefix + os.path.basename(p): p for p in (audio["path"], audio["cue_path"])}
+        view["audio"] = audio
+
+    if view.get("player_mode") == "split":
+        write_split_player(output_dir, view["store_name"], tracks, view["map_url"], lang_key, audio)
+        updates[prefix + SPLIT_HTML_NAME] = os.path.join(output_dir, SPLIT_HTML_NAME)
+        updates[prefix + SPLIT_SW_NAME] = os.path.join(output_dir, SPLIT_SW_NAME)
+    else:
+        write_standalone_html_player(view["html_path"], view["store_name"], tracks, view["map_url"], lang_key, known_srcs, audio)
+        if prefix: updates[prefix + view["html_name"]] = view["html_path"]
+    report("zip", 0.0, "ZIPを更新しています...")
+    patch_zip(view["zip_path"], updates, removals)
+    view["tracks"] = tracks
+    view["track_stats"] = track_stats
+    view["menu_data"] = categories
+    return {"changed": True, "updated": updated_count, "failed": len(failed_files)}
@@ -0,0 +1,127 @@
+import os
+import json
+import tempfile
+import threading
+from collections import deque
+
+# --- 読み方辞書 (Aho-Corasick) ---
+# 登録語をまとめたオートマトンを一度だけ作り、台本を1回なめるだけで全ての登録語を見つける。
+# 読み上げ用の台本は見つかった語を読みに置き換えてから TTS に渡す (毎回同じ結果になる)。
+# プロンプトには全件ではなく、元の文章に実際に出てくる語だけを入れる。
+
+class ReadingDictionary:
+    def __init__(self, entries=None):
+        self.entries = dict(entries or {})
+        # ノードごとの遷移・失敗リンク・そのノードで終わる語の長さ
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        for word in self.entries:
+            if word: self._insert(word)
+        self._build_links()
+
+    def _insert(self, word):
+        node = 0
+        for ch in word:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            node = nxt
+        self._out[node].append(len(word))
+
+    def _build_links(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self._goto[node].items():
+                queue.append(nxt)
+                f = self._fail[node]
+                while f and ch not in self._goto[f]: f = self._fail[f]
+                self._fail[nxt] = self._goto[f].get(ch, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def matches(self, text):
+        # 重なりを除いた (開始, 終了) のリスト。同じ位置なら長い語、位置が違えば前の語を優先する
+        found = []
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in self._goto[node]: node = self._fail[node]
+            node = self._goto[node].get(ch, 0)
+            for length in self._out[node]:
+                found.append((i + 1 - length, i + 1))
+        found.sort(key=lambda m: (m[0], -m[1]))
+        result = []
+        last_end = 0
+        for start, end in found:
+            if start >= last_end:
+                result.append((start, end))
+                last_end = end
+        return result
+
+    def apply(self, text):
+        if not self.entries or not text: return text
+        out = []
+        pos = 0
+        for start, end in self.matches(text):
+            out.append(text[pos:start])
+            out.append(self.entries[text[start:end]])
+            pos = end
+        out.append(text[pos:])
+        return "".join(out)
+
+    def subset(self, text):
+        # text に出てくる登録語だけの辞書
+        if not self.entries or not text: return {}
+        return {text[s:e]: self.entries[text[s:e]] for s, e in self.matches(text)}
+
+# --- 辞書ファイルの管理 (メモリ上に保持) ---
+# 読み込みは初回とファイルが外から書き換えられたときだけ。保存すると同時にオートマトンを作り直す。
+
+class DictionaryStore:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._dictionary = ReadingDictionary()
+
+    def _file_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _reload_locked(self):
+        mtime = self._file_mtime()
+        if mtime == self._mtime: return
+        entries = {}
+        if mtime is not None:
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    entries = json.load(f)
+            except json.JSONDecodeError:
+                entries = {}
+        self._dictionary = ReadingDictionary(entries)
+        self._mtime = mtime
+
+    @property
+    def dictionary(self):
+        with self._lock:
+            self._reload_locked()
+            return self._dictionary
+
+    def entries(self):
+        return dict(self.dictionary.entries)
+
+    def save(self, entries):
+        data = json.dumps(entries, ensure_ascii=False, indent=2)
+        with self._lock:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(data)
+            os.replace(tmp, self.path)
+            self._dictionary = ReadingDictionary(entries)
+            self._mtime = self._file_mtime()
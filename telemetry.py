@@ -0,0 +1,188 @@
+import os
+import json
+import time
+import uuid
+import logging
+import tempfile
+import threading
+import contextvars
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+
+# --- 計測 (スパンとカウンター) ---
+# 生成1回分を run() で囲み、その中の各段階 (取り込み・画像の前処理・Gemini の呼び出しと再試行・JSON の取り出し・
+# トラックごとの TTS・HTML・ZIP) を span() で囲む。実行中の run と親スパンは contextvars で受け渡すので、
+# 途中の関数に引数を足さなくてよい (asyncio のタスクや to_thread には自動で引き継がれる。
+# ThreadPoolExecutor に渡す関数は bind() で包む)。run() の外で呼ばれた span() / count() は何もしない。
+# スパンは JSON Lines のログ (サイズでローテーション) に1行ずつ書き、段階ごとの所要時間とカウンターは
+# Prometheus のテキスト形式のファイルに書き出す (node_exporter の textfile collector などで読む)。
+
+# 所要時間のヒストグラムの区切り (秒)
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_run = contextvars.ContextVar("menu_telemetry_run", default=None)
+_parent = contextvars.ContextVar("menu_telemetry_span", default=None)
+
+def _labels_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(labels):
+    if not labels: return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+class Telemetry:
+    # 全ての run で共有する出力先と累計値 (プロセス内で1つ)
+    def __init__(self, log_path=None, metrics_path=None, max_bytes=5 * 1024 * 1024, backups=3):
+        self.metrics_path = metrics_path
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._durations = {}
+        self._logger = None
+        if log_path:
+            os.makedirs(os.path.dirname(os.path.abspath(log_path)), exist_ok=True)
+            handler = RotatingFileHandler(log_path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            # 他のロガーの設定に影響しないよう、登録しない専用のロガーを使う
+            self._logger = logging.Logger("menu.telemetry")
+            self._logger.addHandler(handler)
+
+    def record_span(self, span):
+        with self._lock:
+            d = self._durations.setdefault(span["name"], {"count": 0, "sum": 0.0, "errors": 0, "buckets": [0] * len(DURATION_BUCKETS)})
+            d["count"] += 1
+            d["sum"] += span["duration"]
+            if span["status"] != "ok": d["errors"] += 1
+            for n, bound in enumerate(DURATION_BUCKETS):
+                if span["duration"] <= bound: d["buckets"][n] += 1
+        if self._logger: self._logger.info(json.dumps(span, ensure_ascii=False, default=str))
+
+    def inc(self, name, n=1, **labels):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + n
+
+    def prometheus_text(self):
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            durations = sorted((k, dict(v, buckets=list(v["buckets"]))) for k, v in self._durations.items())
+        seen = set()
+        for (name, labels), value in counters:
+            metric = f"menu_{name}_total"
+            if metric not in seen:
+                lines.append(f"# TYPE {metric} counter")
+                seen.add(metric)
+            lines.append(f"{metric}{_format_labels(labels)} {value}")
+        if durations:
+            lines.append("# HELP menu_span_duration_seconds 生成処理の段階ごとの所要時間")
+            lines.append("# TYPE menu_span_duration_seconds histogram")
+            for name, d in durations:
+                for bound, count in zip(DURATION_BUCKETS, d["buckets"]):
+                    lines.append(f'menu_span_duration_seconds_bucket{{span="{_escape(name)}",le="{bound}"}} {count}')
+                lines.append(f'menu_span_duration_seconds_bucket{{span="{_escape(name)}",le="+Inf"}} {d["count"]}')
+                lines.append(f'menu_span_duration_seconds_sum{{span="{_escape(name)}"}} {d["sum"]:.6f}')
+                lines.append(f'menu_span_duration_seconds_count{{span="{_escape(name)}"}} {d["count"]}')
+            lines.append("# TYPE menu_span_errors_total counter")
+            for name, d in durations:
+                lines.append(f'menu_span_errors_total{{span="{_escape(name)}"}} {d["errors"]}')
+        return "\n".join(lines) + "\n"
+
+    def write_metrics(self):
+        if not self.metrics_path: return
+        directory = os.path.dirname(os.path.abspath(self.metrics_path))
+        os.makedirs(directory, exist_ok=True)
+        # 読み取り側が書きかけのファイルを見ないよう、一時ファイルから置き換える
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp, self.metrics_path)
+
+class Run:
+    # 生成1回分のスパンとカウンター (画面の内訳表示に使う)
+    def __init__(self, telemetry, attrs):
+        self.id = uuid.uuid4().hex[:12]
+        self.telemetry = telemetry
+        self.attrs = attrs
+        self.spans = []
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def add_span(self, span):
+        with self._lock:
+            self.spans.append(span)
+        if self.telemetry: self.telemetry.record_span(span)
+
+    def inc(self, name, n=1, **labels):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+        if self.telemetry: self.telemetry.inc(name, n, **labels)
+
+    def timings(self):
+        # スパン名ごとの回数・合計・最大 (並列に動いた分は合計が実時間を超える)
+        summary = {}
+        with self._lock:
+            spans = list(self.spans)
+        for s in spans:
+            t = summary.setdefault(s["name"], {"name": s["name"], "count": 0, "total": 0.0, "max": 0.0, "errors": 0, "start": s["start"]})
+            t["count"] += 1
+            t["total"] += s["duration"]
+            t["max"] = max(t["max"], s["duration"])
+            t["start"] = min(t["start"], s["start"])
+            if s["status"] != "ok": t["errors"] += 1
+        return sorted(summary.values(), key=lambda t: t["start"])
+
+    def counts(self):
+        with self._lock:
+            return [{"name": name, **dict(labels), "value": value} for (name, labels), value in sorted(self.counters.items())]
+
+@contextmanager
+def run(telemetry=None, **attrs):
+    current = Run(telemetry, attrs)
+    token = _run.set(current)
+    status = "failed"
+    try:
+        with span("run", **attrs):
+            yield current
+        status = "done"
+    finally:
+        count("runs", status=status)
+        _run.reset(token)
+        if telemetry: telemetry.write_metrics()
+
+@contextmanager
+def span(name, **attrs):
+    # with span("llm", model=...) as s: s["tokens"] = ... のように、終わるまで属性を足せる
+    current = _run.get()
+    if current is None:
+        yield attrs
+        return
+    span_id = uuid.uuid4().hex[:12]
+    token = _parent.set(span_id)
+    start = time.time()
+    t0 = time.perf_counter()
+    status, error = "ok", None
+    try:
+        yield attrs
+    except BaseException as e:
+        status, error = "error", f"{e.__class__.__name__}: {e}"
+        raise
+    finally:
+        _parent.reset(token)
+        current.add_span({
+            "run": current.id, "span": span_id, "parent": _parent.get(), "name": name,
+            "start": start, "duration": time.perf_counter() - t0, "status": status, "error": error, "attrs": attrs,
+        })
+
+def count(name, n=1, **labels):
+    current = _run.get()
+    if current is not None and n: current.inc(name, n, **labels)
+
+def bind(fn):
+    # 呼び出し元の run / 親スパンを引き継いで別スレッドで動かすための包み
+    # (同じ Context は複数のスレッドで同時に使えないので、呼び出しごとに複製する)
+    ctx = contextvars.copy_context()
+    return lambda *args, **kwargs: ctx.copy().run(fn, *args, **kwargs)
@@ -0,0 +1,137 @@
+import time
+import random
+import asyncio
+import threading
+from collections import deque
+
+# --- TTS 同時実行数の制御 (AIMD) ---
+# Streamlit の各セッションはそれぞれ別スレッドの asyncio.run で動くため、
+# asyncio.Semaphore ではなくスレッドセーフな待ち行列でセッション間の上限を共有する。
+# 成功するたびに上限を少しずつ増やし (加算的増加)、失敗したら半分にする (乗算的減少)。
+
+def _grant(fut):
+    if not fut.done():
+        fut.set_result(None)
+
+class AdaptiveLimiter:
+    def __init__(self, max_limit, min_limit=1, backoff_base=0.5, backoff_cap=8.0, decrease_interval=1.0):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(max_limit)
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        # 同じ障害で一斉に失敗した分をまとめて1回の減少として扱う
+        self.decrease_interval = decrease_interval
+        self.active = 0
+        self._waiters = deque()
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self.active < int(self.limit) and not self._waiters:
+                self.active += 1
+                return
+            waiter = (loop, loop.create_future())
+            self._waiters.append(waiter)
+        try:
+            await waiter[1]
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    raise
+            # 枠を譲られた直後にキャンセルされた場合は返却する
+            self.release()
+            raise
+
+    def release(self):
+        with self._lock:
+            self.active -= 1
+            self._wake_locked()
+
+    def _wake_locked(self):
+        while self._waiters and self.active < int(self.limit):
+            loop, fut = self._waiters.popleft()
+            self.active += 1
+            try:
+                loop.call_soon_threadsafe(_grant, fut)
+            except RuntimeError:
+                # 待っていたセッションのループが既に閉じている
+                self.active -= 1
+
+    def on_success(self):
+        with self._lock:
+            self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+            self._wake_locked()
+
+    def on_failure(self):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_decrease < self.decrease_interval: return
+            self._last_decrease = now
+            self.limit = max(float(self.min_limit), self.limit / 2)
+
+    def backoff_delay(self, attempt):
+        # 指数バックオフ + ジッター (半分は固定、半分はランダム)
+        delay = min(self.backoff_cap, self.backoff_base * (2 ** attempt))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def snapshot(self):
+        with self._lock:
+            return {"limit": int(self.limit), "active": self.active, "waiting": len(self._waiters)}
+
+# --- サーキットブレーカー (TTS エンジンごと) ---
+# 連続 failure_threshold 回失敗したら open にし、reset_timeout 秒間はそのエンジンを使わない。
+# 時間が経ったら half_open として1件だけ試し、成功すれば closed に戻す。
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def _state_locked(self):
+        if self._opened_at is None: return "closed"
+        if time.monotonic() - self._opened_at >= self.reset_timeout: return "half_open"
+        return "open"
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state_locked()
+
+    def available(self):
+        # 枠を消費しない確認用 (ヘッジするかどうかの判断など)
+        return self.state != "open"
+
+    def allow(self):
+        with self._lock:
+            state = self._state_locked()
+            if state == "closed": return True
+            if state == "half_open" and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def abandon(self):
+        # 試行がキャンセルされた場合は結果を記録せず、half_open の枠だけ戻す
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self._opened_at is not None or self.failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
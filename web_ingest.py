@@ -0,0 +1,191 @@
+import re
+import hashlib
+import importlib.util
+import threading
+from urllib.parse import urljoin, urldefrag, urlparse
+from concurrent.futures import ThreadPoolExecutor
+from disk_cache import make_cache_key
+from lazy_import import LazyModule
+
+requests = LazyModule("requests")
+bs4 = LazyModule("bs4")
+
+# --- Web ページからのメニュー取り込み ---
+# 指定ページから同じサイト内の「メニューらしい」リンクを depth 段までたどり、まとめて取得する。
+# 接続は共有セッションで使い回し、前回の ETag / Last-Modified を送って変更がなければ (304)
+# 保存済みのテキストを使う。本文は行のまとまり (チャンク) に分けて重複を除き、
+# 上限を超える分は値段の少ないチャンクから落とす (先頭からの単純な切り捨てはしない)。
+
+# lxml があれば速いパーサーを使う (なければ標準の html.parser)
+HTML_PARSER = "lxml" if importlib.util.find_spec("lxml") else "html.parser"
+
+USER_AGENT = "Mozilla/5.0"
+MENU_LINK_WORDS = (
+    "menu", "lunch", "dinner", "drink", "food", "course", "price", "grand",
+    "メニュー", "ランチ", "ディナー", "ドリンク", "フード", "コース", "料理", "お品書き", "お飲み物", "料金",
+)
+PRICE_PATTERN = re.compile(r"(\d[\d,]*\s*円|[¥￥]\s*\d)")
+CHUNK_CHARS = 1500
+# この長さ以上の行が複数ページに出てきたら、住所や営業時間などの共通部分とみなして1回だけ残す
+BOILERPLATE_MIN_CHARS = 15
+
+class IngestError(Exception):
+    pass
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session(pool_size=8):
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=1)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers["User-Agent"] = USER_AGENT
+            _session = session
+        return _session
+
+def _normalize_url(url):
+    return urldefrag(url.strip())[0]
+
+def _extract(content, base_url):
+    # bytes のまま渡し、文字コードは meta charset などからパーサーに判定させる
+    soup = bs4.BeautifulSoup(content, HTML_PARSER)
+    links = []
+    for a in soup.find_all("a", href=True):
+        label = (a.get_text() or "") + " " + a["href"]
+        links.append((_normalize_url(urljoin(base_url, a["href"])), label.lower()))
+    for s in soup(["script", "style", "header", "footer", "nav", "noscript"]): s.extract()
+    text = soup.get_text(separator="\n")
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    return lines, links
+
+def fetch_page(url, cache=None, timeout=10):
+    # 戻り値: {"url", "lines", "links", "status": "fetched" / "not_modified"}
+    key = make_cache_key("web", url)
+    cached = cache.get_json(key) if cache else None
+    headers = {}
+    if cached:
+        if cached.get("etag"): headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"): headers["If-Modified-Since"] = cached["last_modified"]
+    try:
+        resp = get_session().get(url, headers=headers, timeout=timeout)
+    except requests.RequestException as e:
+        raise IngestError(f"{url}: {e}") from e
+    if resp.status_code == 304 and cached:
+        return {"url": url, "lines": cached["lines"], "links": [tuple(l) for l in cached["links"]], "status": "not_modified"}
+    if resp.status_code >= 400:
+        raise IngestError(f"{url}: HTTP {resp.status_code}")
+    if "html" not in resp.headers.get("Content-Type", "text/html"):
+        raise IngestError(f"{url}: HTML ではありません")
+    lines, links = _extract(resp.content, resp.url)
+    if cache and (resp.headers.get("ETag") or resp.headers.get("Last-Modified")):
+        cache.put_json(key, {
+            "etag": resp.headers.get("ETag"), "last_modified": resp.headers.get("Last-Modified"),
+            "lines": lines, "links": links,
+        })
+    return {"url": url, "lines": lines, "links": links, "status": "fetched"}
+
+def _menu_links(page, host, seen):
+    found = []
+    for link, label in page["links"]:
+        parsed = urlparse(link)
+        if parsed.scheme not in ("http", "https") or parsed.netloc != host: continue
+        if link in seen or link in found: continue
+        if any(w in label for w in MENU_LINK_WORDS): found.append(link)
+    return found
+
+def _chunk_lines(lines, chunk_chars=CHUNK_CHARS):
+    chunks = []
+    current = []
+    size = 0
+    for line in lines:
+        if current and size + len(line) > chunk_chars:
+            chunks.append(current)
+            current, size = [], 0
+        current.append(line)
+        size += len(line) + 1
+    if current: chunks.append(current)
+    return chunks
+
+def crawl_menu_pages(url, depth=1, max_pages=8, cache=None, workers=4, timeout=10):
+    # 戻り値: (ページのリスト (取得順), 失敗したページのエラー)
+    start = _normalize_url(url)
+    host = urlparse(start).netloc
+    if not host: raise IngestError("URLが正しくありません")
+    first = fetch_page(start, cache, timeout)
+    pages = [first]
+    errors = []
+    seen = {start}
+    frontier = [first]
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="menu-web") as pool:
+        for _ in range(depth):
+            targets = []
+            for page in frontier:
+                for link in _menu_links(page, host, seen):
+                    if len(seen) >= max_pages: break
+                    seen.add(link)
+                    targets.append(link)
+            if not targets: break
+            futures = [pool.submit(fetch_page, link, cache, timeout) for link in targets]
+            frontier = []
+            for fut in futures:
+                try:
+                    frontier.append(fut.result())
+                except IngestError as e:
+                    errors.append(str(e))
+            pages.extend(frontier)
+    return pages, errors
+
+def build_menu_text(pages, max_chars=30000):
+    # 共通部分の行と同じ内容のチャンクを除き、max_chars に収まるよう値段の多いチャンクを優先して残す
+    line_pages = {}
+    for n, page in enumerate(pages):
+        for line in page["lines"]:
+            if len(line) >= BOILERPLATE_MIN_CHARS: line_pages.setdefault(line, set()).add(n)
+    shared = {line for line, where in line_pages.items() if len(where) > 1}
+
+    chunks = []
+    seen_digests = set()
+    seen_shared = set()
+    raw_chars = 0
+    for page in pages:
+        raw_chars += sum(len(line) + 1 for line in page["lines"])
+        lines = []
+        for line in page["lines"]:
+            if line in shared:
+                if line in seen_shared: continue
+                seen_shared.add(line)
+            lines.append(line)
+        for chunk in _chunk_lines(lines):
+            text = "\n".join(chunk)
+            digest = hashlib.sha256(re.sub(r"\s+", "", text).encode("utf-8")).hexdigest()
+            if digest in seen_digests: continue
+            seen_digests.add(digest)
+            chunks.append(text)
+
+    total = sum(len(c) + 2 for c in chunks)
+    keep = set(range(len(chunks)))
+    if total > max_chars:
+        # 値段の表記が少ないチャンクから外す (同点なら後ろのものから)
+        ranked = sorted(range(len(chunks)), key=lambda i: (len(PRICE_PATTERN.findall(chunks[i])) / max(len(chunks[i]), 1), -i))
+        for i in ranked:
+            if total <= max_chars: break
+            keep.discard(i)
+            total -= len(chunks[i]) + 2
+    text = "\n\n".join(chunks[i] for i in sorted(keep))
+    stats = {
+        "pages": len(pages), "not_modified": sum(1 for p in pages if p["status"] == "not_modified"),
+        "chunks": len(chunks), "dropped_chunks": len(chunks) - len(keep),
+        "raw_chars": raw_chars, "chars": len(text), "urls": [p["url"] for p in pages],
+    }
+    return text, stats
+
+def ingest_url(url, depth=1, max_pages=8, max_chars=30000, cache=None, workers=4):
+    pages, errors = crawl_menu_pages(url, depth, max_pages, cache, workers)
+    text, stats = build_menu_text(pages, max_chars)
+    if not text: raise IngestError("ページから文字を取り出せませんでした")
+    stats["errors"] = errors
+    return text, stats
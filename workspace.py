@@ -0,0 +1,104 @@
+import os
+import time
+import uuid
+import shutil
+import threading
+
+# --- セッションごとの作業フォルダ ---
+# root/<セッションID>/<ジョブID>/ に音声・ZIP を置き、他のセッションと衝突しないようにする。
+# バックグラウンドの掃除スレッドが、古いフォルダ (最終更新からの経過時間) と
+# 合計容量の上限を超えた分 (古い順) を削除する。生成中のフォルダは削除しない。
+
+def dir_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+class WorkspaceManager:
+    def __init__(self, root, max_age, max_bytes, interval=300):
+        self.root = root
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self._active = set()
+        self._lock = threading.Lock()
+        self._janitor = None
+        os.makedirs(self.root, exist_ok=True)
+
+    def create(self, session_id):
+        job_id = f"{time.strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8]}"
+        path = os.path.join(self.root, session_id, job_id)
+        os.makedirs(path)
+        with self._lock:
+            self._active.add(path)
+        return path
+
+    def release(self, path):
+        with self._lock:
+            self._active.discard(path)
+
+    def touch(self, path):
+        # 結果を表示しているセッションのフォルダは使用中とみなして寿命を延ばす
+        try:
+            os.utime(path, None)
+        except FileNotFoundError:
+            pass
+
+    def remove(self, path):
+        self.release(path)
+        shutil.rmtree(path, ignore_errors=True)
+        parent = os.path.dirname(path)
+        try:
+            os.rmdir(parent)
+        except OSError:
+            pass
+
+    def _jobs(self):
+        jobs = []
+        for session in os.scandir(self.root):
+            if not session.is_dir(): continue
+            for job in os.scandir(session.path):
+                if not job.is_dir(): continue
+                try:
+                    jobs.append((job.stat().st_mtime, job.path))
+                except FileNotFoundError:
+                    pass
+        return jobs
+
+    def sweep(self):
+        now = time.time()
+        with self._lock:
+            active = set(self._active)
+        removed = 0
+        remaining = []
+        for mtime, path in sorted(self._jobs()):
+            if path in active: continue
+            if now - mtime > self.max_age:
+                self.remove(path)
+                removed += 1
+            else:
+                remaining.append((path, dir_size(path)))
+        total = sum(size for _, size in remaining)
+        for path, size in remaining:
+            if total <= self.max_bytes: break
+            self.remove(path)
+            removed += 1
+            total -= size
+        return removed
+
+    def start_janitor(self):
+        if self._janitor is not None: return
+        def loop():
+            while True:
+                try:
+                    self.sweep()
+                except OSError:
+                    pass
+                time.sleep(self.interval)
+        self._janitor = threading.Thread(target=loop, name="workspace-janitor", daemon=True)
+        self._janitor.start()
@@ -0,0 +1,67 @@
+import os
+import copy
+import struct
+import zipfile
+
+# MP3 は既に圧縮されているので deflate し直さずに格納する
+def compression_for(name):
+    return zipfile.ZIP_STORED if name.lower().endswith(".mp3") else zipfile.ZIP_DEFLATED
+
+# --- 逐次書き込みの ZIP ---
+# トラックが出来上がるたびに add() で追加し、最後に close() で目録を書く。
+# 全部そろってからフォルダを走査して作り直すより早く ZIP が完成する。
+
+class IncrementalZip:
+    def __init__(self, zip_path):
+        self.path = zip_path
+        self._zf = zipfile.ZipFile(zip_path, "w")
+        self._names = set()
+
+    def add(self, path, arcname=None):
+        arcname = arcname or os.path.basename(path)
+        if arcname in self._names: return
+        self._zf.write(path, arcname, compress_type=compression_for(arcname))
+        self._names.add(arcname)
+
+    def close(self):
+        self._zf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# --- ZIP の差分更新 ---
+# 変更のないエントリは圧縮済みのバイト列をそのまま新しい ZIP に写し、
+# 変更・追加されたファイルだけを圧縮し直す。
+
+def _copy_raw_entry(src_fp, info, dst):
+    src_fp.seek(info.header_offset)
+    header = src_fp.read(30)
+    name_len, extra_len = struct.unpack("<HH", header[26:30])
+    src_fp.seek(info.header_offset + 30 + name_len + extra_len)
+    raw = src_fp.read(info.compress_size)
+
+    new_info = copy.copy(info)
+    # データディスクリプタは写さないので、ローカルヘッダにサイズと CRC を書く
+    new_info.flag_bits &= ~0x08
+    new_info.header_offset = dst.fp.tell()
+    if hasattr(new_info, "_end_offset"): new_info._end_offset = None
+    dst.fp.write(new_info.FileHeader())
+    dst.fp.write(raw)
+    dst.start_dir = dst.fp.tell()
+    dst.filelist.append(new_info)
+    dst.NameToInfo[new_info.filename] = new_info
+
+def patch_zip(zip_path, updates, removals=()):
+    # updates: {ZIP内の名前: 元ファイルのパス}  removals: 削除するZIP内の名前
+    tmp = zip_path + ".tmp"
+    with open(zip_path, "rb") as src_fp, zipfile.ZipFile(src_fp) as old, \
+            zipfile.ZipFile(tmp, "w") as new:
+        for info in old.infolist():
+            if info.filename in updates or info.filename in removals: continue
+            _copy_raw_entry(src_fp, info, new)
+        for name, path in updates.items():
+            new.write(path, name, compress_type=compression_for(name))
+    os.replace(tmp, zip_path)